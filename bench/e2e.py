@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""会話→要約→gist保存→音声合成の一連の処理のレイテンシの計測
+
+OpenAI, Gist, VOICEVOXの代わりにlib/fake_serverのフェイクサーバーを
+同じプロセス内で起動し、ネットワークやAPIキー無しで計測する。
+フェイクサーバーの遅延やエラーの割合を変えて、性能の変化を確かめる。
+
+- ttft: 質問してから回答の最初の文字が届くまで
+- turn: 質問してから回答の全文が届くまで
+- summary_lag: 回答の全文が届いてから要約がgistへ保存されるまで
+- first_audio: 質問してから最初の音声の再生が始まるまで(--voiceを指定したとき)
+
+--tail-rateの割合の回答だけ--tail-latencyだけ遅らせ、--hedgeで
+2つ目のフェイクサーバーへのヘッジを有効にすると、p99の変化を確かめられる。
+
+# USAGE
+$ python bench/e2e.py --turns 20 --openai-latency 0.3 --chunk-interval 0.01
+$ python bench/e2e.py --voice 3 --tts-latency 0.1 --error-rate 0.05
+$ python bench/e2e.py --turns 200 --tail-rate 0.05 --tail-latency 3 --hedge
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+import statistics
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib import fake_server  # noqa: E402
+
+# 計測用のキャラクター設定
+CHARACTER = """- name: "Bench"
+  filename: "bench.txt"
+  max_tokens: 300
+"""
+# 質問
+PROMPT = "こんにちは"
+# 要約がgistへ保存されるのを待つ上限(秒)
+SUMMARY_TIMEOUT = 30.0
+
+
+def summarize(samples: list[float]) -> dict:
+    """中央値、95と99パーセンタイル、平均、最大(ミリ秒)"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return {
+        "n": len(samples),
+        "p50_ms": round(statistics.median(samples) * 1000, 1),
+        "p95_ms": round(p95 * 1000, 1),
+        "p99_ms": round(p99 * 1000, 1),
+        "mean_ms": round(statistics.mean(samples) * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+async def start_servers(args: argparse.Namespace, patches: list) -> list:
+    """フェイクサーバーを起動し、libが使うURLを環境変数で差し替える"""
+    def on_patch(name: str, _content: str):
+        patches.append((perf_counter(), name))
+
+    def openai_app():
+        return fake_server.openai_app(latency=args.openai_latency,
+                                      error_rate=args.error_rate,
+                                      chunk_interval=args.chunk_interval,
+                                      tail_rate=args.tail_rate,
+                                      tail_latency=args.tail_latency)
+
+    openai = await fake_server.start(openai_app())
+    runners = [openai]
+    character = CHARACTER
+    if args.hedge:  # 2つ目のフェイクサーバーへヘッジする
+        backup = await fake_server.start(openai_app())
+        runners.append(backup)
+        character += "  endpoints:\n" + "".join(
+            f'    - endpoint: "{fake_server.url_of(r)}/v1/chat/completions"\n'
+            for r in runners)
+        if args.hedge_after is not None:
+            character += f"  hedge_after: {args.hedge_after}\n"
+    gist = await fake_server.start(
+        fake_server.gist_app({
+            "character.yml": character,
+            "bench.txt": ""
+        },
+                             latency=args.gist_latency,
+                             error_rate=args.error_rate,
+                             on_patch=on_patch))
+    tts = await fake_server.start(
+        fake_server.tts_app(latency=args.tts_latency,
+                            error_rate=args.error_rate,
+                            ready_after=args.tts_ready_after))
+    engine = await fake_server.start(
+        fake_server.voicevox_app(latency=args.tts_latency,
+                                 error_rate=args.error_rate))
+    scratch = tempfile.mkdtemp(prefix="chatme-bench-")
+    os.environ.update({
+        "CHATGPT_API_KEY": "bench",
+        # フェイクサーバーなのでレート制限で待たせない
+        "CHATGPT_RPM": "1000000",
+        "CHATGPT_TPM": "1000000000",
+        "CHATGPT_ENDPOINT":
+        fake_server.url_of(openai) + "/v1/chat/completions",
+        "GIST_ID": "bench",
+        "GITHUB_TOKEN": "bench",
+        "GIST_API_ROOT": fake_server.url_of(gist) + "/gists/",
+        "VOICEVOX_SLOW_URL": fake_server.url_of(tts) + "/v1",
+        "VOICEVOX_FAST_URL": fake_server.url_of(tts) + "/v2",
+        "VOICEVOX_LOCAL_URL": fake_server.url_of(engine),
+        "XDG_CACHE_HOME": os.path.join(scratch, "cache"),
+        "XDG_DATA_HOME": os.path.join(scratch, "data"),
+    })
+    return runners + [gist, tts, engine]
+
+
+async def wait_summary(patches: list, filename: str, since: float) -> float:
+    """since以降に要約がgistへ保存されるまで待ち、その時刻を返す"""
+    deadline = perf_counter() + SUMMARY_TIMEOUT
+    while perf_counter() < deadline:
+        for at, name in patches:
+            if name == filename and at > since:
+                return at
+        await asyncio.sleep(0.005)
+    raise TimeoutError("要約がgistへ保存されませんでした。")
+
+
+async def bench(args: argparse.Namespace) -> dict:
+    """args.turns回会話して各項目を計測する"""
+    patches: list[tuple[float, str]] = []
+    runners = await start_servers(args, patches)
+    # 環境変数を差し替えてから読み込む
+    from lib.ai import ai_constructor
+    from lib.http_session import close_session
+    from lib.storage import open_storage
+    from lib.voicevox_character import Mode
+    import lib.voicevox_audio as voicevox_audio
+    from lib.voice_cache import VoiceCache
+    if not args.voice_cache:
+        voicevox_audio.voice_cache = VoiceCache(max_bytes=0)
+    ai = await asyncio.to_thread(ai_constructor,
+                                 name="Bench",
+                                 voice=Mode(args.voice))
+    ai.storage = open_storage(delay=args.write_delay)
+    samples: dict[str, list[float]] = {
+        "ttft": [],
+        "turn": [],
+        "summary_lag": [],
+        "first_audio": [],
+    }
+    errors = 0
+    history = []
+    try:
+        for _ in range(args.turns):
+            start = perf_counter()
+            first_token = []
+            first_audio = []
+            speech = None
+            if args.voice:
+                speech = voicevox_audio.SpeechPipeline(
+                    ai.speaker,
+                    ai.voice,
+                    player=lambda _: first_audio.append(perf_counter()))
+
+            def on_delta(delta: str):
+                if not first_token:
+                    first_token.append(perf_counter())
+                if speech is not None:
+                    speech.feed(delta)
+
+            try:
+                await ai.respond(history, PROMPT, on_delta)
+            except ValueError:
+                errors += 1
+                continue
+            finally:
+                if speech is not None:
+                    speech.close()
+            end = perf_counter()
+            samples["ttft"].append(first_token[0] - start)
+            samples["turn"].append(end - start)
+            if speech is not None:
+                await speech.wait()
+                if first_audio:
+                    samples["first_audio"].append(first_audio[0] - start)
+            saved = await wait_summary(patches, ai.filename, end)
+            samples["summary_lag"].append(saved - end)
+    finally:
+        await ai.flush()
+        await close_session()
+        for runner in runners:
+            await runner.cleanup()
+    result = {name: summarize(values) for name, values in samples.items()}
+    result["errors"] = errors
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="会話の一連の処理のレイテンシの計測")
+    parser.add_argument("--turns", type=int, default=10, help="会話の回数")
+    parser.add_argument("--voice",
+                        type=int,
+                        default=0,
+                        choices=[0, 1, 2, 3],
+                        help="音声の生成先(1=SLOW, 2=FAST, 3=LOCAL)")
+    parser.add_argument("--openai-latency",
+                        type=float,
+                        default=0.2,
+                        help="ChatGPTの最初のバイトまでの遅延(秒)")
+    parser.add_argument("--chunk-interval",
+                        type=float,
+                        default=0.01,
+                        help="ChatGPTのストリーミングの1文字ごとの間隔(秒)")
+    parser.add_argument("--gist-latency",
+                        type=float,
+                        default=0.1,
+                        help="gistの応答の遅延(秒)")
+    parser.add_argument("--tts-latency",
+                        type=float,
+                        default=0.1,
+                        help="VOICEVOXの応答の遅延(秒)")
+    parser.add_argument("--tts-ready-after",
+                        type=float,
+                        default=0.5,
+                        help="SLOWモードの音声の準備ができるまでの時間(秒)")
+    parser.add_argument("--tail-rate",
+                        type=float,
+                        default=0.0,
+                        help="ChatGPTの回答を--tail-latencyだけ遅らせる割合(0から1)")
+    parser.add_argument("--tail-latency",
+                        type=float,
+                        default=0.0,
+                        help="遅らせた回答の最初のバイトまでの遅延(秒)")
+    parser.add_argument("--hedge",
+                        action="store_true",
+                        help="2つ目のChatGPTのフェイクサーバーへヘッジする")
+    parser.add_argument("--hedge-after",
+                        type=float,
+                        default=None,
+                        help="ヘッジを送るまでの待ち時間(秒, default=応答時間のp95)")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        default=0.0,
+                        help="フェイクサーバーがエラーを返す割合(0から1)")
+    parser.add_argument("--write-delay",
+                        type=float,
+                        default=0.0,
+                        help="要約をgistへ書き込むまでにまとめる待ち時間(秒)")
+    parser.add_argument("--voice-cache",
+                        action="store_true",
+                        help="音声キャッシュを使う(default=毎回合成する)")
+    print(json.dumps(asyncio.run(bench(parser.parse_args())), indent=2))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""ChatSessionで長い会話を続けたときのメモリ使用量の計測
+
+lib/fake_serverのChatGPTのフェイクサーバーを同じプロセス内で起動し、
+ChatSession.send()で何千ターンも会話して、RSSの推移を記録する。
+会話履歴はトークン予算で切り詰められ、要約は階層ごとにまとめ直され、
+長期記憶は--memory-records件を超えると古いやり取りから捨てられるので、
+ウォームアップ後のRSSの増加が--max-growth-mbを超えたら失敗(終了コード1)にする。
+毎ターン違う質問をして、長期記憶が上限まで埋まるようにする。
+
+# USAGE
+$ python bench/soak.py --turns 3000
+$ python bench/soak.py --turns 500 --sample 50 --max-growth-mb 10
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib import fake_server  # noqa: E402
+
+# 質問。{turn}にターン数が入る
+PROMPT = "今日は何をしようかな(その{turn})"
+
+
+def rss_mb() -> float:
+    """このプロセスのRSS(MB)"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource  # /procが無いときは最大RSSで代用する
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+async def soak(args: argparse.Namespace) -> dict:
+    """args.turns回会話してargs.sampleターンごとにRSSを記録する"""
+    openai = await fake_server.start(
+        fake_server.openai_app(chunk_interval=args.chunk_interval))
+    scratch = tempfile.mkdtemp(prefix="chatme-soak-")
+    os.environ.update({
+        "CHATGPT_API_KEY": "soak",
+        # フェイクサーバーなのでレート制限で待たせない
+        "CHATGPT_RPM": "1000000",
+        "CHATGPT_TPM": "1000000000",
+        "CHATGPT_ENDPOINT":
+        fake_server.url_of(openai) + "/v1/chat/completions",
+        "XDG_CACHE_HOME": os.path.join(scratch, "cache"),
+        "XDG_DATA_HOME": os.path.join(scratch, "data"),
+    })
+    # 環境変数を差し替えてから読み込む
+    from lib.ai import AI
+    from lib.session import ChatSession
+    from lib.storage import SQLiteStorage
+    from lib.http_session import close_session
+    from lib.memory_store import MemoryStore
+    storage = SQLiteStorage(os.path.join(scratch, "storage.sqlite3"))
+    session = ChatSession(
+        AI(name="Soak",
+           filename="soak.txt",
+           storage=storage,
+           summary_turns=args.summary_turns))
+    session.ai.memory = MemoryStore.open(session.ai.filename,
+                                         directory=os.path.join(
+                                             scratch, "memory"),
+                                         max_records=args.memory_records)
+    samples: list[tuple[int, float]] = []
+    errors = 0
+    start = perf_counter()
+    try:
+        for turn in range(1, args.turns + 1):
+            try:
+                await session.send(PROMPT.format(turn=turn))
+            except ValueError:
+                errors += 1
+            if turn % args.sample == 0:
+                samples.append((turn, round(rss_mb(), 1)))
+        await session.close()
+    finally:
+        await close_session()
+        await openai.cleanup()
+        storage.close()
+    elapsed = perf_counter() - start
+    # ウォームアップ後の最初の計測からの増加
+    settled = [rss for turn, rss in samples if turn >= args.warmup]
+    growth = settled[-1] - settled[0] if settled else 0.0
+    return {
+        "turns": args.turns,
+        "errors": errors,
+        "turns_per_sec": round(args.turns / elapsed, 1),
+        "history": len(session.history),
+        "summary_chars": len(session.ai.chat_summary),
+        "memory_records": len(session.ai.memory.records),
+        "rss_mb": samples,
+        "growth_mb": round(growth, 1),
+        "ok": growth <= args.max_growth_mb,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="長い会話のメモリ使用量の計測")
+    parser.add_argument("--turns", type=int, default=3000, help="会話の回数")
+    parser.add_argument("--sample",
+                        type=int,
+                        default=100,
+                        help="RSSを記録する間隔(ターン)")
+    parser.add_argument("--warmup",
+                        type=int,
+                        default=500,
+                        help="RSSの増加を数え始めるターン")
+    parser.add_argument("--max-growth-mb",
+                        type=float,
+                        default=20.0,
+                        help="ウォームアップ後に許すRSSの増加(MB)")
+    parser.add_argument("--summary-turns",
+                        type=int,
+                        default=10,
+                        help="要約するまでに貯める会話の数")
+    parser.add_argument("--memory-records",
+                        type=int,
+                        default=2000,
+                        help="長期記憶の数の上限")
+    parser.add_argument("--chunk-interval",
+                        type=float,
+                        default=0.0,
+                        help="ChatGPTのストリーミングの1文字ごとの間隔(秒)")
+    result = asyncio.run(soak(parser.parse_args()))
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if result["ok"] else 1)
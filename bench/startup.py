@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""chatme.pyの起動時間の計測
+
+- import: `import chatme` にかかる時間(インタプリタの起動時間を除く)
+- prompt: ローカルのキャラクター設定YAMLで起動して、
+  入力プロンプトが表示されるまでの時間
+
+エディタから毎回起動されるので、重いモジュールを起動時に読み込むような
+変更で遅くなっていないかを確かめる。しきい値を超えたら終了コード1で終わる。
+
+# USAGE
+$ python bench/startup.py
+$ python bench/startup.py --repeat 20 --max-import-ms 150 --max-prompt-ms 400
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# chatmeの入力プロンプト
+PROMPT = "あなた: ".encode("utf-8")
+# 計測用のキャラクター設定
+CHARACTER = """- name: "Bench"
+  max_tokens: 100
+"""
+
+
+def run_python(code: str) -> float:
+    """python -c codeの実行時間(秒)"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def time_to_prompt(character_file: str) -> float:
+    """chatme.pyを起動して入力プロンプトが表示されるまでの時間(秒)"""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "chatme.py", "-c", "Bench", "-y", character_file],
+        cwd=ROOT,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    output = b""
+    try:
+        while PROMPT not in output:
+            chunk = proc.stdout.read1(1024)
+            if not chunk:
+                raise RuntimeError(f"プロンプトが表示されませんでした。{output!r}")
+            output += chunk
+        return time.perf_counter() - start
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def measure(repeat: int) -> dict:
+    """各項目の中央値(ミリ秒)"""
+    with tempfile.NamedTemporaryFile("w",
+                                     suffix=".yml",
+                                     encoding="utf-8",
+                                     delete=False) as f:
+        f.write(CHARACTER)
+    try:
+        interpreter = [run_python("pass") for _ in range(repeat)]
+        imports = [run_python("import chatme") for _ in range(repeat)]
+        prompts = [time_to_prompt(f.name) for _ in range(repeat)]
+    finally:
+        os.remove(f.name)
+    base = statistics.median(interpreter)
+    return {
+        "interpreter_ms": round(base * 1000, 1),
+        "import_ms": round((statistics.median(imports) - base) * 1000, 1),
+        "prompt_ms": round(statistics.median(prompts) * 1000, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="chatme.pyの起動時間の計測")
+    parser.add_argument("--repeat", type=int, default=10, help="計測回数")
+    parser.add_argument("--max-import-ms",
+                        type=float,
+                        default=None,
+                        help="importにかかる時間の上限(ミリ秒)")
+    parser.add_argument("--max-prompt-ms",
+                        type=float,
+                        default=None,
+                        help="プロンプト表示までの時間の上限(ミリ秒)")
+    args = parser.parse_args()
+    result = measure(args.repeat)
+    print(json.dumps(result))
+    if args.max_import_ms is not None and \
+            result["import_ms"] > args.max_import_ms:
+        sys.exit(1)
+    if args.max_prompt_ms is not None and \
+            result["prompt_ms"] > args.max_prompt_ms:
+        sys.exit(1)
@@ -1,9 +1,29 @@
 #!/usr/bin/env python3
 """chatgptに複数回の質問と回答 CLI"""
+import sys
 import argparse
 import asyncio
-from lib.ai import ai_constructor
-from lib.voicevox_character import CV, Mode
+from lib.http_session import close_session
+from lib.voicevox_character import Mode
+
+
+class HelpParser(argparse.ArgumentParser):
+    """--helpを表示するときだけVOICEVOXのキャラクター一覧を作るパーサー"""
+    def format_help(self) -> str:
+        from lib.voicevox_character import CV
+        cv_list = "\n".join(str(t) for t in CV.items().items())
+        self.description = f"""ChatGPT client
+
+        speakers: {cv_list}"""
+        return super().format_help()
+
+
+def positive_int(value: str) -> int:
+    """1以上の整数の引数"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"1以上を指定してください: {value}")
+    return number
 
 
 def parse_args() -> argparse.Namespace:
@@ -18,12 +38,23 @@ def parse_args() -> argparse.Namespace:
       3. --speaker, -s : VOICEVOX キャラクターボイスを指定する。
           strまたはintを指定する。デフォルトは0。
       4. --yaml, -y : AIカスタム設定YAMLのファイルパスを指定する。デフォルトはNone。
+      5. --offline : ネットワークにアクセスせず、gistのキャッシュだけを使う。
+      6. --daemon : Unixソケットで待ち受ける常駐モードで起動する。
+          質問はlib/chat_client.pyから送る。
+      7. --socket : 常駐モードで待ち受けるUnixソケットのパス。
+      8. --batch, -b : プロンプトを書いたJSONLファイルのパス。
+          -なら標準入力から読む。結果をJSONLで標準出力へ書き出す。
+      9. --concurrency : バッチモードで同時に問い合わせる数(1以上)。デフォルトは4。
+      10. --trace : 処理ごとの時間とトークン数を記録するJSON Linesのパス。
+          終了時に処理ごとの集計を表示する。
+      11. --serve : 多くのユーザーとキャラクタの会話を受け持つHTTPサーバーで起動する。
+          回答はSSEかWebSocketで返す。
+      12. --host, --port : HTTPサーバーで待ち受けるアドレスとポート。
+      13. --connections : HTTPサーバーからAPIへの同時接続数の上限(1以上)。
+          同時に流せる回答の数になる。デフォルトは100。
     - 引数を解析した結果をargparse.Namespaceオブジェクトに格納し、戻り値として返す。
     """
-    cv_list = "\n".join(str(t) for t in CV.items().items())
-    parser = argparse.ArgumentParser(description=f"""ChatGPT client
-
-        speakers: {cv_list}""")
+    parser = HelpParser(description="ChatGPT client")
     parser.add_argument(
         "--character",
         "-c",
@@ -50,15 +81,153 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help="AIカスタム設定YAMLのファイルパス",
     )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="ネットワークにアクセスせず、gistのキャッシュだけを使って起動する",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Unixソケットで待ち受ける常駐モードで起動する",
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help="常駐モードで待ち受けるUnixソケットのパス",
+    )
+    parser.add_argument(
+        "--batch",
+        "-b",
+        default=None,
+        help="プロンプトを書いたJSONLファイルのパス(-で標準入力)。"
+        "結果をJSONLで標準出力へ書き出す",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=4,
+        help="バッチモードで同時に問い合わせる数(default=4)",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="処理ごとの時間とトークン数をJSON Linesで記録するファイルのパス"
+        "(環境変数CHATME_TRACEでも指定できる)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="SSEとWebSocketで会話を受け付けるHTTPサーバーで起動する",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="HTTPサーバーで待ち受けるアドレス(default=127.0.0.1)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="HTTPサーバーで待ち受けるポート(default=8080)",
+    )
+    parser.add_argument(
+        "--connections",
+        type=positive_int,
+        default=100,
+        help="HTTPサーバーからAPIへの同時接続数の上限(default=100)",
+    )
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-    args = parse_args()
+async def main(ai):
+    """会話を始め、終了時に保存待ちの要約を書き込んで共有セッションを閉じる
+    q/exitでの終了でもCtrl-Cでの中断でも必ず書き込む。
+    """
+    from lib.session import ChatSession
+    session = ChatSession(ai)
+    try:
+        await session.interact()
+    finally:
+        await session.close()
+        await close_session()
+
+
+async def serve(args: argparse.Namespace):
+    """常駐モードで待ち受け、終了時に共有セッションを閉じる"""
+    from lib.daemon import ChatDaemon
+    from lib.chat_client import SOCKET_PATH
+    daemon = ChatDaemon(character=args.character,
+                        voice=Mode(args.voice),
+                        speaker=args.speaker,
+                        character_file=args.yaml,
+                        offline=args.offline)
+    try:
+        await daemon.serve(args.socket or SOCKET_PATH)
+    except RuntimeError as err:  # 他のデーモンが起動している
+        print(f"Error: {err}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        await close_session()
+
+
+async def serve_http(args: argparse.Namespace):
+    """HTTPサーバーで待ち受け、終了時に共有セッションを閉じる"""
+    from lib.server import ChatServer
+    server = ChatServer(character=args.character,
+                        voice=Mode(args.voice),
+                        speaker=args.speaker,
+                        character_file=args.yaml,
+                        offline=args.offline,
+                        connections=args.connections)
+    try:
+        await server.serve(args.host, args.port)
+    finally:
+        await close_session()
+
+
+async def batch(ai, path: str, concurrency: int):
+    """バッチモードでプロンプトを問い合わせ、終了時に共有セッションを閉じる"""
+    from lib.batch import read_prompts, run_batch
+    if path == "-":
+        items = read_prompts(sys.stdin)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            items = read_prompts(f)
+    try:
+        await run_batch(ai, items, sys.stdout, concurrency)
+    finally:
+        await close_session()
+
+
+def run(args: argparse.Namespace):
+    """引数に応じてサーバー、常駐モード、バッチモード、対話モードのいずれかで起動する"""
+    if args.serve:
+        asyncio.run(serve_http(args))
+        return
+    if args.daemon:
+        asyncio.run(serve(args))
+        return
+    from lib.ai import ai_constructor
     ai = ai_constructor(name=args.character,
                         voice=Mode(args.voice),
                         speaker=args.speaker,
-                        character_file=args.yaml)
+                        character_file=args.yaml,
+                        offline=args.offline)
+    if args.batch:
+        asyncio.run(batch(ai, args.batch, args.concurrency))
+        return
     # Start chat
     print("空行で入力確定, qまたはexitで会話終了")
-    asyncio.run(ai.ask([]))
+    asyncio.run(main(ai))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    from lib.metrics import tracer
+    if args.trace:
+        tracer.enable(args.trace)
+    try:
+        run(args)
+    finally:
+        tracer.close()  # 処理ごとの時間の集計を表示する
@@ -5,22 +5,39 @@
 """
 import os
 import sys
+import copy
 import json
+import signal
 from enum import Enum, auto
 from collections import namedtuple
-from typing import Optional
+from typing import Optional, Callable, AsyncIterator, Iterator, TYPE_CHECKING
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
 import random
-from time import sleep
 from itertools import cycle
+from time import perf_counter
 import asyncio
-import yaml
-import aiohttp
 from .voicevox_character import CV, Mode
+from .http_session import get_session, warmup
+from .context import fit_context, estimate_tokens, CONTEXT_TOKENS
+from .rate_limit import limiter, Priority, backoff, retry_after, MAX_RETRIES
+from .metrics import tracer
+from .response_cache import response_cache, cacheable
+from .memory_store import MemoryStore, MEMORY_TOP_K
+from .tiered_summary import TieredSummary
+from .storage import Storage, open_storage
+from .hedge import Route, hedged, parse_routes
+from .summary_scheduler import SummaryScheduler, SUMMARY_TURNS, \
+    SUMMARY_INTERVAL
+
+if TYPE_CHECKING:
+    import aiohttp
 
 # ChatGPT API Key
 API_KEY = os.getenv("CHATGPT_API_KEY")
 # ChatGPT API Endpoint
-ENDPOINT = "https://api.openai.com/v1/chat/completions"
+ENDPOINT = os.getenv("CHATGPT_ENDPOINT",
+                     "https://api.openai.com/v1/chat/completions")
 # ChatGPT API header
 HEADERS = {
     "Content-Type": "application/json",
@@ -36,6 +53,10 @@ CONFIG_FILE = "character.yml"
 PROMPT = "あなた: "
 # OpenAI model
 MODEL = "gpt-3.5-turbo"
+# キャラクタ設定にendpointsが無いときの問い合わせの経路
+DEFAULT_ROUTE = Route(ENDPOINT, MODEL, API_KEY)
+# 待ってから再試行するHTTPステータス
+RETRY_STATUS = (429, 500, 502, 503, 504)
 # 会話履歴
 Message = namedtuple("Message", ["role", "content"])
 
@@ -53,11 +74,17 @@ class Role(Enum):
 
 
 async def spinner():
-    """非同期処理待ちスピナー"""
+    """非同期処理待ちスピナー
+    止められるまでの表示時間をspinnerとして記録する。
+    """
     dots = cycle([".", "..", "..."])
-    while True:
-        print(f"{next(dots):<3}", end="\r")
-        await asyncio.sleep(0.1)
+    start = perf_counter()
+    try:
+        while True:
+            print(f"{next(dots):<3}", end="\r")
+            await asyncio.sleep(0.1)
+    finally:
+        tracer.record("spinner", start)
 
 
 def get_content(resp_json: dict) -> str:
@@ -69,18 +96,166 @@ def get_content(resp_json: dict) -> str:
     return content
 
 
-def print_one_by_one(text):
-    """一文字ずつ出力"""
+def get_delta(chunk: dict) -> str:
+    """ストリーミングのチャンクJSONからAIの回答の差分を取得"""
+    try:
+        delta = chunk['choices'][0]['delta']
+    except (KeyError, IndexError):
+        raise KeyError(f"キーが見つかりません。{chunk}")
+    return delta.get("content") or ""
+
+
+async def iter_sse(
+        response: "aiohttp.ClientResponse") -> AsyncIterator[dict]:
+    """Server-Sent Eventsのdata行をJSONとして順に返す
+    data: [DONE] を受け取ったら終了する。
+    """
+    async for raw in response.content:
+        line = raw.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        yield json.loads(data)
+
+
+def request_tokens(data: dict) -> int:
+    """レート制限で数えるリクエストのトークン数
+    OpenAIはプロンプトとmax_tokensの合計でTPMを数える。
+    """
+    prompt = sum(estimate_tokens(m["content"]) for m in data["messages"])
+    return prompt + data.get("max_tokens", 0)
+
+
+@asynccontextmanager
+async def open_completion(
+    data: dict,
+    priority: Priority = Priority.INTERACTIVE,
+    route: Route = DEFAULT_ROUTE
+) -> AsyncIterator["aiohttp.ClientResponse"]:
+    """レート制限を守ってrouteのChatGPT APIにPOSTし、ステータス200のレスポンスを返す
+    429と5xxと接続エラーはRetry-Afterか、無ければジッタ付きの
+    指数バックオフだけ待ってMAX_RETRIES回まで再試行する。
+    429のときは共有のレート制限を止めて、他のリクエストも待たせる。
+    再試行しても失敗したらValueErrorを投げる。
+    """
+    import aiohttp
+    tokens = request_tokens(data)
+    body = json.dumps(data)
+    headers = {**HEADERS, "Authorization": f"Bearer {route.api_key}"}
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire(tokens, priority)
+        try:
+            response = await get_session().post(route.endpoint,
+                                                headers=headers,
+                                                data=body)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+            if attempt == MAX_RETRIES:
+                raise ValueError(f"Error: {err}") from err
+            await asyncio.sleep(backoff(attempt))
+            continue
+        if response.status == 200:
+            try:
+                yield response
+            finally:
+                response.release()
+            return
+        message = await response.text()
+        response.release()
+        if response.status not in RETRY_STATUS or attempt == MAX_RETRIES:
+            raise ValueError(f"Error: {response.status}, Message: {message}")
+        delay = retry_after(response.headers) or backoff(attempt)
+        if response.status == 429:
+            limiter.pause(delay)
+        else:
+            await asyncio.sleep(delay)
+
+
+def cached_content(data: dict, endpoint: str = ENDPOINT) -> Optional[str]:
+    """temperature=0のリクエストならキャッシュした回答を返す。無ければNone"""
+    if not cacheable(data):
+        return None
+    start = perf_counter()
+    content = response_cache.get(endpoint, data)
+    if content is not None:
+        tracer.record("cache.hit", start)
+    return content
+
+
+def store_content(data: dict, content: str, endpoint: str = ENDPOINT):
+    """temperature=0のリクエストなら回答をキャッシュする"""
+    if cacheable(data) and content:
+        response_cache.put(endpoint, data, content)
+
+
+async def complete(route: Route, data: dict) -> AsyncIterator[str]:
+    """routeのモデルでdataを問い合わせ、回答の差分を届いた順に返す
+    stream=trueでなければ回答の全文を1回だけ返す。
+    """
+    data = {**data, "model": route.model}
+    stream = bool(data.get("stream"))
+    with tracer.span("post", model=route.model, stream=stream):
+        async with open_completion(data, route=route) as response:
+            if not stream:
+                ai_response = await response.json()
+                tracer.add_usage("post", ai_response.get("usage"))
+                yield get_content(ai_response)
+                return
+            async for chunk in iter_sse(response):
+                if chunk.get("usage"):
+                    tracer.add_usage("post", chunk["usage"])
+                if not chunk.get("choices"):
+                    continue
+                delta = get_delta(chunk)
+                if delta:
+                    yield delta
+
+
+async def print_one_by_one(text, printed: Optional[list[str]] = None):
+    """一文字ずつ出力
+    イベントループを止めないようにasyncio.sleepで待つ。
+    printedを渡すと出力した文字を追加する(途中で止められたときのため)。
+    """
     for char in f"{text}\n":
         try:
             print(char, end="", flush=True)
-            sleep(INTERVAL)
+            if printed is not None:
+                printed.append(char)
+            await asyncio.sleep(INTERVAL)
         except KeyboardInterrupt:
             return
 
 
+class StreamPrinter:
+    """ストリーミングで受け取った差分を届いた順に出力する
+    最初の差分が届いたらスピナーを止めてAIの名前を表示する。
+    """
+    def __init__(self, name: str, spinner_task: asyncio.Task):
+        self.name = name
+        self.spinner_task = spinner_task
+        self.started = False
+
+    def __call__(self, delta: str):
+        if not self.started:
+            self.started = True
+            self.spinner_task.cancel()
+            print(f"{self.name}: ", end="", flush=True)
+        print(delta, end="", flush=True)
+
+    def close(self):
+        """改行して出力を終える"""
+        if self.started:
+            print("\n")
+
+
+# 入力待ちのスレッド。タイムアウトしても読み続け、次の入力待ちで使う
+_input_task: Optional[asyncio.Task] = None
+
+
 async def wait_for_input(timeout: float) -> str:
     """時間経過でタイムアウトエラーを発生させる"""
+    global _input_task
     silent_input = [
         "",
         "続けて",
@@ -89,13 +264,16 @@ async def wait_for_input(timeout: float) -> str:
     ]
     try:
         # 5分入力しなければ下記のいずれかの指示をしてAIが話し始める
-        input_task = asyncio.create_task(async_input())
-        done, _ = await asyncio.wait({input_task}, timeout=timeout)
-        if input_task in done:
+        if _input_task is None or _input_task.done():
+            _input_task = asyncio.create_task(async_input())
+        done, _ = await asyncio.wait({_input_task}, timeout=timeout)
+        if _input_task in done:
+            input_task, _input_task = _input_task, None
             return input_task.result()
         raise asyncio.TimeoutError("Timeout")
     except asyncio.CancelledError:
-        input_task.cancel()
+        _input_task.cancel()
+        _input_task = None
         raise
     except asyncio.TimeoutError:
         # 5分黙っていたらランダムに一つ質問
@@ -109,6 +287,42 @@ async def async_input() -> str:
     return await asyncio.get_running_loop().run_in_executor(None, multi_input)
 
 
+@contextmanager
+def barge_in(task: asyncio.Task) -> Iterator[None]:
+    """withブロックの間、Ctrl-Cが押されるか入力が始まったらtaskを取り消す
+    入力は端末から読むときだけ見張る。読まずに残した行や
+    入力待ちのスレッドが読んだ行は、次の入力待ちで質問として使う。
+    """
+    loop = asyncio.get_running_loop()
+    # asyncio.runの入れたハンドラを後で戻す
+    previous = signal.getsignal(signal.SIGINT)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+        sigint = True
+    except (NotImplementedError, RuntimeError, ValueError):
+        sigint = False  # Windowsやメインスレッド以外では使えない
+    fd = None
+    if _input_task is not None:  # タイムアウトした入力待ちがまだ読んでいる
+        _input_task.add_done_callback(lambda _: task.cancel())
+    elif sys.stdin.isatty():
+        fd = sys.stdin.fileno()
+
+        def typed():
+            loop.remove_reader(fd)
+            task.cancel()
+
+        loop.add_reader(fd, typed)
+    try:
+        yield
+    finally:
+        if sigint:
+            loop.remove_signal_handler(signal.SIGINT)
+            if previous is not None:  # Python以外で設定されたものは戻せない
+                signal.signal(signal.SIGINT, previous)
+        if fd is not None:
+            loop.remove_reader(fd)
+
+
 def multi_input() -> str:
     """複数行読み込み
     空行で入力確定
@@ -128,11 +342,20 @@ class AI:
                  temperature=1.0,
                  system_role=None,
                  filename="chatgpt-assistant.txt",
-                 gist=None,
+                 storage: Optional[Storage] = None,
                  chat_summary="",
-                 messages_limit: int = 2,
+                 messages_limit: Optional[int] = None,
+                 context_tokens: int = CONTEXT_TOKENS,
                  voice: Mode = Mode.NONE,
-                 speaker: CV = CV.四国めたんノーマル):
+                 speaker: CV = CV.四国めたんノーマル,
+                 stream: bool = True,
+                 write_delay: Optional[float] = None,
+                 summary_turns: int = SUMMARY_TURNS,
+                 summary_interval: float = SUMMARY_INTERVAL,
+                 memory_tokens: int = 0,
+                 memory_top_k: int = MEMORY_TOP_K,
+                 endpoints: Optional[list] = None,
+                 hedge_after: Optional[float] = None):
         # YAMLから設定するオプション
         self.name = name
         self.max_tokens = max_tokens
@@ -146,37 +369,108 @@ class AI:
                 """
         self.system_role = system_role
         self.filename = filename
-        self.gist = gist  # 長期記憶
+        self.storage = storage  # 要約の保存先(長期記憶)
+        self.write_delay = write_delay  # gistへの書き込みをまとめる待ち時間(秒)
+        self.tiers = TieredSummary()  # 階層に分けた会話の要約
         self.chat_summary = chat_summary  # 会話履歴
-        self.messages_limit = int(messages_limit)  # 会話履歴のストック上限数
+        # 要約と会話を貯めて検索する長期記憶(Noneなら要約の全文を送る)
+        self.memory: Optional[MemoryStore] = None
+        # 質問ごとに思い出す記憶のトークン数の予算と件数の上限
+        # 長期記憶はディスクに貯まるので、キャラクタ設定で正にしたときだけ使う
+        self.memory_tokens = int(memory_tokens)
+        self.memory_top_k = int(memory_top_k)
+        # summary_turns会話ごとかsummary_interval秒ごとにまとめて要約する
+        self.summaries = SummaryScheduler(self.summarize, int(summary_turns),
+                                          float(summary_interval))
+        # 会話履歴のストック上限数(None=トークン予算のみで制限)
+        self.messages_limit = messages_limit and int(messages_limit)
+        # system_role + chat_summary + 会話履歴に使うトークン数の予算
+        self.context_tokens = int(context_tokens)
         self.voice = voice
         # AIの発話用テキスト読み上げキャラクターを設定
         self.speaker = self.set_speaker(speaker)
-
-    async def post(self, chat_messages: list[Message]) -> str:
-        """ユーザーの入力を受け取り、ChatGPT APIにPOSTし、AIの応答を返す"""
+        self.stream = stream  # 回答を届いた順に表示する
+        # 問い合わせの経路。先頭へ送り、遅いか失敗したら次へも送る
+        self.routes = parse_routes(endpoints, DEFAULT_ROUTE)
+        # 次の経路へ送るまでの待ち時間(秒, None=経路ごとの応答時間のp95)
+        self.hedge_after = hedge_after and float(hedge_after)
+
+    @property
+    def chat_summary(self) -> str:
+        """プロンプトに入れる会話の要約(階層を古い順につないだもの)"""
+        return self.tiers.render()
+
+    @chat_summary.setter
+    def chat_summary(self, text: str):
+        """gistに保存した要約か従来の要約の文字列から階層を読み込む"""
+        self.tiers = TieredSummary.parse(text)
+
+    async def post(self,
+                   chat_messages: list[Message],
+                   on_delta: Optional[Callable[[str], None]] = None) -> str:
+        """ユーザーの入力を受け取り、ChatGPT APIにPOSTし、AIの応答を返す
+        self.streamが真のときはstream=trueでリクエストし、
+        差分が届くたびにon_deltaを呼び出す。
+        戻り値は履歴と要約に使う回答の全文。
+        プロンプトはcontext_tokensに収まるように古い側から切り詰める。
+        長期記憶があれば、要約の全文の代わりに全体像と質問に関係の深い記憶だけを送る。
+        temperature=0のときは回答をキャッシュし、同じリクエストでは
+        APIに問い合わせずにキャッシュした回答を一度にon_deltaへ渡す。
+        経路が複数あれば、最初の差分が遅いときに次の経路へも問い合わせ、
+        先に届いたほうの回答を使う。
+        """
+        chat_summary, chat_messages = fit_context(self.system_role,
+                                                  self.recall(chat_messages),
+                                                  chat_messages,
+                                                  self.context_tokens)
         messages = [{
             "role": str(Role.SYSTEM),
             "content": self.system_role
         }, {
             "role": str(Role.ASSISTANT),
-            "content": self.chat_summary
+            "content": chat_summary
         }]
         messages += [h._asdict() for h in chat_messages]  # 会話のやり取り
         data = {
-            "model": MODEL,
+            "model": self.routes[0].model,
             "max_tokens": self.max_tokens,
             "temperature": self.temperature,
             "messages": messages
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(ENDPOINT,
-                                    headers=HEADERS,
-                                    data=json.dumps(data)) as response:
-                ai_response = await response.json()
-        content = get_content(ai_response)
+        content = cached_content(data, self.routes[0].endpoint)
+        if content is not None:
+            if on_delta is not None:
+                on_delta(content)
+            return content
+        if self.stream:
+            data["stream"] = True
+            if tracer.enabled:  # 最後のチャンクでトークン使用量を受け取る
+                data["stream_options"] = {"include_usage": True}
+        chunks = []
+        route = self.routes[0]
+        async for route, delta in hedged(self.routes,
+                                         partial(complete, data=data),
+                                         tag=self.stream,
+                                         after=self.hedge_after,
+                                         ready=partial(
+                                             limiter.ready,
+                                             request_tokens(data))):
+            chunks.append(delta)
+            if on_delta is not None:
+                on_delta(delta)
+        content = "".join(chunks)
+        # 次の同じ質問は先頭の経路のキーで探すので、そのキーでも保存する
+        store_content(data, content, self.routes[0].endpoint)
+        if route != self.routes[0]:  # 回答したモデルのリクエストとしても保存する
+            store_content({**data, "model": route.model}, content,
+                          route.endpoint)
         return content
 
+    async def warmup(self):
+        """問い合わせの経路のAPIサーバーへ先に接続しておく"""
+        endpoints = dict.fromkeys(r.endpoint for r in self.routes)
+        await asyncio.gather(*(warmup(e) for e in endpoints))
+
     def set_speaker(self, sp):
         """ AI.speakerの判定
         コマンドラインからspeakerオプションがintかstrで与えられていたら
@@ -192,49 +486,173 @@ class AI:
         except TypeError:  # sp == None
             return self.speaker
 
+    def recall(self, chat_messages: list[Message]) -> str:
+        """プロンプトに入れる要約
+        長期記憶があれば、ユーザーとの関係の全体像(profile)を先頭に置き、
+        残りのmemory_tokensに最新の質問に関係の深い記憶を詰めて返す。
+        無ければ要約の全文を返す。
+        """
+        if self.memory is None or not chat_messages:
+            return self.chat_summary
+        profile = self.tiers.profile.strip()
+        budget = self.memory_tokens
+        if profile:
+            budget -= estimate_tokens(profile) + 1  # 改行
+        memories = self.memory.recall(chat_messages[-1].content,
+                                      self.memory_top_k, budget)
+        return "\n".join(p for p in (profile, memories) if p)
+
+    def trim(self, chat_messages: list[Message]):
+        """会話履歴をcontext_tokensに収まるように古いものから捨てる
+        messages_limitが設定されていれば、N会話分を超えた分も捨てる。
+        2倍するのはUserの質問とAssistantと回答で1セットだから。
+        """
+        _, kept = fit_context(self.system_role, self.recall(chat_messages),
+                              chat_messages, self.context_tokens)
+        del chat_messages[:len(chat_messages) - len(kept)]
+        if self.messages_limit:
+            del chat_messages[:-self.messages_limit * 2]
+
     async def summarize(self, chat_messages: list[Message]):
         """要約用のChatGPT: Summarizerを呼び出して要約文を作成し、
         要約文をgistへアップロードする。
+        chat_messagesは前回の要約に成功してから増えた会話だけで、
+        self.summariesから1つずつ呼び出される。
+        新しい会話だけを要約して最近の要約に足し、
+        溜まった古い要約は上の階層へまとめ直す。
+        要約はstorageへ保存し、gistへのアップロードは間引いて非同期に行う。
+        """
+        summarizer = Summarizer("")
+        with tracer.span("summary", messages=len(chat_messages)):
+            recent = await summarizer.post(chat_messages)
+        # 保存し終えるまでは複製を変えるので、途中で失敗しても
+        # 次の要約で同じ会話を二重に足さない
+        tiers = self.tiers.copy()
+        tiers.recent.append(recent)
+        try:
+            with tracer.span("summary.compact"):
+                await tiers.compact(condense)
+        except ValueError as err:  # 次の要約のときにもう一度まとめ直す
+            print(f"要約をまとめ直せませんでした: {err}", file=sys.stderr)
+        if self.memory is not None:  # 要約の各項目を検索できるように貯める
+            for line in recent.splitlines():
+                self.memory.add(line, kind="summary")
+            for digest in tiers.digests:  # まとめ直した要約も貯める
+                self.memory.add(digest, kind="digest")
+        if self.storage is not None:
+            await self.storage.put(self.filename, tiers.dump())
+        self.tiers = tiers
+
+    def load(self, storage: Optional[Storage]):
+        """storageから要約を読み込み、memory_tokensが正なら長期記憶を開く
+        保存先の読み込みは同期処理。
+        """
+        if storage is not None:
+            self.storage = storage
+            self.chat_summary = storage.get(self.filename) or ""
+        # 要約の全文の代わりに質問に関係の深い記憶だけを送る
+        if self.memory_tokens > 0:
+            self.memory = MemoryStore.open(self.filename,
+                                           seed=self.chat_summary)
+            for digest in self.tiers.digests:  # 記憶を貯めた後にまとめ直した要約
+                self.memory.add(digest, kind="digest")
+
+    def for_session(self,
+                    session: str,
+                    storage: Optional[Storage] = None) -> "AI":
+        """会話sessionだけの要約と長期記憶を持つ複製を返す
+        キャラクタの設定を共有し、要約と長期記憶はfilenameを
+        "{session}@{filename}"に分けてstorage(None=キャラクタの保存先)へ保存する。
+        保存先の読み込みは同期処理。
+        """
+        ai = copy.copy(self)
+        ai.filename = f"{session}@{self.filename}"
+        ai.tiers = TieredSummary()
+        ai.memory = None
+        ai.summaries = SummaryScheduler(ai.summarize, self.summaries.turns,
+                                        self.summaries.interval)
+        ai.load(self.storage if storage is None else storage)
+        return ai
+
+    async def flush(self):
+        """要約待ちの会話を要約し、保存待ちの要約を長期記憶へすぐに書き込む"""
+        await self.summaries.drain()
+        if self.storage is not None:
+            await self.storage.flush()
+
+    async def respond(self,
+                      chat_messages: list[Message],
+                      user_input: str,
+                      on_delta: Optional[Callable[[str], None]] = None,
+                      settle: bool = True) -> str:
+        """1会話分の質問と回答
+        質問と回答を会話履歴に追加し、要約を予約して、古い会話履歴を捨てる。
+        回答を得られなかったときは質問を会話履歴から取り除く。
+        回答の途中で取り消されたときは、on_deltaへ渡した分だけを回答として残す。
+        settleが偽なら会話履歴に追加するだけで、回答を表示し終えてから
+        settle()かamend()を呼ぶまで要約と長期記憶には入れない。
+        会話の番号(tracer.next_turn())は呼び出し側で進める。
         """
-        summarizer = Summarizer(self.chat_summary)
-        self.chat_summary = await summarizer.post(chat_messages)
-        self.gist.patch(self.chat_summary)
+        chat_messages.append(Message(str(Role.USER), user_input))
+        delivered: list[str] = []
 
-    async def ask(self, chat_messages: list[Message]):
-        """AIへの質問"""
-        while True:  # 入力待受
-            try:
-                user_input = await wait_for_input(TIMEOUT)
-                user_input = user_input.replace("/n", " ")
-                if user_input.strip() in ("q", "exit"):
-                    raise SystemExit
-                # 待っても入力がなければ、再度質問待ち
-                # 入力があればループを抜け回答を考えてもらう
-                if user_input.strip() != "":
-                    chat_messages.append(Message(str(Role.USER), user_input))
-                    break
-            except KeyboardInterrupt:
-                print()
-        # 回答を考えてもらう
-        spinner_task = asyncio.create_task(spinner())  # スピナー表示
-        # ai_responseが出てくるまで待つ
-        ai_response: str = await self.post(chat_messages)
-        spinner_task.cancel()
+        def deliver(delta: str):
+            delivered.append(delta)
+            if on_delta is not None:
+                on_delta(delta)
+
+        try:
+            ai_response: str = await self.post(chat_messages, deliver)
+        except asyncio.CancelledError:
+            if delivered:
+                self.remember(chat_messages, "".join(delivered))
+            else:
+                chat_messages.pop()
+            raise
+        except BaseException:
+            chat_messages.pop()
+            raise
+        self.remember(chat_messages, ai_response, settle)
+        return ai_response
+
+    def remember(self,
+                 chat_messages: list[Message],
+                 ai_response: str,
+                 settle: bool = True):
+        """回答を会話履歴に追加し、settleが真なら要約を予約する"""
         # 会話履歴に追加
         chat_messages.append(Message(str(Role.ASSISTANT), ai_response))
-        # N会話分のlimitを超えるとtoken節約のために会話の内容を忘れる
-        # 2倍するのはUserの質問とAssistantと回答で1セットだから。
-        while len(chat_messages) > self.messages_limit * 2:
-            chat_messages.pop(0)
+        if settle:
+            self.settle(chat_messages)
+
+    def settle(self, chat_messages: list[Message]):
+        """最後の質問と回答を長期記憶に貯めて要約を予約し、古い会話履歴を捨てる"""
+        if self.memory is not None:  # やり取りをそのまま長期記憶に貯める
+            self.memory.add("\n".join(f"- {m.role}: {m.content}"
+                                      for m in chat_messages[-2:]))
         # 会話の要約をバックグラウンドで進める非同期処理
-        asyncio.create_task(self.summarize(chat_messages))
-        # 音声出力オプションがあれば、音声の再生
-        if self.voice > 0:
-            from lib.voicevox_audio import play_voice
-            play_voice(ai_response, self.speaker, self.voice)
-        print_one_by_one(f"{self.name}: {ai_response}\n")
-        # 次の質問
-        await self.ask(chat_messages)
+        self.summaries.add(chat_messages[-2:])
+        # トークン予算を超えるとtoken節約のために古い会話の内容を忘れる
+        self.trim(chat_messages)
+
+    def amend(self, chat_messages: list[Message], delivered: str):
+        """最後の回答を実際に表示できた部分だけにして要約を予約する
+        何も表示できなかったときは質問ごと会話履歴から取り除く。
+        """
+        if not chat_messages or chat_messages[-1].role != str(Role.ASSISTANT):
+            return
+        if delivered.strip():
+            chat_messages[-1] = chat_messages[-1]._replace(content=delivered)
+            self.settle(chat_messages)
+        else:
+            del chat_messages[-2:]
+
+    async def ask(self, chat_messages: list[Message]):
+        """AIへの質問
+        端末で質問を受け付けて答える。qかexitで終わる。
+        """
+        from .session import ChatSession
+        await ChatSession(self, chat_messages).interact()
 
 
 class Summarizer(AI):
@@ -244,11 +662,14 @@ class Summarizer(AI):
         name="Summarizer",
         max_tokens=2000,
         temperature=0,
+        system_role=None,
     ):
         super().__init__()
-        self.chat_summary = chat_summary
+        # まとめ直す要約の文字列をそのまま使う(保存した要約として読まない)
+        self.tiers = TieredSummary(digests=[chat_summary])
+        self.max_tokens = max_tokens
         self.temperature = temperature
-        self.system_role = """
+        self.system_role = system_role or """
         発言者がuserとassistantどちらであるかわかるように、
         下記の会話をリスト形式で、ですます調を使わずにである調で要約してください。
         要約は必ず2000tokens以内で収まるようにして、
@@ -274,23 +695,38 @@ class Summarizer(AI):
                 "content": content
             }]
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(ENDPOINT,
-                                    headers=HEADERS,
-                                    data=json.dumps(data)) as response:
-                if response.status != 200:
-                    raise ValueError(
-                        f'Error: {response.status}, Message: {response.json()}'
-                    )
+        content = cached_content(data)
+        if content is not None:
+            return content
+        # 要約は対話の回答より後回しにする
+        with tracer.span("summary.post", model=MODEL):
+            async with open_completion(data, Priority.BACKGROUND) as response:
                 ai_response = await response.json()
+        tracer.add_usage("summary.post", ai_response.get("usage"))
         content = get_content(ai_response)
+        store_content(data, content)
         return content
 
 
+async def condense(text: str, max_tokens: int) -> str:
+    """古い要約をmax_tokens以内にまとめ直す(TieredSummary.compactで使う)"""
+    summarizer = Summarizer(text,
+                            max_tokens=max_tokens,
+                            system_role=f"""
+        発言者がuserとassistantどちらであるかわかるように、
+        下記の要約をリスト形式で、ですます調を使わずにである調でまとめ直してください。
+        まとめ直した要約は必ず{max_tokens}tokens以内で収まるようにして、
+        ユーザーについての事実や好みはなるべく残してください。
+        """)
+    return await summarizer.post([])
+
+
 def ai_constructor(name: str = "ChatGPT",
                    voice: Mode = Mode.NONE,
                    speaker=None,
-                   character_file: Optional[str] = None) -> AI:
+                   character_file: Optional[str] = None,
+                   offline: bool = False,
+                   storage: Optional[Storage] = None) -> AI:
     """YAMLファイルから設定リストを読み込み、characterに指定されたAIキャラクタを返す
 
     Args:
@@ -298,18 +734,27 @@ def ai_constructor(name: str = "ChatGPT",
         voice: AIの音声生成モード。
         speaker: AIの発話用テキスト読み上げキャラクター。
         character_file: ローカルのキャラ設定YAMLファイルのパス
+        offline: ネットワークにアクセスせず、gistのキャッシュだけを使う
+        storage: 複数のキャラクタで共有する保存先(Noneなら開く)
 
     Returns:
         選択されたAIキャラクタのインスタンス。
     """
+    import yaml
+    shared = storage is not None
     if character_file:  # ローカルのキャラ設定YAMLファイルが指定されたとき
         with open(character_file, "r", encoding="utf-8") as yaml_str:
             config = yaml.safe_load(yaml_str)
-    else:  # キャラ設定YAMLファイルが指定されなければGist上のキャラ設定を読みに行く
-        from lib.gist_memory import Gist
-        gist = Gist(CONFIG_FILE)
-        yaml_str = gist.get()
-        config = yaml.safe_load(yaml_str)
+        storage = None
+    else:  # キャラ設定YAMLファイルが指定されなければ保存先のキャラ設定を読みに行く
+        if offline:
+            from lib.gist_memory import Gist
+            Gist.offline = True
+        # ローカルに無ければgistから読む。
+        # character.ymlと会話履歴は同じgistにあるので、取得は1回で済む
+        storage = storage or open_storage()
+        yaml_str = storage.get(CONFIG_FILE)
+        config = yaml_str and yaml.safe_load(yaml_str)
     if config is None:
         raise ValueError("キャラクター設定ファイルが存在しません。")
 
@@ -321,10 +766,10 @@ def ai_constructor(name: str = "ChatGPT",
     ai = [a for a in ais if a.name == name][-1]
 
     # コマンドライン引数から設定を適用
-    if not character_file:
-        # 会話履歴を読み込む
-        ai.gist = Gist(ai.filename)
-        ai.chat_summary = ai.gist.get()
+    if storage is not None and ai.write_delay is not None and not shared:
+        storage.set_delay(float(ai.write_delay))
+    # 会話の要約と長期記憶を読み込む
+    ai.load(storage)
     # AIの音声生成モードを設定
     if isinstance(voice, int):
         voice = Mode(voice)
@@ -0,0 +1,92 @@
+"""プロンプトをまとめて問い合わせるバッチモード
+
+JSONLか1行1プロンプトのテキストからプロンプトを読み、
+キャラクタのsystem_roleとchat_summaryを使って並行に問い合わせる。
+結果は入力と同じ順にJSONLで書き出す。
+各プロンプトは独立した1会話として扱い、会話履歴や要約は更新しない。
+
+入力の各行は次のいずれか
+    {"id": "1", "prompt": "質問"}
+    {"request_id": "user-001", "title": "タイトル", "body": "本文"}
+    JSONでない行はその行全体をプロンプトとする
+
+出力の各行
+    {"id": "1", "prompt": "質問", "answer": "回答", "latency": 1.234}
+    失敗したときはanswerがnullになりerrorに理由が入る
+
+# USAGE
+$ python chatme.py -c PRO --batch requests.jsonl --concurrency 8 > out.jsonl
+$ cat prompts.txt | python chatme.py --batch -
+"""
+import json
+import asyncio
+from time import perf_counter
+from typing import TextIO, Iterable
+from .ai import AI, Message, Role
+from .metrics import tracer
+
+# 同時に問い合わせる数
+CONCURRENCY = 4
+
+
+def parse_line(line: str, index: int) -> dict:
+    """入力の1行を{"id", "prompt"}にする
+    idもrequest_idも無ければ0から数えた行番号をidにする。
+    """
+    try:
+        item = json.loads(line)
+    except ValueError:
+        item = None
+    if not isinstance(item, dict):
+        return {"id": index, "prompt": line.rstrip("\n")}
+    prompt = item.get("prompt") or item.get("text")
+    if prompt is None:
+        prompt = "\n".join(
+            str(item[key]) for key in ("title", "body") if item.get(key))
+    return {
+        "id": item.get("id", item.get("request_id", index)),
+        "prompt": prompt
+    }
+
+
+def read_prompts(lines: Iterable[str]) -> list[dict]:
+    """空行を除いた各行をプロンプトにする"""
+    return [
+        parse_line(line, i) for i, line in enumerate(lines) if line.strip()
+    ]
+
+
+async def ask_one(ai: AI, item: dict, semaphore: asyncio.Semaphore) -> dict:
+    """1つのプロンプトを問い合わせ、回答と所要時間を返す"""
+    async with semaphore:
+        tracer.next_turn()
+        start = perf_counter()
+        result = {"id": item["id"], "prompt": item["prompt"]}
+        try:
+            result["answer"] = await ai.post(
+                [Message(str(Role.USER), item["prompt"])])
+        except Exception as err:  # pylint: disable=broad-except
+            result["answer"] = None
+            result["error"] = str(err)
+        result["latency"] = round(perf_counter() - start, 3)
+        return result
+
+
+async def run_batch(ai: AI,
+                    items: list[dict],
+                    out: TextIO,
+                    concurrency: int = CONCURRENCY):
+    """itemsを最大concurrency件ずつ並行に問い合わせ、入力順にoutへ書き出す
+    先頭から順に結果がそろい次第書き出すので、途中経過も読める。
+    concurrencyが1未満ならいつまでも問い合わせられないのでValueErrorを投げる。
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrencyは1以上にしてください: {concurrency}")
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.create_task(ask_one(ai, item, semaphore)) for item in items
+    ]
+    for task in tasks:
+        result = await task
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""常駐しているchatmeデーモンへ質問を送る軽量クライアント
+
+標準ライブラリだけを使うので、起動してすぐに質問を送れる。
+デーモンは `python3 chatme.py --daemon` で起動しておく。
+
+# USAGE
+$ echo "こんにちは" | python3 lib/chat_client.py -c PRO
+$ python3 lib/chat_client.py -c PRO question.txt
+
+# プロトコル
+クライアントは {"character": "キャラクタ名", "text": "質問"} を1行のJSONで送り、
+デーモンは回答をUTF-8のテキストで届いた順に返して接続を閉じる。
+"""
+import os
+import sys
+import json
+import socket
+import tempfile
+import argparse
+import codecs
+from typing import Optional
+
+# デーモンが待ち受けるUnixソケットのパス
+SOCKET_PATH = os.path.join(
+    os.getenv("XDG_RUNTIME_DIR", tempfile.gettempdir()),
+    "chat_my_assistant.sock")
+# 受信する単位(バイト)
+CHUNK_SIZE = 4096
+
+
+def send(text: str,
+         character: Optional[str] = None,
+         path: str = SOCKET_PATH,
+         out=sys.stdout):
+    """デーモンへ質問を送り、回答を届いた順にoutへ書き出す
+    デーモンが起動していなければConnectionErrorを投げる。
+    """
+    request = {"text": text}
+    if character:
+        request["character"] = character
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        while chunk := sock.recv(CHUNK_SIZE):
+            out.write(decoder.decode(chunk))
+            out.flush()
+    out.write(decoder.decode(b"", final=True) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="chatmeデーモンのクライアント")
+    parser.add_argument("--character",
+                        "-c",
+                        default=None,
+                        help="AIキャラクタ指定(default=デーモンの起動時の指定)")
+    parser.add_argument("--socket",
+                        default=SOCKET_PATH,
+                        help=f"デーモンのソケットのパス(default={SOCKET_PATH})")
+    parser.add_argument("file", nargs="?", help="質問を書いたファイル(default=標準入力)")
+    args = parser.parse_args()
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f:
+            question = f.read()
+    else:
+        question = sys.stdin.read()
+    try:
+        send(question, args.character, args.socket)
+    except (FileNotFoundError, ConnectionError):
+        print("chatmeデーモンに接続できません。"
+              "python3 chatme.py --daemon で起動してください。",
+              file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,106 @@
+"""トークン数の見積もりとコンテキストウィンドウの調整
+
+メッセージの件数ではなくトークン数の予算で会話履歴を切り詰める。
+tiktokenがインストールされていればそれで数え、
+無ければ文字種から見積もる(ASCIIは約4文字で1トークン、
+日本語などそれ以外は約1文字で1トークン)。
+tiktokenは初回にBPEのファイルをダウンロードするので、起動時ではなく
+最初に数えるときに読み込み、読み込めなければ見積もりを使う。
+
+# USAGE
+summary, messages = fit_context(system_role, chat_summary, messages, 3000)
+"""
+from typing import TypeVar
+
+# 1メッセージあたりのroleや区切りのトークン数
+MESSAGE_OVERHEAD = 4
+# system_roleが予算を使い切っても最新のメッセージに残すトークン数
+MIN_LATEST_TOKENS = 256
+# 既定のプロンプトのトークン予算
+CONTEXT_TOKENS = 3000
+
+M = TypeVar("M")  # contentを持つnamedtuple
+
+_encoding = None  # tiktokenのエンコーディング(False=使えない)
+
+
+def _get_encoding():
+    """tiktokenのエンコーディングを初めて使うときに読み込む
+    インストールされていないか、オフラインでBPEのファイルを
+    ダウンロードできなければFalse。
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:  # pylint: disable=broad-except
+            _encoding = False
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数"""
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (ascii_chars + 3) // 4 + len(text) - ascii_chars
+
+
+def message_tokens(content: str) -> int:
+    """メッセージひとつ分のトークン数"""
+    return estimate_tokens(content) + MESSAGE_OVERHEAD
+
+
+def truncate_head(text: str, tokens: int) -> str:
+    """先頭(古い側)を削ってtokens以内に収める"""
+    if tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= tokens:
+        return text
+    # 二分探索で残せる末尾の長さを探す
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[-mid:]) <= tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[len(text) - low:]
+
+
+def fit_context(system_role: str, chat_summary: str, messages: list[M],
+                budget: int) -> tuple[str, list[M]]:
+    """system_role + chat_summary + messages をbudgetトークン以内に収める
+    system_roleと最新のメッセージは必ず残し、足りなければ古い側から削る。
+        1. 最新のメッセージが収まらなければ、その先頭を削る。
+           system_roleが予算を使い切っていても、最新のメッセージには
+           MIN_LATEST_TOKENSまでは残す(予算を超えてもよい)
+        2. chat_summaryが収まらなければ、その先頭を削る
+        3. 残りの予算に新しいメッセージから順に詰め、入らない古いものは捨てる
+    return: (切り詰めたchat_summary, 残したメッセージのリスト)
+    """
+    available = budget - message_tokens(system_role)
+    if not messages:
+        return truncate_head(chat_summary, available - MESSAGE_OVERHEAD), []
+    *older, latest = messages
+    latest_tokens = message_tokens(latest.content)
+    room = max(available, MIN_LATEST_TOKENS + MESSAGE_OVERHEAD)
+    if latest_tokens > room:
+        content = truncate_head(latest.content, room - MESSAGE_OVERHEAD)
+        latest = latest._replace(content=content)
+        latest_tokens = message_tokens(content)
+    available -= latest_tokens
+    chat_summary = truncate_head(chat_summary, available - MESSAGE_OVERHEAD)
+    if chat_summary:
+        available -= message_tokens(chat_summary)
+    kept = [latest]
+    for message in reversed(older):
+        tokens = message_tokens(message.content)
+        if tokens > available:
+            break
+        available -= tokens
+        kept.append(message)
+    kept.reverse()
+    return chat_summary, kept
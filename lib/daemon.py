@@ -0,0 +1,124 @@
+"""Unixソケットで待ち受ける常駐チャットサーバー
+
+AIインスタンス、会話履歴、共有セッションのコネクションプール、
+gistから読み込んだ設定と記憶を保持したまま待ち受けるので、
+エディタから呼び出すたびにPythonを起動し直す必要がない。
+クライアントはlib/chat_client.pyを使う。
+
+# USAGE
+$ python3 chatme.py --daemon -c PRO
+$ echo "こんにちは" | python3 lib/chat_client.py
+"""
+import os
+import sys
+import json
+import socket
+import asyncio
+from typing import Optional
+from .ai import ai_constructor
+from .session import ChatSession
+from .chat_client import SOCKET_PATH
+from .voicevox_character import Mode
+
+
+def in_use(path: str) -> bool:
+    """pathのUnixソケットで他のデーモンが待ち受けているか"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:  # 前回のデーモンが残したソケット
+            return False
+    return True
+
+
+class ChatDaemon:
+    """キャラクタごとのAIと会話履歴を保持して質問に答える"""
+    def __init__(self,
+                 character: str = "ChatGPT",
+                 voice: Mode = Mode.NONE,
+                 speaker=None,
+                 character_file: Optional[str] = None,
+                 offline: bool = False):
+        self.character = character  # キャラクタ指定がない質問に答えるAI
+        self.voice = voice
+        self.speaker = speaker
+        self.character_file = character_file
+        self.offline = offline
+        self.sessions: dict[str, ChatSession] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    async def get_session(self, name: str) -> ChatSession:
+        """キャラクタとの会話を返す。初めてのキャラクタなら読み込む
+        gistの取得は同期処理なので別スレッドで行う。
+        """
+        if name not in self.sessions:
+            ai = await asyncio.to_thread(ai_constructor,
+                                         name=name,
+                                         voice=self.voice,
+                                         speaker=self.speaker,
+                                         character_file=self.character_file,
+                                         offline=self.offline)
+            self.sessions[name] = ChatSession(ai)
+        return self.sessions[name]
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        """1行のJSONで質問を受け取り、回答を届いた順に返す
+        同じキャラクタへの質問は会話履歴を共有するので1つずつ答える。
+        """
+        try:
+            line = await reader.readline()
+            if not line.strip():  # 他のデーモンからの生存確認
+                return
+            request = json.loads(line)
+            name = request.get("character") or self.character
+            async with self.locks.setdefault(name, asyncio.Lock()):
+                session = await self.get_session(name)
+                speech = session.speech()
+
+                def on_delta(delta: str):
+                    writer.write(delta.encode("utf-8"))
+                    if speech is not None:
+                        speech.feed(delta)
+
+                try:
+                    await session.send(request["text"], on_delta)
+                finally:
+                    if speech is not None:
+                        speech.close()
+                await writer.drain()
+                if speech is not None:
+                    await speech.wait()
+        except Exception as err:  # pylint: disable=broad-except
+            writer.write(f"Error: {err}".encode("utf-8"))
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def serve(self, path: str = SOCKET_PATH):
+        """pathのUnixソケットで待ち受ける
+        他のデーモンが待ち受けていればRuntimeErrorを投げる。
+        ソケットは作った瞬間から本人しか接続できない権限にする。
+        終了時は要約待ちの会話を要約して長期記憶へ書き込む。
+        """
+        if os.path.exists(path):
+            if in_use(path):
+                raise RuntimeError(f"{path}で他のデーモンが待ち受けています。")
+            os.remove(path)
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path)
+        finally:
+            os.umask(umask)
+        # 最初の質問までにキャラクタの読み込みとAPIサーバーへの接続を済ませる
+        session = await self.get_session(self.character)
+        await session.ai.warmup()
+        print(f"chatme daemon: {path}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for session in self.sessions.values():
+                await session.close()
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""OpenAI, GitHub Gist, VOICEVOXの代わりに使うローカルのフェイクサーバー
+
+本物のAPIと同じ形のレスポンスを返すので、APIキーやネットワークが無い環境でも
+会話→要約→gist保存→音声合成の一連の動作確認や計測ができる。
+どのサーバーも応答の遅延(latency)とエラーの割合(error_rate)を指定できる。
+
+- openai_app: /v1/chat/completions (stream=trueならSSE)
+- gist_app: /gists/{id} のGET(ETag, If-None-Match対応)とPATCH
+- tts_app: WEB版VOICEVOX API 低速(/v1/voicevox/)と高速(/v2/voicevox/audio)
+- voicevox_app: VOICEVOXエンジン(/audio_query, /synthesis, /multi_synthesis)
+
+音声はテキストの長さに比例した無音のwavを返す。
+
+# USAGE
+$ python -m lib.fake_server openai --port 8000 --latency 0.3
+$ CHATGPT_ENDPOINT=http://localhost:8000/v1/chat/completions python chatme.py
+
+# テストや計測のコードから起動する場合
+runner = await start(openai_app(latency=0.3, chunk_interval=0.02))
+os.environ["CHATGPT_ENDPOINT"] = url_of(runner) + "/v1/chat/completions"
+...
+await runner.cleanup()
+"""
+import io
+import json
+import wave
+import random
+import asyncio
+import hashlib
+import argparse
+import zipfile
+from time import monotonic
+from typing import Optional
+from aiohttp import web
+
+# フェイクの音声のサンプリングレート
+SAMPLE_RATE = 24000
+# 1文字あたりの音声の長さ(秒)
+SECONDS_PER_CHAR = 0.1
+# フェイクのChatGPTの回答
+ANSWER = "こんにちは。今日はいい天気ですね。何かお手伝いできることはありますか？"
+# フェイクのSummarizerの要約
+SUMMARY = "- user: 挨拶をした\n- assistant: 挨拶を返し、用件を尋ねた"
+
+
+def silent_wav(text: str) -> bytes:
+    """テキストの長さに比例した無音のwavを作る"""
+    frames = int(SAMPLE_RATE * SECONDS_PER_CHAR * max(len(text), 1))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\0\0" * frames)
+    return buffer.getvalue()
+
+
+def faulty(latency: float = 0.0,
+           error_rate: float = 0.0,
+           error_status: int = 500,
+           tail_rate: float = 0.0,
+           tail_latency: float = 0.0):
+    """応答を遅らせ、error_rateの割合でerror_statusを返すミドルウェア
+    429のときはRetry-Afterを付ける。
+    tail_rateの割合の応答はlatencyの代わりにtail_latencyだけ遅らせる。
+    """
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        slow = random.random() < tail_rate
+        await asyncio.sleep(tail_latency if slow else latency)
+        if random.random() < error_rate:
+            headers = {"Retry-After": "1"} if error_status == 429 else {}
+            return web.json_response({"error": {"message": "injected"}},
+                                     status=error_status,
+                                     headers=headers)
+        try:
+            return await handler(request)
+        except ConnectionResetError:  # クライアントが応答を待たずに切断した
+            return web.Response(status=499)
+
+    return middleware
+
+
+def openai_app(latency: float = 0.0,
+               error_rate: float = 0.0,
+               error_status: int = 429,
+               chunk_interval: float = 0.0,
+               answer: str = ANSWER,
+               summary: str = SUMMARY,
+               tail_rate: float = 0.0,
+               tail_latency: float = 0.0) -> web.Application:
+    """ChatGPT APIの/v1/chat/completions
+    Summarizerのリクエストにはsummaryを、それ以外にはanswerを返す。
+    latency: 最初のバイトまでの遅延(秒)
+    tail_rate, tail_latency: tail_rateの割合の応答だけ遅延をtail_latencyにする
+    chunk_interval: ストリーミングで1文字ずつ送る間隔(秒)
+    """
+    async def completions(request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        system = data["messages"][0]["content"]
+        content = summary if "要約" in system and \
+            data.get("temperature") == 0 else answer
+        prompt_tokens = sum(len(m["content"]) for m in data["messages"])
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content),
+            "total_tokens": prompt_tokens + len(content),
+        }
+        if not data.get("stream"):
+            return web.json_response({
+                "object": "chat.completion",
+                "model": data["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": content
+                    },
+                    "finish_reason": "stop"
+                }],
+                "usage": usage,
+            })
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(chunk: dict):
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        try:
+            for char in content:
+                await send({
+                    "object": "chat.completion.chunk",
+                    "choices": [{
+                        "index": 0,
+                        "delta": {
+                            "content": char
+                        },
+                        "finish_reason": None
+                    }]
+                })
+                await asyncio.sleep(chunk_interval)
+            if data.get("stream_options", {}).get("include_usage"):
+                await send({"choices": [], "usage": usage})
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:  # クライアントが途中で受信をやめた
+            pass
+        return response
+
+    app = web.Application(
+        middlewares=[
+            faulty(latency, error_rate, error_status, tail_rate, tail_latency)
+        ])
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+
+def gist_app(files: Optional[dict] = None,
+             latency: float = 0.0,
+             error_rate: float = 0.0,
+             on_patch=None) -> web.Application:
+    """GitHub Gist APIの/gists/{id}
+    files: {ファイル名: 内容} の初期値
+    on_patch: PATCHを受け取るたびに(ファイル名, 内容)で呼び出す関数
+    """
+    store = dict(files or {})
+
+    def document(gist_id: str) -> dict:
+        return {
+            "id": gist_id,
+            "files": {
+                name: {
+                    "filename": name,
+                    "content": content,
+                    "truncated": False
+                }
+                for name, content in store.items()
+            }
+        }
+
+    def etag() -> str:
+        digest = hashlib.sha1(json.dumps(store, sort_keys=True).encode())
+        return f'"{digest.hexdigest()}"'
+
+    async def get(request: web.Request) -> web.Response:
+        tag = etag()
+        if request.headers.get("If-None-Match") == tag:
+            return web.Response(status=304, headers={"ETag": tag})
+        return web.json_response(document(request.match_info["id"]),
+                                 headers={"ETag": tag})
+
+    async def patch(request: web.Request) -> web.Response:
+        data = await request.json()
+        for name, file in data["files"].items():
+            store[name] = file["content"]
+            if on_patch is not None:
+                on_patch(name, file["content"])
+        return web.json_response(document(request.match_info["id"]),
+                                 headers={"ETag": etag()})
+
+    app = web.Application(middlewares=[faulty(latency, error_rate)])
+    app.router.add_get("/gists/{id}", get)
+    app.router.add_patch("/gists/{id}", patch)
+    return app
+
+
+def tts_app(latency: float = 0.0,
+            error_rate: float = 0.0,
+            ready_after: float = 0.5) -> web.Application:
+    """WEB版VOICEVOX APIの低速版(tts.quest)と高速版(su-shiki)
+    低速版はready_after秒後にaudioStatusUrlがisAudioReadyになる。
+    """
+    jobs: dict[str, tuple[float, str]] = {}  # id: (準備ができる時刻, テキスト)
+
+    async def slow(request: web.Request) -> web.Response:
+        text = request.query["text"]
+        job = hashlib.sha1(f"{len(jobs)}{text}".encode()).hexdigest()
+        jobs[job] = (monotonic() + ready_after, text)
+        origin = f"{request.scheme}://{request.host}/v1"
+        return web.json_response({
+            "success": True,
+            "isApiKeyValid": False,
+            "speakerName": request.query.get("speaker", "0"),
+            "audioStatusUrl": f"{origin}/status/{job}",
+            "wavDownloadUrl": f"{origin}/audio/{job}.wav",
+        })
+
+    async def status(request: web.Request) -> web.Response:
+        ready_at, _ = jobs[request.match_info["job"]]
+        ready = monotonic() >= ready_at
+        return web.json_response({
+            "success": True,
+            "isAudioReady": ready,
+            "isAudioError": False,
+            "status": "success" if ready else "generating",
+        })
+
+    async def download(request: web.Request) -> web.Response:
+        ready_at, text = jobs[request.match_info["job"]]
+        if monotonic() < ready_at:
+            return web.Response(status=404)
+        return web.Response(body=silent_wav(text), content_type="audio/wav")
+
+    async def fast(request: web.Request) -> web.Response:
+        return web.Response(body=silent_wav(request.query["text"]),
+                            content_type="audio/wav")
+
+    app = web.Application(middlewares=[faulty(latency, error_rate)])
+    app.router.add_get("/v1/voicevox", slow)
+    app.router.add_get("/v1/voicevox/", slow)
+    app.router.add_get("/v1/status/{job}", status)
+    app.router.add_get("/v1/audio/{job}.wav", download)
+    app.router.add_get("/v2/voicevox/audio", fast)
+    app.router.add_get("/v2/voicevox/audio/", fast)
+    return app
+
+
+def voicevox_app(latency: float = 0.0,
+                 error_rate: float = 0.0) -> web.Application:
+    """VOICEVOXエンジンの/audio_query, /synthesis, /multi_synthesis
+    latency: 各リクエストの応答を遅らせる秒数
+    """
+    async def audio_query(request: web.Request) -> web.Response:
+        text = request.query["text"]
+        return web.json_response({
+            "accent_phrases": [],
+            "speedScale": 1.0,
+            "pitchScale": 0.0,
+            "intonationScale": 1.0,
+            "volumeScale": 1.0,
+            "prePhonemeLength": 0.1,
+            "postPhonemeLength": 0.1,
+            "outputSamplingRate": SAMPLE_RATE,
+            "outputStereo": False,
+            "kana": text,
+        })
+
+    async def synthesis(request: web.Request) -> web.Response:
+        query = await request.json()
+        return web.Response(body=silent_wav(query["kana"]),
+                            content_type="audio/wav")
+
+    async def multi_synthesis(request: web.Request) -> web.Response:
+        queries = await request.json()
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for i, query in enumerate(queries, 1):
+                archive.writestr(f"{i:03}.wav", silent_wav(query["kana"]))
+        return web.Response(body=buffer.getvalue(),
+                            content_type="application/zip")
+
+    app = web.Application(middlewares=[faulty(latency, error_rate)])
+    app.router.add_post("/audio_query", audio_query)
+    app.router.add_post("/synthesis", synthesis)
+    app.router.add_post("/multi_synthesis", multi_synthesis)
+    return app
+
+
+async def start(app: web.Application,
+                host: str = "127.0.0.1",
+                port: int = 0) -> web.AppRunner:
+    """appをバックグラウンドで起動する
+    port=0なら空いているポートを使う。実際のURLはurl_of(runner)で得る。
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def url_of(runner: web.AppRunner) -> str:
+    """起動したサーバーのURL"""
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="フェイクサーバー")
+    parser.add_argument("service",
+                        choices=["openai", "gist", "tts", "voicevox"],
+                        help="起動するサービス")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50021)
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.0,
+                        help="応答を遅らせる秒数")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        default=0.0,
+                        help="エラーを返す割合(0から1)")
+    args = parser.parse_args()
+    apps = {
+        "openai": openai_app,
+        "gist": gist_app,
+        "tts": tts_app,
+        "voicevox": voicevox_app,
+    }
+    web.run_app(apps[args.service](latency=args.latency,
+                                   error_rate=args.error_rate),
+                host=args.host,
+                port=args.port)
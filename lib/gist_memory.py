@@ -8,18 +8,43 @@ print(content)
 
 content = gist.patch("明日も晴れ")
 print(content)
+
+# 非同期に間引いて保存
+writer = DebouncedWriter(gist, delay=5)
+writer.write("明日も晴れ")
+writer.write("明後日は雨")  # 5秒以内の書き込みは最後の1回にまとめられる
+await writer.flush()  # 終了時は待ち時間を待たずに書き込む
+
+# gist全体はプロセスごとに1回だけ取得し、ETag付きでディスクにキャッシュする。
+# Gist.offline = True(または環境変数CHATME_OFFLINE=1)ならネットワークに
+# アクセスしない。キャッシュが無ければファイルの無い空のgistとして扱い、
+# 書き込みはgistへ送らない。
 """
 import os
+import sys
 import json
+import asyncio
+from typing import Optional
 import requests
 
+# 書き込みをまとめる待ち時間(秒)
+WRITE_DELAY = 5.0
+# gistのキャッシュを置くディレクトリ
+CACHE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "chat_my_assistant")
+
 
 class Gist:
     """gist API handler"""
-    _root = "https://api.github.com/gists/"
+    _root = os.getenv("GIST_API_ROOT", "https://api.github.com/gists/")
     _id = os.getenv("GIST_ID")
-    url = _root + _id
     __token = os.getenv("GITHUB_TOKEN")
+    # ネットワークにアクセスせずキャッシュだけを使う
+    offline = os.getenv("CHATME_OFFLINE", "") not in ("", "0")
+    _document: Optional[dict] = None  # このプロセスで取得済みのgist全体
+    # 取得したgistがディスクのキャッシュと違ったか(他で更新されていたか)
+    modified = False
 
     def __init__(self, filename):
         """指定したgist ファイルに対するAPI操作"""
@@ -27,19 +52,179 @@ class Gist:
 
     def get(self):
         """会話履歴を取得"""
-        resp = requests.get(Gist.url)
-        if resp.status_code != 200:
-            raise requests.HTTPError(f"{resp.json()}")
-        content = resp.json()["files"][self.filename]["content"]
+        content = Gist.fetch()["files"][self.filename]["content"]
         return content
 
-    def patch(self, body):
-        """会話履歴を保存"""
-        headers = {
+    @classmethod
+    def url(cls) -> str:
+        """gist APIのURL
+        GIST_IDが無くてもimportできるように、使うときに組み立てる。
+        """
+        if not cls._id:
+            raise ValueError("環境変数GIST_IDが設定されていません。")
+        return cls._root + cls._id
+
+    @classmethod
+    def fetch(cls) -> dict:
+        """gist全体を取得
+        gistの全ファイルを1回のGETで取得し、プロセス内で使い回す。
+        ディスクのキャッシュがあればIf-None-Matchで条件付きGETを行い、
+        304 Not Modifiedならキャッシュを使う。
+        offlineのときやネットワークに繋がらないときはキャッシュをそのまま使う。
+        offlineでキャッシュも無ければファイルの無い空のgistとして扱う。
+        """
+        if cls._document is not None:
+            return cls._document
+        cache = cls._load_cache()
+        if cls.offline:
+            cls._document = {"files": {}} if cache is None \
+                else cache["document"]
+            return cls._document
+        headers = {"Accept": "application/vnd.github+json"}
+        if cls.__token:
+            headers["Authorization"] = f"token {cls.__token}"
+        if cache is not None:
+            headers["If-None-Match"] = cache["etag"]
+        try:
+            resp = requests.get(cls.url(), headers=headers)
+        except requests.ConnectionError:
+            if cache is None:
+                raise
+            print("Warning: gistに接続できないためキャッシュを使います。",
+                  file=sys.stderr)
+            cls._document = cache["document"]
+            return cls._document
+        if resp.status_code == 304:
+            cls._document = cache["document"]
+        elif resp.status_code == 200:
+            cls.modified = cache is None or \
+                resp.headers.get("ETag") != cache["etag"]
+            cls._store(resp.headers.get("ETag"), resp.json())
+        else:
+            raise requests.HTTPError(f"{resp.json()}")
+        return cls._document
+
+    @classmethod
+    def _cache_path(cls) -> str:
+        return os.path.join(CACHE_DIR, f"gist-{cls._id}.json")
+
+    @classmethod
+    def _load_cache(cls) -> Optional[dict]:
+        """ディスクのキャッシュを読む。無いか壊れていればNone"""
+        try:
+            with open(cls._cache_path(), "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not cache.get("etag") or "document" not in cache:
+            return None
+        return cache
+
+    @classmethod
+    def _store(cls, etag: Optional[str], document: dict):
+        """取得したgist全体をプロセス内とディスクにキャッシュする
+        書きかけのファイルを読まないように一時ファイルから置き換える。
+        """
+        cls._document = document
+        if not etag:
+            return
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = cls._cache_path()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"etag": etag, "document": document},
+                      f,
+                      ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _headers():
+        return {
             "Accept": "application/vnd.github+json",
             "Authorization": f"token {Gist.__token}"
         }
+
+    def patch(self, body):
+        """会話履歴を保存
+        PATCHのレスポンスはgist全体なのでキャッシュも更新する。
+        offlineのときはネットワークにアクセスせず、保存しない。
+        """
+        if Gist.offline:
+            return body
         data = {"files": {self.filename: {"content": body}}}
-        resp = requests.patch(Gist.url, headers=headers,
-                              data=json.dumps(data)).json()
-        return resp["files"][self.filename]["content"]
+        resp = requests.patch(Gist.url(),
+                              headers=Gist._headers(),
+                              data=json.dumps(data))
+        resp_json = resp.json()
+        Gist._store(resp.headers.get("ETag"), resp_json)
+        return resp_json["files"][self.filename]["content"]
+
+    async def apatch(self, body):
+        """会話履歴を非同期に保存
+        共有セッションを使うのでイベントループを止めない。
+        offlineのときはネットワークにアクセスせず、保存しない。
+        """
+        if Gist.offline:
+            return body
+        from .http_session import get_session
+        from .metrics import tracer
+        data = {"files": {self.filename: {"content": body}}}
+        with tracer.span("gist.patch", filename=self.filename):
+            async with get_session().patch(Gist.url(),
+                                           headers=Gist._headers(),
+                                           data=json.dumps(data)) as resp:
+                resp.raise_for_status()
+                resp_json = await resp.json()
+        Gist._store(resp.headers.get("ETag"), resp_json)
+        return resp_json["files"][self.filename]["content"]
+
+
+class DebouncedWriter:
+    """Gistへの書き込みを間引く
+    write()されてからdelay秒間次の書き込みがなければ、
+    最後に渡された内容だけを1回のPATCHで保存する。
+    """
+    def __init__(self, gist: Gist, delay: float = WRITE_DELAY):
+        self.gist = gist
+        self.delay = delay
+        self._body: Optional[str] = None  # まだ保存していない最新の内容
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> bool:
+        """保存待ちの内容があるか"""
+        return self._body is not None
+
+    def write(self, body: str):
+        """内容を保存待ちにして、待ち時間を数え直す"""
+        self._body = body
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(self.delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        self._task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """保存待ちの内容をすぐに書き込む
+        書き込み中にwrite()された内容は次のflushで書き込まれる。
+        失敗したときは警告を出し、より新しい内容がなければ保存待ちに戻す。
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            body, self._body = self._body, None
+            if body is None:
+                return
+            try:
+                await self.gist.apatch(body)
+            except Exception as err:  # pylint: disable=broad-except
+                print(f"Warning: {self.gist.filename}の保存に失敗しました。{err}",
+                      file=sys.stderr)
+                if self._body is None:
+                    self._body = body
@@ -0,0 +1,185 @@
+"""遅い問い合わせを別の経路へも送るヘッジ
+
+キャラクタごとにChatGPT APIのエンドポイントとモデルの組(経路)を複数並べ、
+先頭の経路へ問い合わせる。最初の差分がその経路のこれまでの応答時間の
+中央値のFACTOR倍(HEDGE_AFTER秒まで)を過ぎても届かなければ、次の経路へも
+同じ質問を送り、先に最初の差分が届いたほうを使って他方は取り消す。
+高い分位を待ち時間にすると、遅い応答が数%を超えたときにその遅さ自体が
+待ち時間になってヘッジが間に合わない。中央値を基にすれば遅い応答が
+1〜2割あってもヘッジが効き、速い応答の大半はヘッジしないので
+費用はあまり増えずに回答の待ち時間の裾(p95, p99)が短くなる。レート制限で待たされているときは
+ヘッジがさらに制限を圧迫するので送らない。
+エラーで失敗した経路があれば、待たずに次の経路へ送る。
+
+# USAGE
+routes = parse_routes([{"model": "gpt-4o-mini"},
+                       {"endpoint": url, "model": "gpt-4o-mini",
+                        "api_key_env": "BACKUP_API_KEY"}], default)
+async for route, delta in hedged(routes, complete):
+    print(delta, end="")
+"""
+import os
+import sys
+import asyncio
+import statistics
+from collections import deque, namedtuple
+from time import perf_counter
+from typing import AsyncIterator, Callable, Hashable, Optional, TypeVar
+from .metrics import tracer
+
+# ヘッジを送るまでの待ち時間の上限(秒)。応答時間の記録が少ないうちはこれを使う
+HEDGE_AFTER = 3.0
+# ヘッジを送るまでの待ち時間の下限(秒)。速い回答まではヘッジしない
+MIN_HEDGE_AFTER = 0.5
+# ヘッジを送るまでの待ち時間は応答時間の中央値の何倍か
+FACTOR = 2.0
+# 中央値を求めるのに使う直近の応答時間の数
+WINDOW = 200
+# 中央値を使い始める応答時間の数
+MIN_SAMPLES = 20
+# 問い合わせの経路。api_keyはAuthorizationヘッダーに使う
+Route = namedtuple("Route", ["endpoint", "model", "api_key"])
+
+T = TypeVar("T")
+
+
+def parse_routes(config: Optional[list], default: Route) -> list[Route]:
+    """キャラクタ設定のendpointsから経路のリストを作る
+    各項目はモデル名の文字列か、endpoint, model, api_key_env(APIキーを
+    読む環境変数)を持つ辞書。省略した値はdefaultの値を使う。
+    api_key_envの環境変数が無い経路は警告を出して使わない。
+    """
+    if not config:
+        return [default]
+    routes = []
+    for item in config:
+        if isinstance(item, str):
+            item = {"model": item}
+        api_key = default.api_key
+        if item.get("api_key_env"):
+            api_key = os.getenv(item["api_key_env"])
+            if api_key is None:
+                print(f"Warning: 環境変数{item['api_key_env']}が無いので"
+                      f"{item.get('endpoint', default.endpoint)}を使いません。",
+                      file=sys.stderr)
+                continue
+        routes.append(
+            Route(item.get("endpoint", default.endpoint),
+                  item.get("model", default.model), api_key))
+    return routes or [default]
+
+
+class LatencyTracker:
+    """経路ごとの最初の差分までの時間を直近WINDOW件だけ記録する"""
+    def __init__(self,
+                 window: int = WINDOW,
+                 factor: float = FACTOR,
+                 default: float = HEDGE_AFTER):
+        self.window = window
+        self.factor = factor
+        self.default = default
+        self.samples: dict[Hashable, deque] = {}
+
+    def add(self, key: Hashable, seconds: float):
+        """keyの経路の応答時間を記録する"""
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+        self.samples[key].append(seconds)
+
+    def threshold(self, key: Hashable) -> float:
+        """keyの経路へ送ってからヘッジを送るまでの待ち時間(秒)
+        応答時間の中央値のfactor倍を、MIN_HEDGE_AFTERからdefaultまでに収める。
+        記録がMIN_SAMPLES件に満たなければdefaultを返す。
+        """
+        samples = self.samples.get(key)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return self.default
+        median = statistics.median(samples)
+        return min(self.default, max(MIN_HEDGE_AFTER, median * self.factor))
+
+
+# プロセス全体で共有する応答時間の記録
+latency = LatencyTracker()
+
+
+async def hedged(routes: list[Route],
+                 start: Callable[[Route], AsyncIterator[T]],
+                 tag: Hashable = "",
+                 after: Optional[float] = None,
+                 ready: Callable[[], bool] = lambda: True,
+                 tracker: LatencyTracker = latency
+                 ) -> AsyncIterator[tuple[Route, T]]:
+    """routesの先頭から順にstart(route)の問い合わせを始め、
+    最初に要素を返した経路の要素を(経路, 要素)として順に返す
+    最初の要素が待ち時間を過ぎても届かないか、エラーで失敗したら
+    次の経路も始める。勝った経路が決まったら他の問い合わせは取り消す。
+    after: ヘッジを送るまでの待ち時間(秒, None=経路ごとの応答時間の中央値から)
+    tag: 応答時間を記録するときに経路と組にする値(ストリーミングの有無など)
+    ready: ヘッジを送ってよいか。偽なら待ち時間を過ぎても送らずに待ち続ける
+    すべての経路が失敗したら最後の例外を投げる。
+    """
+    pending: dict[asyncio.Task, tuple[Route, AsyncIterator[T], float]] = {}
+
+    def launch(route: Route):
+        iterator = start(route)
+        task = asyncio.ensure_future(iterator.__anext__())
+        pending[task] = (route, iterator, perf_counter())
+
+    async def cancel(task: asyncio.Task):
+        route, iterator, began = pending.pop(task)
+        task.cancel()
+        await asyncio.wait({task})
+        # 取り消すまで届かなかったので、少なくともこれだけ遅かった
+        tracker.add((route, tag), perf_counter() - began)
+        await iterator.aclose()
+
+    launched = 1
+    launch(routes[0])
+    winner = None
+    error: Optional[BaseException] = None
+    try:
+        while winner is None:
+            timeout = None
+            if launched < len(routes):
+                latest = routes[launched - 1]
+                timeout = tracker.threshold((latest, tag)) \
+                    if after is None else after
+            done, _ = await asyncio.wait(pending,
+                                         timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:  # 遅いので次の経路へも送る
+                if not ready():
+                    continue
+                tracer.record("hedge", perf_counter() - timeout,
+                              model=routes[launched].model)
+                launch(routes[launched])
+                launched += 1
+                continue
+            for task in done:
+                route, iterator, began = pending.pop(task)
+                if task.exception() is None or \
+                        isinstance(task.exception(), StopAsyncIteration):
+                    if winner is None:
+                        tracker.add((route, tag), perf_counter() - began)
+                        winner = (route, iterator, task)
+                    else:
+                        await iterator.aclose()
+                    continue
+                error = task.exception()
+            if winner is None and not pending:
+                if launched == len(routes):
+                    raise error
+                launch(routes[launched])  # 失敗したので待たずに次の経路へ
+                launched += 1
+    finally:
+        for task in list(pending):
+            await cancel(task)
+    route, iterator, task = winner
+    if isinstance(task.exception(), StopAsyncIteration):
+        return
+    try:
+        yield route, task.result()
+        async for item in iterator:
+            yield route, item
+    finally:
+        await iterator.aclose()
@@ -0,0 +1,82 @@
+"""プロセス全体で共有するaiohttpのセッション
+
+AI.postとSummarizer.postが同じコネクションプールを使い回すことで、
+リクエストごとのDNS解決、TCP接続、TLSハンドシェイクを省く。
+
+# USAGE
+session = get_session()
+async with session.post(url, data=data) as response:
+    ...
+await close_session()  # 終了時に一度だけ呼ぶ
+"""
+import asyncio
+from typing import Optional, TYPE_CHECKING
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    import aiohttp
+
+# 同時接続数の上限
+LIMIT = 16
+# 同一ホストへの同時接続数の上限
+LIMIT_PER_HOST = 8
+# 使っていない接続を保持する時間(秒)
+KEEPALIVE_TIMEOUT = 60
+# DNSキャッシュの保持時間(秒)
+DNS_TTL = 300
+
+_session: Optional["aiohttp.ClientSession"] = None
+_limits = (LIMIT, LIMIT_PER_HOST)
+
+
+def set_limits(limit: int = LIMIT, limit_per_host: int = LIMIT_PER_HOST):
+    """同時接続数の上限を変える
+    多くの会話を同時に受け持つサーバーでは、同時に流せる回答の数になる。
+    次に作る共有セッションから使われるので、get_session()より前に呼ぶ。
+    """
+    global _limits
+    _limits = (limit, limit_per_host)
+
+
+def get_session() -> "aiohttp.ClientSession":
+    """共有セッションを返す
+    まだ無いか閉じられていたら、実行中のイベントループ上に作り直す。
+    aiohttpは読み込みに時間がかかるので、初めて使うときにimportする。
+    """
+    global _session
+    import aiohttp
+    if _session is None or _session.closed:
+        limit, limit_per_host = _limits
+        connector = aiohttp.TCPConnector(limit=limit,
+                                         limit_per_host=limit_per_host,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                         ttl_dns_cache=DNS_TTL)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def warmup(url: str):
+    """urlのホストへ先に接続してコネクションプールに入れておく
+    ユーザーの入力待ちの間に呼び出すと、最初のリクエストで
+    DNS、TCP、TLSの待ち時間がかからない。
+    接続できなくても本番のリクエストで再試行されるので例外は握りつぶす。
+    最初にイベントループへ処理を返し、入力プロンプトを先に表示させてから
+    aiohttpの読み込みと接続を行う。
+    """
+    await asyncio.sleep(0)
+    import aiohttp
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}/"
+    try:
+        async with get_session().head(origin) as response:
+            await response.release()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+
+
+async def close_session():
+    """共有セッションを閉じる"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
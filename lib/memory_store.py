@@ -0,0 +1,258 @@
+"""検索で思い出す長期記憶
+
+過去の要約と会話のやり取りをキャラクタのfilenameごとにJSON Linesへ貯めて、
+文字n-gramのBM25で索引を作る。質問ごとに関係の深い記憶だけをトークン予算の中で
+プロンプトに入れるので、要約の全文を毎回送るよりプロンプトが短くて済む。
+
+日本語は単語の区切りが無いので、ASCII以外の文字の並びは2文字ずつのn-gramと
+1文字の漢字やカタカナ(「猫」「山」のような1文字の単語のため)、
+英数字の並びは単語ひとつを索引の語にする。
+
+ファイルへは追記だけを行い、検索の前に他のプロセス(常駐モードなど)が
+追記した分を読み込む。記憶がmax_recordsの1.25倍を超えたら、古い会話の
+やり取りから(要約に含まれているので)捨ててmax_records件に詰め直すので、
+起動時間とメモリ使用量は会話を続けても増え続けない。
+
+# USAGE
+memory = MemoryStore.open("chatgpt-assistant.txt", seed=chat_summary)
+memory.add("- user: 猫を飼い始めた", kind="summary")
+print(memory.recall("猫の名前は？", k=8, budget=800))
+"""
+import os
+import re
+import json
+import math
+import time
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from .context import estimate_tokens, MESSAGE_OVERHEAD
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間で排他しない
+    fcntl = None
+
+# 記憶を置くディレクトリ
+DATA_DIR = os.path.join(
+    os.getenv("XDG_DATA_HOME", os.path.expanduser("~/.local/share")),
+    "chat_my_assistant", "memory")
+# 1回の質問で思い出す記憶の数の上限
+MEMORY_TOP_K = 8
+# 思い出した記憶に使うトークン数の予算
+MEMORY_TOKENS = 800
+# キャラクタひとりぶんの記憶の数の上限
+MAX_RECORDS = int(os.getenv("CHATME_MEMORY_RECORDS", "2000"))
+# 捨てるときに会話のやり取りより後回しにする記憶の種類
+KEEP_KINDS = ("summary", "digest")
+# 文字n-gramのn
+NGRAM = 2
+# BM25のパラメータ
+K1 = 1.5
+B = 0.75
+# 英数字の並びと、それ以外の文字(日本語など)の並び
+RUN = re.compile(r"[0-9a-z]+|[^\W0-9a-z_]+")
+# 1文字でも索引の語にしない文字(ひらがな)
+KANA = re.compile(r"[\u3040-\u309f]")
+
+
+def tokenize(text: str) -> list[str]:
+    """テキストを索引の語に分ける
+    全角半角の揺れをNFKCでそろえ、英数字は単語、それ以外はn-gramと
+    ひらがな以外の1文字にする。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in RUN.findall(text):
+        if run.isascii():
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + NGRAM]
+                          for i in range(len(run) - NGRAM + 1))
+            tokens.extend(char for char in run if not KANA.match(char))
+    return tokens
+
+
+class BM25Index:
+    """文書番号で引くBM25の転置索引"""
+    def __init__(self):
+        self.postings: dict[str, dict[int, int]] = {}  # 語: {文書番号: 出現数}
+        self.lengths: dict[int, int] = {}  # 文書番号: 語数
+        self.total = 0  # 全文書の語数の合計
+
+    def add(self, doc: int, text: str):
+        """文書を索引に加える"""
+        terms = Counter(tokenize(text))
+        self.lengths[doc] = sum(terms.values())
+        self.total += self.lengths[doc]
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[doc] = count
+
+    def search(self, query: str, k: int) -> list[tuple[float, int]]:
+        """queryとの関連度が高い順に(スコア, 文書番号)をk件返す"""
+        if not self.lengths:
+            return []
+        n = len(self.lengths)
+        average = self.total / n or 1
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, count in docs.items():
+                norm = K1 * (1 - B + B * self.lengths[doc] / average)
+                scores[doc] = scores.get(doc, 0.0) + \
+                    idf * count * (K1 + 1) / (count + norm)
+        ranked = sorted(((s, d) for d, s in scores.items()), reverse=True)
+        return ranked[:k]
+
+
+class MemoryStore:
+    """キャラクタひとりぶんの検索できる長期記憶"""
+    def __init__(self, path: str, max_records: int = MAX_RECORDS):
+        self.path = path
+        self.max_records = max_records
+        self.records: list[dict] = []  # 文書番号順の記憶
+        self.index = BM25Index()
+        self._seen: set[str] = set()  # 同じ記憶を二重に貯めない
+        self._offset = 0  # 読み込み済みのファイルの位置
+        self._inode: Optional[int] = None  # 読み込み中のファイル
+
+    @classmethod
+    def open(cls,
+             filename: str,
+             seed: str = "",
+             directory: str = DATA_DIR,
+             max_records: int = MAX_RECORDS) -> "MemoryStore":
+        """filenameの記憶を開く
+        まだ記憶が無ければ、これまでの要約seedを1行ずつ記憶として取り込む。
+        """
+        store = cls(os.path.join(directory, filename + ".jsonl"), max_records)
+        store._sync()
+        if not store.records and seed:
+            for line in seed.splitlines():
+                store.add(line, kind="summary")
+        return store
+
+    @property
+    def texts(self) -> list[str]:
+        """文書番号順の記憶の本文"""
+        return [record["text"] for record in self.records]
+
+    def _reset(self):
+        self.records = []
+        self.index = BM25Index()
+        self._seen = set()
+        self._offset = 0
+
+    def _sync(self):
+        """他のプロセスが追記した記憶を読み込む
+        他のプロセスがファイルを詰め直していたら、最初から読み直す。
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._inode:
+                    self._reset()
+                    self._inode = inode
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith("\n"):  # 書き込み途中
+                        break
+                    self._offset += len(line.encode("utf-8"))
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._index(record)
+        except FileNotFoundError:
+            pass
+
+    def _index(self, record: dict):
+        self._seen.add(record["text"])
+        self.index.add(len(self.records), record["text"])
+        self.records.append(record)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """他のプロセスと追記や詰め直しが重ならないようにする"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", "w", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, text: str, kind: str = "exchange"):
+        """記憶を追記する
+        kind: summary(要約の1項目), digest(まとめ直した要約),
+        exchange(会話のやり取り)
+        """
+        text = text.strip()
+        if not text:
+            return
+        with self._locked():
+            self._sync()
+            if text in self._seen:
+                return
+            record = {"time": round(time.time(), 3), "kind": kind, "text": text}
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                self._inode = os.fstat(f.fileno()).st_ino
+            self._offset += len(line.encode("utf-8"))
+            self._index(record)
+            if len(self.records) > self.max_records * 5 // 4:
+                self._compact()
+
+    def _compact(self):
+        """max_records件になるまで古い記憶を捨て、ファイルを書き直す
+        会話のやり取りを古いものから捨て、それでも多ければ要約も古いものから捨てる。
+        """
+        excess = len(self.records) - self.max_records
+        dropped = set()
+        for kinds in ((lambda k: k not in KEEP_KINDS), (lambda k: True)):
+            for doc, record in enumerate(self.records):
+                if len(dropped) >= excess:
+                    break
+                if doc not in dropped and kinds(record.get("kind")):
+                    dropped.add(doc)
+        kept = [r for doc, r in enumerate(self.records) if doc not in dropped]
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in kept:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self._inode = None  # 次の_syncで読み直す
+        self._sync()
+
+    def search(self, query: str, k: int = MEMORY_TOP_K) -> list[str]:
+        """queryに関係の深い記憶を関連度の高い順にk件返す"""
+        self._sync()
+        return [
+            self.records[doc]["text"]
+            for _, doc in self.index.search(query, k)
+        ]
+
+    def recall(self,
+               query: str,
+               k: int = MEMORY_TOP_K,
+               budget: int = MEMORY_TOKENS) -> str:
+        """queryに関係の深い記憶をbudgetトークン以内で古い順に改行でつなぐ
+        関連度の高い順に詰め、入らないものは飛ばす。
+        """
+        self._sync()
+        available = budget - MESSAGE_OVERHEAD
+        picked = []
+        for _, doc in self.index.search(query, k):
+            tokens = estimate_tokens(self.records[doc]["text"]) + 1  # 改行
+            if tokens > available:
+                continue
+            available -= tokens
+            picked.append(doc)
+        return "\n".join(self.records[doc]["text"] for doc in sorted(picked))
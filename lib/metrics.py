@@ -0,0 +1,140 @@
+"""1会話ごとの処理時間とトークン数の記録
+
+環境変数CHATME_TRACEかchatme.pyの--traceでJSON Linesの出力先を指定したときだけ
+有効になる。各処理(span)の所要時間と、APIレスポンスのトークン使用量を
+1行ずつ書き出し、終了時に処理ごとの集計を標準エラー出力に表示する。
+
+記録する処理
+    spinner: 回答の最初の文字が届くまでスピナーを表示していた時間
+    post: AI.postでChatGPTに問い合わせて回答の全文を受け取るまで
+    hedge: 遅い問い合わせのヘッジを次の経路へ送るまで待った時間
+    cache.hit: 回答キャッシュにあった回答を読み出すまで(問い合わせはしない)
+    summary: AI.summarizeで要約を作るまで
+    summary.post: SummarizerがChatGPTに問い合わせて要約を受け取るまで
+    gist.patch: 要約をgistへ書き込むまで
+    voice.synthesize: 1文の音声合成(キャッシュのヒットも含む)
+    voice.decode: 音声のバイナリのデコード
+    voice.play: 音声の再生
+
+# USAGE
+$ CHATME_TRACE=trace.jsonl python chatme.py
+
+with tracer.span("post", model=route.model):
+    ...
+tracer.add_usage("post", resp_json["usage"])
+tracer.close()  # 集計を表示する
+"""
+import os
+import sys
+import json
+import time
+import threading
+import statistics
+import contextvars
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Optional, Iterator
+
+# 今の会話の番号。バックグラウンドの要約などにも引き継がれる
+current_turn: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "current_turn", default=0)
+
+
+class Tracer:
+    """処理ごとの所要時間とトークン数をJSON Linesへ記録する"""
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()  # 音声合成などは別スレッドから記録される
+        self._turns = 0
+        self.spans: dict[str, list[float]] = {}
+        self.usage: dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """記録するかどうか"""
+        return self.path is not None
+
+    def enable(self, path: str):
+        """pathへの記録を始める"""
+        self.path = path
+
+    def next_turn(self) -> int:
+        """新しい会話を始める。以降の記録にこの会話の番号が付く"""
+        self._turns += 1
+        current_turn.set(self._turns)
+        return self._turns
+
+    def _write(self, record: dict):
+        record["turn"] = current_turn.get()
+        record["time"] = round(time.time(), 3)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def record(self, name: str, start: float, **attrs):
+        """perf_counter()のstartから今までをnameの処理時間として記録する"""
+        if not self.enabled:
+            return
+        ms = (perf_counter() - start) * 1000
+        with self._lock:
+            self.spans.setdefault(name, []).append(ms)
+        self._write({"span": name, "ms": round(ms, 1), **attrs})
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[None]:
+        """withブロックの所要時間をnameの処理時間として記録する
+        例外で抜けたときはerrorに例外の型を記録する。
+        """
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        except BaseException as err:
+            attrs["error"] = type(err).__name__
+            raise
+        finally:
+            self.record(name, start, **attrs)
+
+    def add_usage(self, name: str, usage: Optional[dict]):
+        """APIレスポンスのusage(トークン使用量)を記録する"""
+        if not self.enabled or not usage:
+            return
+        with self._lock:
+            for key in ("prompt_tokens", "completion_tokens"):
+                self.usage[key] = self.usage.get(key, 0) + usage.get(key, 0)
+        self._write({"usage": name, **usage})
+
+    def summary(self) -> str:
+        """処理ごとの回数、合計、平均、95パーセンタイル、トークン数の集計"""
+        lines = [
+            f"{'span':<18}{'count':>6}{'total_ms':>11}{'mean_ms':>10}"
+            f"{'p95_ms':>10}"
+        ]
+        ordered = sorted(self.spans.items(), key=lambda s: -sum(s[1]))
+        for name, samples in ordered:
+            p95 = sorted(samples)[min(len(samples) - 1,
+                                      int(len(samples) * 0.95))]
+            lines.append(f"{name:<18}{len(samples):>6}{sum(samples):>11.1f}"
+                         f"{statistics.mean(samples):>10.1f}{p95:>10.1f}")
+        for key, tokens in self.usage.items():
+            lines.append(f"{key:<18}{tokens:>6}")
+        return "\n".join(lines)
+
+    def close(self):
+        """記録を終え、集計を標準エラー出力に表示する"""
+        if not self.enabled:
+            return
+        print(self.summary(), file=sys.stderr)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# プロセス全体で共有する記録先
+tracer = Tracer(os.getenv("CHATME_TRACE"))
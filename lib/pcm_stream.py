@@ -0,0 +1,161 @@
+"""WAVを読み込みながら再生するストリーミング再生
+
+HTTPレスポンスの本文が届いた分からWAVのヘッダーを読み、
+PCMのフレームをそのままオーディオデバイスへ書き込む。
+pydubのようにファイル全体をAudioSegmentへデコードしたり、
+一時ファイルと別プロセスで再生したりしないので、最初の音が早く出て、
+長い回答でもメモリを使わない。
+
+再生にはPyAudioを使う。インストールされていなければavailable()がFalseになり、
+呼び出し側はpydubで再生する。
+
+# USAGE
+if available():
+    play_pcm(response.iter_content(CHUNK_BYTES))
+"""
+import struct
+import threading
+from collections import namedtuple
+from typing import Iterable, Optional, Union
+
+# HTTPレスポンスから一度に読むバイト数
+CHUNK_BYTES = 8192
+# dataチャンクの前に読むヘッダーの上限(バイト)
+HEADER_LIMIT = 64 * 1024
+# dataチャンクの大きさが分からないときの値
+UNKNOWN_SIZE = (0, 0xFFFFFFFF)
+# WAVのフォーマット
+WavFormat = namedtuple("WavFormat", ["channels", "sample_width", "frame_rate"])
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+_pyaudio = None
+
+
+def available() -> bool:
+    """PyAudioで再生できるか
+    PyAudioは読み込みに時間がかかるので、初めて使うときにimportする。
+    """
+    global _pyaudio
+    if _pyaudio is None:
+        try:
+            import pyaudio
+            _pyaudio = pyaudio
+        except ImportError:
+            _pyaudio = False
+    return bool(_pyaudio)
+
+
+class WavParser:
+    """届いた順にバイト列を受け取り、WAVのヘッダーを読んでPCMを返す
+    PCMはフレームの境目でそろえて返す。受け取ったバイト列はなるべく
+    コピーせずにmemoryviewで切り出す。
+    """
+    def __init__(self):
+        self.format: Optional[WavFormat] = None
+        self._header = bytearray()  # dataチャンクまでのヘッダー
+        self._data = False  # dataチャンクを読んでいるか
+        self._remaining: Optional[int] = None  # dataチャンクの残り(None=不明)
+        self._partial = b""  # フレームの途中で切れた端数
+
+    def feed(self, chunk: Buffer) -> Buffer:
+        """chunkを読み、再生できるPCMを返す(まだ無ければ空)"""
+        view = memoryview(chunk)
+        if not self._data:
+            before = len(self._header)
+            self._header += view[:HEADER_LIMIT - before]
+            start = self._parse_header()
+            if start is None:
+                if len(self._header) >= HEADER_LIMIT:
+                    raise ValueError("WAVのdataチャンクが見つかりません。")
+                return b""
+            view = view[start - before:]
+        if self._remaining is not None:
+            view = view[:self._remaining]
+            self._remaining -= len(view)
+        return self._align(view)
+
+    def _parse_header(self) -> Optional[int]:
+        """dataチャンクの本文の位置を返す。ヘッダーが足りなければNone"""
+        header = self._header
+        if len(header) < 12:
+            return None
+        if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError("WAVではありません。")
+        position = 12
+        while len(header) >= position + 8:
+            name = bytes(header[position:position + 4])
+            size, = struct.unpack_from("<I", header, position + 4)
+            body = position + 8
+            if name == b"data":
+                if self.format is None:
+                    raise ValueError("WAVのfmtチャンクがありません。")
+                self._data = True
+                self._remaining = None if size in UNKNOWN_SIZE else size
+                self._header = bytearray()
+                return body
+            if len(header) < body + size:
+                return None
+            if name == b"fmt ":
+                self.format = self._parse_format(header[body:body + size])
+            position = body + size + size % 2  # チャンクは偶数バイトにそろえる
+        return None
+
+    @staticmethod
+    def _parse_format(fmt: Buffer) -> WavFormat:
+        audio_format, channels, frame_rate, _, _, bits = struct.unpack_from(
+            "<HHIIHH", fmt)
+        # 1: PCM, 0xFFFE: WAVE_FORMAT_EXTENSIBLE(中身が整数のPCMのとき)
+        if audio_format not in (1, 0xFFFE):
+            raise ValueError(f"対応していないWAVの形式です。{audio_format}")
+        return WavFormat(channels, bits // 8, frame_rate)
+
+    def _align(self, view: memoryview) -> Buffer:
+        """前回の端数とつなぎ、フレームの途中で切れた分を次回に回す"""
+        if self._partial:
+            view = memoryview(self._partial + view)
+        frame = self.format.channels * self.format.sample_width
+        cut = len(view) - len(view) % frame
+        self._partial = bytes(view[cut:])
+        return view[:cut]
+
+
+def play_pcm(chunks: Iterable[Buffer],
+             stop: Optional[threading.Event] = None) -> float:
+    """WAVのバイト列を届いた順に読みながら再生し、再生した秒数を返す
+    最初のPCMが届いたときにフォーマットに合わせてデバイスを開く。
+    stopがセットされたらCHUNK_BYTESごとの区切りで再生をやめる。
+    """
+    if not available():
+        raise RuntimeError("PyAudioがインストールされていません。")
+    parser = WavParser()
+    audio = _pyaudio.PyAudio()
+    stream = None
+    frames = 0
+    try:
+        for chunk in chunks:
+            pcm = parser.feed(chunk)
+            if not pcm:
+                continue
+            if stream is None:
+                fmt = parser.format
+                stream = audio.open(
+                    format=audio.get_format_from_width(fmt.sample_width),
+                    channels=fmt.channels,
+                    rate=fmt.frame_rate,
+                    output=True)
+            frame = parser.format.channels * parser.format.sample_width
+            block = CHUNK_BYTES - CHUNK_BYTES % frame
+            for start in range(0, len(pcm), block):
+                if stop is not None and stop.is_set():
+                    return frames / parser.format.frame_rate
+                piece = pcm[start:start + block]
+                stream.write(piece)
+                frames += len(piece) // frame
+        if stream is not None:
+            stream.stop_stream()
+    finally:
+        if stream is not None:
+            stream.close()
+        audio.terminate()
+    return frames / parser.format.frame_rate if parser.format else 0.0
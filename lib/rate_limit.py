@@ -0,0 +1,160 @@
+"""OpenAI APIのレート制限
+
+1分あたりのリクエスト数(RPM)とトークン数(TPM)のトークンバケットで
+リクエストの送信を待たせる。AI.postとSummarizer.postで共有し、
+待っているリクエストの中では対話のリクエストを要約のリクエストより先に送る。
+429を受け取ったらRetry-Afterの間すべてのリクエストを止める。
+
+# USAGE
+await limiter.acquire(tokens=1500, priority=Priority.BACKGROUND)
+...
+limiter.pause(retry_after(response.headers) or backoff(attempt))
+"""
+import os
+import heapq
+import random
+import asyncio
+import itertools
+from enum import IntEnum
+from time import monotonic
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional, Mapping
+
+# 1分あたりのリクエスト数の上限
+RPM = int(os.getenv("CHATGPT_RPM", "3500"))
+# 1分あたりのトークン数の上限
+TPM = int(os.getenv("CHATGPT_TPM", "90000"))
+# 429や5xxで再試行する回数
+MAX_RETRIES = 5
+# 再試行の待ち時間の基準(秒)
+BACKOFF_BASE = 0.5
+# 再試行の待ち時間の上限(秒)
+BACKOFF_MAX = 30.0
+
+
+class Priority(IntEnum):
+    """リクエストの優先度。小さいほうが先に送られる"""
+    INTERACTIVE = 0  # ユーザーが回答を待っている
+    BACKGROUND = 1  # 要約などのバックグラウンド処理
+
+
+def backoff(attempt: int) -> float:
+    """attempt回目の再試行までの待ち時間(秒)
+    指数バックオフの半分をランダムにずらして、再試行が重ならないようにする。
+    """
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Retry-Afterヘッダーの待ち時間(秒)。無ければNone
+    秒数とHTTP日付のどちらの形式にも対応する。
+    """
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        until = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (until - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """1分あたりper_minute個まで補充されるトークンバケット"""
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.level = self.capacity
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.level = min(self.capacity,
+                         self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """amount個取り出せるようになるまでの時間(秒)
+        容量を超える量は容量いっぱいまで貯まれば取り出せることにする。
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float):
+        """amount個取り出す"""
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """RPMとTPMを守ってリクエストを順番に通す"""
+    def __init__(self, rpm: int = RPM, tpm: int = TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._waiters: list[tuple[int, int]] = []  # (優先度, 到着順)のヒープ
+        self._order = itertools.count()
+        self._paused_until = 0.0
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        """待っているリクエストに先頭や制限が変わったことを伝える"""
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _wait(self, timeout: Optional[float]):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def acquire(self,
+                      tokens: float,
+                      priority: Priority = Priority.INTERACTIVE):
+        """リクエストを1件、トークンをtokens個使えるまで待つ
+        優先度の高い順、同じ優先度なら到着順に通す。
+        """
+        entry = (int(priority), next(self._order))
+        heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                if self._waiters[0] != entry:  # 先に通すリクエストがある
+                    await self._wait(None)
+                    continue
+                wait = max(self._paused_until - monotonic(),
+                           self.requests.wait_time(1),
+                           self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await self._wait(wait)
+        except BaseException:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            self._notify()
+            raise
+        heapq.heappop(self._waiters)
+        self.requests.consume(1)
+        self.tokens.consume(tokens)
+        self._notify()
+
+    def ready(self, tokens: float) -> bool:
+        """待たずにリクエストを通せるか
+        ヘッジのように送らなくてもよいリクエストを送るかの判断に使う。
+        """
+        return not self._waiters and self._paused_until <= monotonic() and \
+            self.requests.wait_time(1) <= 0 and \
+            self.tokens.wait_time(tokens) <= 0
+
+    def pause(self, seconds: float):
+        """seconds秒間すべてのリクエストを止める(429を受け取ったとき)"""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+        self._notify()
+
+
+# AI.postとSummarizer.postで共有するレート制限
+limiter = RateLimiter()
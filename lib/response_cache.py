@@ -0,0 +1,140 @@
+"""temperature=0のChatGPT APIの回答のディスクキャッシュ
+
+temperature=0のリクエストは同じ入力に同じ回答を返すので、
+(エンドポイント, model, messages, max_tokensなどのパラメータ)のハッシュを
+キーにして回答をSQLiteに保存し、同じリクエストではネットワークに出ない。
+Summarizerは再起動後や同じ会話履歴の要約で同じリクエストを送りやすい。
+
+保存してからttl秒を過ぎた回答は使わない。
+合計サイズがmax_bytesを超えたら最後に使われた時刻が古いものから消す。
+
+# USAGE
+content = response_cache.get(ENDPOINT, data)
+if content is None:
+    content = ...  # APIに問い合わせる
+    response_cache.put(ENDPOINT, data, content)
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+
+# 回答キャッシュのデータベース
+CACHE_FILE = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "chat_my_assistant", "responses.sqlite3")
+# 回答を使い回す期間(秒)
+TTL = float(os.getenv("CHATME_RESPONSE_CACHE_TTL", str(7 * 24 * 60 * 60)))
+# キャッシュの合計サイズの上限(バイト)
+MAX_BYTES = int(os.getenv("CHATME_RESPONSE_CACHE_MB", "20")) * 1024 * 1024
+# キーに含めないパラメータ(回答の中身が変わらないもの)
+IGNORED_KEYS = ("stream", "stream_options")
+
+
+def cacheable(data: dict) -> bool:
+    """キャッシュしてよいリクエストか
+    temperature=0のときだけ回答が決まるのでキャッシュする。
+    """
+    return data.get("temperature") == 0
+
+
+class ResponseCache:
+    """回答のLRUディスクキャッシュ"""
+    def __init__(self,
+                 path: str = CACHE_FILE,
+                 ttl: float = TTL,
+                 max_bytes: int = MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()  # デーモンではto_threadからも呼ばれる
+
+    @staticmethod
+    def key(endpoint: str, data: dict) -> str:
+        """エンドポイントとリクエストのJSONからキャッシュキーを作る"""
+        params = {k: v for k, v in data.items() if k not in IGNORED_KEYS}
+        source = json.dumps([endpoint, params],
+                            ensure_ascii=False,
+                            sort_keys=True)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    used REAL NOT NULL
+                )""")
+        return self._db
+
+    def get(self, endpoint: str, data: dict) -> Optional[str]:
+        """キャッシュされた回答を返す。無いか期限切れならNone
+        ヒットしたら最後に使われた時刻を今にする。
+        """
+        key = self.key(endpoint, data)
+        now = time.time()
+        try:
+            with self._lock, self._connect() as db:
+                row = db.execute(
+                    "SELECT content FROM responses"
+                    " WHERE key = ? AND created > ?",
+                    (key, now - self.ttl)).fetchone()
+                if row is None:
+                    return None
+                db.execute("UPDATE responses SET used = ? WHERE key = ?",
+                           (now, key))
+        except sqlite3.Error:
+            return None
+        return row[0]
+
+    def put(self, endpoint: str, data: dict, content: str):
+        """回答を保存し、期限切れと上限を超えた分を古いものから消す
+        キャッシュに書けなくても回答は使えるので例外は握りつぶす。
+        """
+        now = time.time()
+        try:
+            with self._lock, self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (self.key(endpoint, data), content,
+                     len(content.encode("utf-8")), now, now))
+                self._evict(db, now)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, db: sqlite3.Connection, now: float):
+        """期限切れを消し、合計サイズがmax_bytes以下になるまで古いものから消す"""
+        db.execute("DELETE FROM responses WHERE created <= ?",
+                   (now - self.ttl, ))
+        total = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT key, size FROM responses ORDER BY used")
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key, ))
+            total -= size
+        db.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def close(self):
+        """データベースを閉じる"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# AI.postとSummarizer.postで共有する回答キャッシュ
+response_cache = ResponseCache()
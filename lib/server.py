@@ -0,0 +1,498 @@
+"""多くのユーザーとキャラクタの会話を1つのプロセスで受け持つHTTPサーバー
+
+会話ID(ユーザーごとに決める文字列)とキャラクタの組ごとにChatSessionを作り、
+会話履歴、要約、長期記憶を会話ごとに持つので、他のユーザーの会話が
+プロンプトに混ざらない。要約と長期記憶は"{会話ID}@{filename}"に保存する。
+会話IDはクライアントが決めるので、会話の要約はgistへは複製せずに
+ローカルのSQLiteだけに保存する。
+キャラクタの設定はキャラクタごとに1つのAIから複製し、保存先、
+APIのコネクションプール、レート制限はプロセスで1つずつを共有する。
+会話履歴はトークン予算で切り詰められ、使われない会話は要約を保存して
+破棄するので、会話が増えてもメモリは増え続けない。
+
+回答はSSEかWebSocketで届いた順に返す。音声出力(-v)を有効にして起動し、
+質問で"voice": trueを指定すると、文ごとに合成したWAVも返す。
+環境変数CHATME_SERVER_TOKENを設定すると、
+Authorization: Bearer <token>か?token=<token>の無い接続を断る。
+
+# USAGE
+$ python3 chatme.py --serve --port 8080 -vv
+
+# SSE
+$ curl -N localhost:8080/v1/sessions/alice/messages \\
+    -d '{"character": "PRO", "text": "こんにちは"}'
+event: delta
+data: {"text": "こん"}
+...
+event: done
+data: {"text": "こんにちは、何かお手伝いできますか？"}
+
+# WebSocket: ws://localhost:8080/v1/sessions/alice/ws?character=PRO
+送信: {"text": "こんにちは", "voice": true}
+      {"type": "cancel"}  (回答を止める。回答中に次の質問を送っても止まる)
+受信: {"type": "delta", "text": "こん"}
+      文ごとの音声のWAV(バイナリ)
+      {"type": "done", "text": 回答の全文}
+      {"type": "cancelled"}
+      {"type": "error", "message": エラーの内容}
+"""
+import os
+import sys
+import json
+import re
+import hmac
+import base64
+import asyncio
+from time import monotonic
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional, Union
+from aiohttp import web, WSMsgType
+from .ai import AI, ai_constructor
+from .session import ChatSession
+from .storage import Storage, open_storage
+from .http_session import set_limits
+from .voicevox_character import Mode
+
+# 待ち受けるアドレス
+HOST = "127.0.0.1"
+# 待ち受けるポート
+PORT = 8080
+# 同時に保持する会話の数の上限
+MAX_SESSIONS = 1000
+# 使われない会話を破棄するまでの時間(秒)
+IDLE_TIMEOUT = 30 * 60
+# 1回の質問の文字数の上限
+MAX_TEXT = 8000
+# WebSocketの生存確認の間隔(秒)
+HEARTBEAT = 30.0
+# 接続に必要なトークン(空なら確認しない)
+TOKEN = os.getenv("CHATME_SERVER_TOKEN", "")
+# APIへの同時接続数の上限(同時に流せる回答の数)
+CONNECTIONS = 100
+# 会話IDに使える文字列。要約と長期記憶のファイル名に使う
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# 会話ID, キャラクタ
+Key = tuple[str, str]
+# 回答の差分(str)か文ごとの音声(bytes)を届いた順に渡す関数
+Emit = Callable[[str, Union[str, bytes]], None]
+
+
+class SessionPool:
+    """(会話ID, キャラクタ)ごとのChatSession
+    最後に使った順に並べ、max_sessionsを超えたら古い会話から破棄し、
+    idle_timeout秒使われていない会話はevict_idle()で破棄する。
+    acquire()かadd()で借りてからrelease()で返すまでの会話は破棄しないので、
+    返す前に同じキーの会話が二重に作られて同じ要約を書き合うことはない。
+    破棄した会話はon_evictへ渡すので、要約待ちの会話を保存できる。
+    """
+    def __init__(self,
+                 max_sessions: int = MAX_SESSIONS,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 on_evict: Callable[[ChatSession], None] = lambda _: None):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self._sessions: OrderedDict[Key, ChatSession] = OrderedDict()
+        self._used: dict[Key, float] = {}  # 最後に使った時刻
+        self._leases: Counter[Key] = Counter()  # 貸し出している数
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def acquire(self, key: Key) -> Optional[ChatSession]:
+        """keyの会話を借りる。無ければNone"""
+        session = self._sessions.get(key)
+        if session is not None:
+            self._leases[key] += 1
+            self.touch(key)
+        return session
+
+    def add(self, key: Key, session: ChatSession) -> ChatSession:
+        """keyの会話としてsessionを加えて借りる
+        先に他の接続が加えていれば、そちらを借りる。
+        """
+        session = self._sessions.setdefault(key, session)
+        self._leases[key] += 1
+        self.touch(key)
+        self._evict_over()
+        return session
+
+    def release(self, key: Key):
+        """借りたkeyの会話を返す"""
+        self._leases[key] -= 1
+        if self._leases[key] <= 0:
+            del self._leases[key]
+        self.touch(key)
+
+    def in_use(self, key: Key) -> bool:
+        """keyの会話を貸し出しているか、回答中か"""
+        session = self._sessions.get(key)
+        return self._leases[key] > 0 or \
+            (session is not None and session.busy)
+
+    def touch(self, key: Key):
+        """keyの会話を使ったことにする"""
+        if key in self._sessions:
+            self._sessions.move_to_end(key)
+            self._used[key] = monotonic()
+
+    def discard(self, key: Key, force: bool = False) -> bool:
+        """keyの会話を破棄する
+        貸し出し中の会話はforceが偽なら破棄せずに偽を返す。
+        """
+        if not force and self.in_use(key):
+            return False
+        session = self._sessions.pop(key, None)
+        self._used.pop(key, None)
+        if session is not None:
+            self.on_evict(session)
+        return True
+
+    def clear(self):
+        """すべての会話を破棄する"""
+        for key in list(self._sessions):
+            self.discard(key, force=True)
+
+    def evict_idle(self) -> int:
+        """idle_timeout秒使われていない会話を破棄し、破棄した数を返す"""
+        deadline = monotonic() - self.idle_timeout
+        stale = [
+            key for key in self._sessions
+            if self._used[key] < deadline and not self.in_use(key)
+        ]
+        for key in stale:
+            self.discard(key)
+        return len(stale)
+
+    def _evict_over(self):
+        for key in list(self._sessions):  # 古い順
+            if len(self._sessions) <= self.max_sessions:
+                break
+            self.discard(key)
+
+
+def sse(kind: str, content: Union[str, bytes]) -> bytes:
+    """SSEの1イベント。音声はbase64にする"""
+    if isinstance(content, bytes):
+        data = {"wav": base64.b64encode(content).decode("ascii")}
+    else:
+        data = {"text": content}
+    body = json.dumps(data, ensure_ascii=False)
+    return f"event: {kind}\ndata: {body}\n\n".encode("utf-8")
+
+
+def check_session(session: str) -> str:
+    """会話IDを確かめて返す"""
+    if not SESSION_ID.fullmatch(session):
+        raise web.HTTPBadRequest(
+            text="会話IDは64文字以内の英数字、_、-にしてください。")
+    return session
+
+
+def failure(err: Exception) -> str:
+    """予期しないエラーを記録し、クライアントへ返すメッセージを作る"""
+    print(f"Warning: 回答に失敗しました。{err!r}", file=sys.stderr)
+    return "回答に失敗しました。"
+
+
+def check_text(text) -> str:
+    """質問の文字列を確かめて返す"""
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("textが空です。")
+    if len(text) > MAX_TEXT:
+        raise ValueError(f"textが{MAX_TEXT}文字を超えています。")
+    return text
+
+
+class ChatServer:
+    """会話ごとのAI(要約と長期記憶)と会話履歴を保持して質問に答える"""
+    def __init__(self,
+                 character: str = "ChatGPT",
+                 voice: Mode = Mode.NONE,
+                 speaker=None,
+                 character_file: Optional[str] = None,
+                 offline: bool = False,
+                 max_sessions: int = MAX_SESSIONS,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 token: str = TOKEN,
+                 connections: int = CONNECTIONS,
+                 session_storage: Optional[Storage] = None):
+        self.character = character  # キャラクタ指定がない質問に答えるAI
+        self.voice = voice
+        self.speaker = speaker
+        self.character_file = character_file
+        self.offline = offline
+        self.token = token
+        self.connections = connections
+        self.storage = open_storage()  # キャラクタ設定を読む保存先
+        # 会話ごとの要約の保存先。gistへは複製しない
+        self.session_storage = session_storage or open_storage("sqlite")
+        # キャラクタごとの設定。会話ごとのAIはこれを複製する
+        self.ais: dict[str, AI] = {}
+        self.pool = SessionPool(max_sessions, idle_timeout, self.close)
+        self._loading = asyncio.Lock()  # 同じキャラクタを二重に読み込まない
+        self._closing: set[asyncio.Task] = set()  # 破棄した会話の保存
+
+    async def get_ai(self, name: str) -> AI:
+        """キャラクタのAIを返す。初めてのキャラクタなら読み込む
+        保存先の読み込みは同期処理なので別スレッドで行う。
+        """
+        async with self._loading:
+            if name not in self.ais:
+                try:
+                    self.ais[name] = await asyncio.to_thread(
+                        ai_constructor,
+                        name=name,
+                        voice=self.voice,
+                        speaker=self.speaker,
+                        character_file=self.character_file,
+                        offline=self.offline,
+                        storage=self.storage)
+                except IndexError as err:
+                    raise web.HTTPNotFound(
+                        text=f"キャラクタ{name}がいません。") from err
+        return self.ais[name]
+
+    @asynccontextmanager
+    async def lease(self, session: str,
+                    name: str) -> AsyncIterator[ChatSession]:
+        """会話IDとキャラクタの会話を借りる。無ければ始める
+        借りている間は破棄されない。会話ごとの要約と長期記憶の読み込みは
+        同期処理なので別スレッドで行う。
+        """
+        key = (session, name)
+        chat = self.pool.acquire(key)
+        if chat is None:
+            ai = await self.get_ai(name)
+            ai = await asyncio.to_thread(ai.for_session, session,
+                                         self.session_storage)
+            chat = self.pool.add(key, ChatSession(ai))
+        try:
+            yield chat
+        finally:
+            self.pool.release(key)
+
+    def close(self, session: ChatSession):
+        """破棄した会話の要約待ちの会話を要約して保存する"""
+        task = asyncio.create_task(self._close(session))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, session: ChatSession):
+        await session.close()
+        # 会話のファイルのために保存先が持つ状態を捨て、会話が増えても貯めない
+        self.session_storage.forget(session.ai.filename)
+
+    async def close_all(self):
+        """すべての会話を破棄し、要約を保存し終えるまで待つ"""
+        self.pool.clear()
+        if self._closing:
+            await asyncio.wait(self._closing)
+
+    @staticmethod
+    async def turn(session: ChatSession, text: str, voice: bool,
+                   emit: Emit) -> str:
+        """1ターン分の回答をemit(種類, 内容)で届いた順に渡し、全文を返す
+        種類はdelta(回答の差分, str)かaudio(文ごとのWAV, bytes)。
+        音声は回答の全文が届いてから、すべての文を合成し終わるまで待つ。
+        """
+        speech = None
+        if voice:
+            loop = asyncio.get_running_loop()
+            # 合成した音声は再生せずに、別スレッドから届いた順に渡す
+            speech = session.speech(lambda binary: loop.call_soon_threadsafe(
+                emit, "audio", binary))
+
+        def on_delta(delta: str):
+            emit("delta", delta)
+            if speech is not None:
+                speech.feed(delta)
+
+        try:
+            answer = await session.send(text, on_delta)
+            if speech is not None:
+                speech.close()
+                await speech.wait()
+        except BaseException:
+            if speech is not None:
+                speech.cancel()
+            raise
+        return answer
+
+    @web.middleware
+    async def authorize(self, request: web.Request, handler):
+        """tokenが設定されていれば、一致しない接続を断る"""
+        if self.token:
+            header = request.headers.get("Authorization", "")
+            given = header.removeprefix("Bearer ") or \
+                request.query.get("token", "")
+            if not hmac.compare_digest(given.encode("utf-8"),
+                                       self.token.encode("utf-8")):
+                raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    async def post_message(self, request: web.Request) -> web.StreamResponse:
+        """JSONで質問を受け取り、回答をSSEで届いた順に返す
+        接続が切れたら回答をやめ、届けた分だけを会話履歴に残す。
+        """
+        try:
+            body = await request.json()
+            text = check_text(body.get("text"))
+        except (ValueError, AttributeError) as err:
+            raise web.HTTPBadRequest(text=str(err)) from err
+        name = body.get("character") or self.character
+        key = (check_session(request.match_info["session"]), name)
+        async with self.lease(*key) as session:
+            return await self.stream_answer(request, session, text,
+                                            bool(body.get("voice")))
+
+    async def stream_answer(self, request: web.Request, session: ChatSession,
+                            text: str, voice: bool) -> web.StreamResponse:
+        """sessionでtextに答え、回答をSSEで届いた順に返す"""
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+        events: asyncio.Queue = asyncio.Queue()
+
+        def emit(kind: str, content: Union[str, bytes]):
+            events.put_nowait((kind, content))
+
+        task = asyncio.create_task(self.turn(session, text, voice, emit))
+        task.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while (event := await events.get()) is not None:
+                await response.write(sse(*event))
+            try:
+                await response.write(sse("done", task.result()))
+            except ValueError as err:  # APIのエラー
+                await response.write(sse("error", str(err)))
+            except Exception as err:  # pylint: disable=broad-except
+                await response.write(sse("error", failure(err)))
+        finally:
+            task.cancel()
+        return response
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        """WebSocketで質問を受け取り、回答を届いた順に返す
+        回答中に次の質問か{"type": "cancel"}が届いたら、今の回答をやめる。
+        接続している間は会話を借りたままにする。
+        """
+        name = request.query.get("character") or self.character
+        key = (check_session(request.match_info["session"]), name)
+        # 接続する前にキャラクタを確かめる
+        async with self.lease(*key) as session:
+            return await self.converse(request, session)
+
+    async def converse(self, request: web.Request,
+                       session: ChatSession) -> web.WebSocketResponse:
+        """WebSocketで届いた質問にsessionで順に答える"""
+        ws = web.WebSocketResponse(heartbeat=HEARTBEAT)
+        await ws.prepare(request)
+        events: asyncio.Queue = asyncio.Queue()
+
+        def emit(kind: str, content: Union[str, bytes]):
+            events.put_nowait((kind, content))
+
+        async def send_all():
+            # 送信はこのタスクだけで行い、届いた順を保つ
+            while (event := await events.get()) is not None:
+                kind, content = event
+                try:
+                    if isinstance(content, bytes):
+                        await ws.send_bytes(content)
+                    elif kind == "error":
+                        await ws.send_json({"type": kind, "message": content})
+                    elif kind == "cancelled":
+                        await ws.send_json({"type": kind})
+                    else:
+                        await ws.send_json({"type": kind, "text": content})
+                except ConnectionError:  # 切断された
+                    return
+
+        async def answer(text: str, voice: bool):
+            try:
+                emit("done", await self.turn(session, text, voice, emit))
+            except asyncio.CancelledError:
+                emit("cancelled", "")
+                raise
+            except ValueError as err:  # APIのエラー
+                emit("error", str(err))
+            except Exception as err:  # pylint: disable=broad-except
+                emit("error", failure(err))
+
+        sender = asyncio.create_task(send_all())
+        task: Optional[asyncio.Task] = None
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                if task is not None and not task.done():
+                    task.cancel()
+                    await asyncio.wait({task})
+                try:
+                    body = json.loads(message.data)
+                    if body.get("type") == "cancel":
+                        continue
+                    text = check_text(body.get("text"))
+                except (ValueError, AttributeError) as err:
+                    emit("error", str(err))
+                    continue
+                task = asyncio.create_task(
+                    answer(text, bool(body.get("voice"))))
+        finally:
+            if task is not None:
+                task.cancel()
+                await asyncio.wait({task})
+            events.put_nowait(None)
+            await sender
+        return ws
+
+    async def delete_session(self, request: web.Request) -> web.Response:
+        """会話を破棄する。要約と長期記憶は保存して残す"""
+        name = request.query.get("character") or self.character
+        key = (check_session(request.match_info["session"]), name)
+        if not self.pool.discard(key):
+            raise web.HTTPConflict(text="使用中の会話は破棄できません。")
+        return web.Response(status=204)
+
+    async def health(self, _request: web.Request) -> web.Response:
+        """会話の数と読み込んだキャラクタ"""
+        return web.json_response({
+            "sessions": len(self.pool),
+            "characters": list(self.ais),
+        })
+
+    def app(self) -> web.Application:
+        """ルーティングを設定したアプリケーション"""
+        app = web.Application(middlewares=[self.authorize])
+        app.add_routes([
+            web.get("/v1/health", self.health),
+            web.post("/v1/sessions/{session}/messages", self.post_message),
+            web.get("/v1/sessions/{session}/ws", self.websocket),
+            web.delete("/v1/sessions/{session}", self.delete_session),
+        ])
+        return app
+
+    async def serve(self, host: str = HOST, port: int = PORT):
+        """host:portで待ち受け、使われない会話を定期的に破棄する
+        終了時は要約待ちの会話を要約して長期記憶へ書き込む。
+        """
+        set_limits(self.connections, self.connections)
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        # 最初の質問までにキャラクタの読み込みとAPIサーバーへの接続を済ませる
+        ai = await self.get_ai(self.character)
+        await ai.warmup()
+        print(f"chatme server: http://{host}:{port}", file=sys.stderr)
+        try:
+            while True:
+                await asyncio.sleep(self.pool.idle_timeout / 4)
+                self.pool.evict_idle()
+        finally:
+            await runner.cleanup()
+            await self.close_all()
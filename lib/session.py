@@ -0,0 +1,170 @@
+"""AIキャラクタとの会話を進めるセッション
+
+会話履歴を持ち、send()で1ターンずつ進める。CLI、常駐モード、サーバーは
+このクラスを通して会話する。対話モードのinteract()は再帰せずに
+1つのループでターンを繰り返す。会話履歴はトークン予算で、要約は階層ごとに、
+長期記憶は記憶の数の上限(CHATME_MEMORY_RECORDS)で詰めるので、
+何千ターン続けてもメモリが増え続けない(bench/soak.pyで確かめる)。
+
+# USAGE
+session = ChatSession(ai_constructor("PRO"))
+answer = await session.send("こんにちは")
+answer = await session.send("続けて", on_delta=print)
+await session.close()  # 要約待ちの会話を要約して保存する
+
+# 端末で対話する
+await ChatSession(ai).interact()
+"""
+import sys
+import asyncio
+from typing import Optional, Callable, TYPE_CHECKING
+from .ai import AI, Message, TIMEOUT, StreamPrinter, spinner, \
+    wait_for_input, print_one_by_one, barge_in
+from .metrics import tracer
+
+if TYPE_CHECKING:
+    from .voicevox_audio import SpeechPipeline
+
+# 対話モードを終わる入力
+QUIT = ("q", "exit")
+
+
+class ChatSession:
+    """AIキャラクタとの1つの会話"""
+    def __init__(self, ai: AI, history: Optional[list[Message]] = None):
+        self.ai = ai
+        self.history: list[Message] = [] if history is None else history
+        self._lock = asyncio.Lock()  # 同じ会話のターンは1つずつ進める
+
+    async def send(self,
+                   text: str,
+                   on_delta: Optional[Callable[[str], None]] = None,
+                   settle: bool = True) -> str:
+        """textを送って回答を返す
+        回答の差分が届くたびにon_deltaを呼び出す。
+        同時に呼ばれたら先に呼ばれたターンが終わるまで待つ。
+        取り消されたときは、on_deltaへ渡した分だけが会話履歴に残る。
+        settleが偽なら、回答を表示し終えてからai.settle()かai.amend()を
+        呼ぶまで要約と長期記憶には入れない。
+        """
+        tracer.next_turn()
+        return await self._respond(text, on_delta, settle)
+
+    async def _respond(self, text: str,
+                       on_delta: Optional[Callable[[str], None]],
+                       settle: bool) -> str:
+        """会話の番号を変えずにtextを送って回答を返す"""
+        async with self._lock:
+            return await self.ai.respond(self.history, text, on_delta,
+                                         settle)
+
+    @property
+    def busy(self) -> bool:
+        """回答中か"""
+        return self._lock.locked()
+
+    def speech(
+        self,
+        player: Optional[Callable[[bytes], None]] = None
+    ) -> Optional["SpeechPipeline"]:
+        """音声出力が有効なら文ごとに合成と再生を行うパイプラインを返す
+        player: 文ごとの音声のバイナリを受け取る関数(None=スピーカーで再生)
+        """
+        if self.ai.voice <= 0:
+            return None
+        from .voicevox_audio import SpeechPipeline
+        return SpeechPipeline(self.ai.speaker, self.ai.voice, player=player)
+
+    async def close(self):
+        """要約待ちの会話を要約し、長期記憶へ書き込む"""
+        await self.ai.flush()
+
+    async def interact(self):
+        """端末で質問を受け付けて答える。qかexitで終わる
+        APIのエラーで答えられなかったときはエラーを表示して次の質問を待つ。
+        """
+        # 入力を待つ間にAPIサーバーへ接続しておく
+        warmup_task = asyncio.create_task(self.ai.warmup())
+        try:
+            while (user_input := await self.read_input()) is not None:
+                try:
+                    await self.console_turn(user_input)
+                except ValueError as err:  # APIのエラー。次の質問を待つ
+                    print(err, file=sys.stderr)
+        finally:
+            warmup_task.cancel()
+
+    @staticmethod
+    async def read_input() -> Optional[str]:
+        """空でない質問を待つ。qかexitならNone"""
+        while True:  # 入力待受
+            try:
+                user_input = await wait_for_input(TIMEOUT)
+                user_input = user_input.replace("/n", " ")
+                if user_input.strip() in QUIT:
+                    return None
+                # 待っても入力がなければ、再度質問待ち
+                if user_input.strip() != "":
+                    return user_input
+            except KeyboardInterrupt:
+                print()
+
+    async def console_turn(self, user_input: str):
+        """1ターン分の回答を端末に表示し、読み上げる
+        Ctrl-Cか次の入力で回答の受信、表示、音声合成、再生をすぐに止める。
+        """
+        # スピナーと読み上げの記録にも回答と同じ会話の番号を付ける
+        tracer.next_turn()
+        spinner_task = asyncio.create_task(spinner())  # スピナー表示
+        printer = StreamPrinter(self.ai.name, spinner_task) \
+            if self.ai.stream else None
+        # 音声出力オプションがあれば、文ごとに合成と再生を始める
+        speech = self.speech()
+
+        def on_delta(delta: str):
+            if printer is not None:
+                printer(delta)
+            if speech is not None:
+                speech.feed(delta)
+
+        async def answer():
+            # ai_responseが出てくるまで待つ
+            # ストリーミング時は届いた差分から順に表示、読み上げされる
+            try:
+                # 一度に届く回答は表示し終えてから要約と長期記憶に入れる
+                ai_response = await self._respond(user_input, on_delta,
+                                                  settle=printer is not None)
+            finally:
+                spinner_task.cancel()
+                if speech is not None:
+                    speech.close()
+            if printer is None:
+                print(f"{self.ai.name}: ", end="")
+                printed: list[str] = []
+                try:
+                    await print_one_by_one(f"{ai_response}\n", printed)
+                except asyncio.CancelledError:
+                    self.ai.amend(self.history, "".join(printed))
+                    raise
+                self.ai.settle(self.history)
+            else:
+                printer.close()
+            # 読み上げが終わってから次の質問を受け付ける
+            if speech is not None:
+                await speech.wait()
+
+        turn = asyncio.create_task(answer())
+        with barge_in(turn):
+            try:
+                await asyncio.wait({turn})
+            finally:
+                turn.cancel()
+        if turn.cancelled():
+            spinner_task.cancel()
+            if speech is not None:
+                speech.cancel()
+            if printer is not None:
+                printer.close()
+            print("(中断しました)")
+        else:
+            turn.result()
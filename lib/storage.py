@@ -0,0 +1,288 @@
+"""キャラクタ設定と会話の要約を保存する場所
+
+ファイル名(キャラクタのfilenameやcharacter.yml)ごとに文字列を読み書きする。
+    SQLiteStorage: ローカルのSQLite。読み書きが数ミリ秒で終わる
+    GistStorage: gist。読み書きのたびにgithub.comへアクセスする
+    DebouncedStorage: 書き込みを間引いて非同期に行う
+    ReplicatedStorage: 読み書きはprimaryで行い、replicaへも書き込む。
+        primaryに無いファイルはreplicaから読む。起動して最初に読むときに
+        replicaが他で更新されていないか確かめ、更新されていればprimaryへ取り込む
+
+環境変数CHATME_STORAGEで使う場所を選ぶ。
+    auto(デフォルト): SQLite。GIST_IDがあればgistへ複製する。
+        起動時にgistを条件付きGETで確かめ(変わっていなければ304が1回)、
+        他のマシンやブラウザでの編集をSQLiteへ取り込む
+    sqlite: SQLiteだけ
+    gist: gistだけ(従来の動作)
+
+# USAGE
+storage = open_storage()
+summary = storage.get("chatgpt-assistant.txt")
+await storage.put("chatgpt-assistant.txt", "明日も晴れ")
+await storage.flush()  # 終了時に複製待ちの内容を書き込む
+
+# gistで編集したファイルをローカルへ取り込み直す
+$ python -m lib.storage pull character.yml
+"""
+import os
+import sys
+import abc
+import argparse
+import time
+import sqlite3
+import threading
+from typing import Optional
+
+# 保存先の種類
+STORAGE = os.getenv("CHATME_STORAGE", "auto")
+# SQLiteのデータベース
+DB_FILE = os.path.join(
+    os.getenv("XDG_DATA_HOME", os.path.expanduser("~/.local/share")),
+    "chat_my_assistant", "storage.sqlite3")
+
+
+class Storage(abc.ABC):
+    """ファイル名ごとに文字列を読み書きする保存先"""
+    @abc.abstractmethod
+    def get(self, filename: str) -> Optional[str]:
+        """filenameの内容を返す。無ければNone"""
+
+    @abc.abstractmethod
+    async def put(self, filename: str, content: str):
+        """filenameに内容を保存する"""
+
+    async def flush(self):
+        """保存待ちの内容をすぐに書き込む"""
+
+    def revalidate(self) -> bool:
+        """前回読んでから他で更新されていれば真"""
+        return False
+
+    def set_delay(self, delay: float):
+        """書き込みをまとめる待ち時間(秒)を変える。まだ書き込む前に呼ぶ"""
+
+    def forget(self, filename: str):
+        """filenameのために持っている状態を捨てる。保存した内容は残る
+        使い終わったファイルの状態が貯まり続けないように、flush()の後に呼ぶ。
+        """
+
+
+class SQLiteStorage(Storage):
+    """ローカルのSQLiteに保存する
+    WALモードなので、常駐モードと対話モードのように複数のプロセスが
+    同時に読み書きしても読み込みが書き込みを待たない。
+    書き込みはファイルごとに1つのトランザクションで置き換える。
+    """
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()  # ai_constructorはto_threadからも呼ばれる
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path,
+                                       timeout=10,
+                                       check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    filename TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+        return self._db
+
+    def get(self, filename: str) -> Optional[str]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT content FROM files WHERE filename = ?",
+                (filename, )).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, filename: str, content: str):
+        """filenameに内容を保存する(同期版)"""
+        with self._lock, self._connect() as db:
+            db.execute(
+                "INSERT INTO files VALUES (?, ?, ?)"
+                " ON CONFLICT(filename) DO UPDATE"
+                " SET content = excluded.content, updated = excluded.updated",
+                (filename, content, time.time()))
+
+    async def put(self, filename: str, content: str):
+        self.set(filename, content)
+
+    def close(self):
+        """データベースを閉じる"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class GistStorage(Storage):
+    """gistに保存する"""
+    def revalidate(self) -> bool:
+        """ディスクのキャッシュのETagで条件付きGETを行い、
+        gistが他で更新されていれば真を返す
+        """
+        from .gist_memory import Gist
+        Gist.fetch()
+        return Gist.modified
+
+    def get(self, filename: str) -> Optional[str]:
+        from .gist_memory import Gist
+        try:
+            return Gist(filename).get()
+        except KeyError:  # gistにそのファイルが無い
+            return None
+
+    async def put(self, filename: str, content: str):
+        from .gist_memory import Gist
+        await Gist(filename).apatch(content)
+
+
+class DebouncedStorage(Storage):
+    """storageへの書き込みをファイルごとにDebouncedWriterで間引く"""
+    def __init__(self, storage: Storage, delay: Optional[float] = None):
+        self.storage = storage
+        self.delay = delay  # 書き込みをまとめる待ち時間(秒, None=既定値)
+        self._writers: dict = {}  # filename: DebouncedWriter
+
+    def get(self, filename: str) -> Optional[str]:
+        return self.storage.get(filename)
+
+    def revalidate(self) -> bool:
+        return self.storage.revalidate()
+
+    def set_delay(self, delay: float):
+        self.delay = delay
+
+    def _writer(self, filename: str):
+        from .gist_memory import DebouncedWriter, WRITE_DELAY
+        if filename not in self._writers:
+            target = _Target(self.storage, filename)
+            delay = WRITE_DELAY if self.delay is None else float(self.delay)
+            self._writers[filename] = DebouncedWriter(target, delay)
+        return self._writers[filename]
+
+    async def put(self, filename: str, content: str):
+        self._writer(filename).write(content)
+
+    async def flush(self):
+        """保存待ちの内容を書き込み、書き込み終えたファイルの状態を捨てる"""
+        for filename, writer in list(self._writers.items()):
+            await writer.flush()
+            if not writer.pending and self._writers.get(filename) is writer:
+                del self._writers[filename]
+
+    def forget(self, filename: str):
+        writer = self._writers.get(filename)
+        if writer is not None and not writer.pending:
+            del self._writers[filename]
+        self.storage.forget(filename)
+
+
+class _Target:
+    """DebouncedWriterからStorageのファイルへ書き込むためのアダプタ"""
+    def __init__(self, storage: Storage, filename: str):
+        self.storage = storage
+        self.filename = filename
+
+    async def apatch(self, body: str):
+        await self.storage.put(self.filename, body)
+
+
+class ReplicatedStorage(Storage):
+    """primaryに保存し、replicaへも保存する
+    replicaをDebouncedStorageにすれば複製は間引いて非同期に行われる。
+    自分の書き込みはreplicaにも届いているので、起動時にreplicaが
+    更新されていれば他のマシンかブラウザでの編集としてreplicaを優先する。
+    """
+    def __init__(self, primary: SQLiteStorage, replica: Storage):
+        self.primary = primary
+        self.replica = replica
+        self._stale: Optional[bool] = None  # replicaが他で更新されていたか
+        self._refreshed: set[str] = set()  # replicaと突き合わせたファイル
+
+    def _replica_changed(self) -> bool:
+        """replicaが他で更新されていたか。確かめるのはプロセスで1回だけ
+        確かめられなければprimaryをそのまま使う。
+        """
+        if self._stale is None:
+            try:
+                self._stale = self.replica.revalidate()
+            except Exception as err:  # ネットワークのエラーなど
+                print(f"Warning: gistの更新を確かめられませんでした: {err}",
+                      file=sys.stderr)
+                self._stale = False
+        return self._stale
+
+    def get(self, filename: str) -> Optional[str]:
+        """primaryに無いか、replicaが他で更新されていればreplicaから読み、
+        primaryにも保存する。replicaから読めなければprimaryの内容を返す
+        """
+        content = self.primary.get(filename)
+        if content is not None and (filename in self._refreshed
+                                    or not self._replica_changed()):
+            return content
+        self._refreshed.add(filename)
+        try:
+            remote = self.replica.get(filename)
+        except Exception as err:  # ネットワークのエラーなど
+            print(f"Warning: gistから{filename}を読めませんでした: {err}",
+                  file=sys.stderr)
+            return content
+        if remote is not None and remote != content:
+            self.primary.set(filename, remote)
+            return remote
+        return content
+
+    async def put(self, filename: str, content: str):
+        await self.primary.put(filename, content)
+        await self.replica.put(filename, content)
+
+    async def flush(self):
+        await self.replica.flush()
+
+    def revalidate(self) -> bool:
+        return self._replica_changed()
+
+    def set_delay(self, delay: float):
+        self.replica.set_delay(delay)
+
+    def forget(self, filename: str):
+        self._refreshed.discard(filename)
+        self.primary.forget(filename)
+        self.replica.forget(filename)
+
+
+def open_storage(kind: str = STORAGE,
+                 delay: Optional[float] = None) -> Storage:
+    """CHATME_STORAGEに合わせた保存先を返す
+    delay: gistへの書き込みをまとめる待ち時間(秒)
+    """
+    if kind == "gist":
+        return DebouncedStorage(GistStorage(), delay)
+    local = SQLiteStorage()
+    if kind == "sqlite" or not os.getenv("GIST_ID"):
+        return local
+    return ReplicatedStorage(local, DebouncedStorage(GistStorage(), delay))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="保存先のファイルの操作")
+    parser.add_argument("command",
+                        choices=["pull"],
+                        help="pull: gistのファイルでローカルのファイルを置き換える")
+    parser.add_argument("filenames", nargs="+", help="ファイル名")
+    args = parser.parse_args()
+    local = SQLiteStorage()
+    for name in args.filenames:
+        text = GistStorage().get(name)
+        if text is None:
+            print(f"Warning: gistに{name}がありません。", file=sys.stderr)
+            continue
+        local.set(name, text)
+        print(f"{name}: {len(text)}文字")
@@ -0,0 +1,107 @@
+"""会話の要約をまとめて順番に行うスケジューラ
+
+会話のたびに要約を投げっぱなしにすると、要約が並行して走り、
+古い要約が新しい要約を上書きしてしまう。
+SummaryScheduler は前回の要約に成功してから増えた会話だけを集め、
+turns会話ごと、または最初の会話からinterval秒後に1回だけ要約する。
+要約は常にひとつずつ実行し、実行中に次の要約の条件を満たしたら
+実行中の要約が終わってから残りの会話をまとめて要約する。
+実行中の要約は取り消さない。要約は前回の要約に足す新しい会話だけの差分で、
+後の要約が前の要約の会話を含むことはないので、前の要約が古くなって
+不要になることはない。取り消すとその会話を要約し直す分だけ無駄になる。
+
+# USAGE
+scheduler = SummaryScheduler(ai.summarize, turns=2, interval=30)
+scheduler.add([Message("user", "こんにちは"), Message("assistant", "やあ")])
+await scheduler.drain()  # 終了時は残りの会話をすべて要約してから戻る
+"""
+import sys
+import asyncio
+from typing import Optional, Callable, Awaitable
+
+# 要約をまとめて行う会話数
+SUMMARY_TURNS = 1
+# 会話があってから要約を始めるまでの最大待ち時間(秒)
+SUMMARY_INTERVAL = 30.0
+
+
+class SummaryScheduler:
+    """要約の実行を間引き、同時に1つだけ走らせる"""
+    def __init__(self,
+                 summarize: Callable[[list], Awaitable],
+                 turns: int = SUMMARY_TURNS,
+                 interval: float = SUMMARY_INTERVAL):
+        self.summarize = summarize
+        self.turns = turns
+        self.interval = interval
+        self._pending: list = []  # まだ要約に成功していない会話
+        self._turns = 0  # 前回要約を始めてからの会話数
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        self._again = False  # 実行中の要約が終わったらもう一度要約する
+
+    @property
+    def running(self) -> bool:
+        """要約を実行中か"""
+        return self._task is not None and not self._task.done()
+
+    def add(self, messages: list):
+        """1会話分のメッセージを要約待ちに加える"""
+        self._pending.extend(messages)
+        self._turns += 1
+        if self._turns >= self.turns:
+            self._start()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.interval, self._start)
+
+    def _start(self):
+        """要約を始める。実行中なら終わってから残りを要約する
+        待ち時間のタイマーはこの要約に含まれるので取り消す。
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._turns = 0
+        if self.running:
+            self._again = True
+            return
+        self._task = asyncio.create_task(self._run(list(self._pending)))
+
+    async def _run(self, batch: list):
+        """batchを要約し、成功したら要約待ちから除く
+        失敗したときは要約待ちに残し、次の要約でまとめて再試行する。
+        """
+        try:
+            await self.summarize(batch)
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"Warning: 会話の要約に失敗しました。{err}", file=sys.stderr)
+        else:
+            del self._pending[:len(batch)]
+        if self._again and self._pending:
+            self._again = False
+            self._task = asyncio.create_task(self._run(list(self._pending)))
+
+    async def drain(self):
+        """実行中の要約と、要約待ちの会話の要約がすべて終わるまで待つ"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.running:
+            await self._task
+        self._again = False
+        if self._pending:
+            self._turns = 0
+            self._task = asyncio.create_task(self._run(list(self._pending)))
+            await self._task
+
+    def cancel(self):
+        """実行中の要約と待ち時間のタイマーを取り消す
+        要約待ちの会話ごと捨てるときだけ使う。新しい要約のためには取り消さない。
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._again = False
+        if self.running:
+            self._task.cancel()
@@ -0,0 +1,104 @@
+"""階層に分けて少しずつまとめ直す要約
+
+要約を3つの階層に分けて持つ。
+    recent: 最近の会話の詳しい要約。要約1回分が1項目
+    digests: recentの古い項目をまとめ直した短い要約
+    profile: digestsの古い項目をまとめ直した、ユーザーとの関係の全体像
+
+Summarizerは新しい会話だけを要約してrecentに足すので、要約の全文を毎回
+書き直すより入力が小さい。recentがRECENT_LIMIT項目を超えたら古い半分を
+digestsの1項目に、digestsがDIGEST_LIMIT項目を超えたら古い半分をprofileへ
+まとめ直す。古い内容は捨てずに上の階層へ移る。
+
+gistにはYAMLで保存する。YAMLの辞書として読めない従来の要約の文字列は
+digestsの1項目として読み込む。
+
+# USAGE
+tiers = TieredSummary.parse(gist.get())
+tiers.recent.append(await summarize(messages))
+await tiers.compact(condense)  # condense(text, max_tokens) -> 要約
+gist.patch(tiers.dump())
+prompt = tiers.render()
+"""
+from typing import Awaitable, Callable, Optional
+
+# そのまま残す最近の要約の数
+RECENT_LIMIT = 8
+# 残す中間の要約の数
+DIGEST_LIMIT = 4
+# 中間の要約1項目のトークン数の上限
+DIGEST_TOKENS = 500
+# 全体像のトークン数の上限
+PROFILE_TOKENS = 1000
+
+
+class TieredSummary:
+    """recent, digests, profileの3階層の要約"""
+    def __init__(self,
+                 profile: str = "",
+                 digests: Optional[list[str]] = None,
+                 recent: Optional[list[str]] = None):
+        self.profile = profile
+        self.digests = digests or []
+        self.recent = recent or []
+
+    @classmethod
+    def parse(cls, text: Optional[str]) -> "TieredSummary":
+        """gistに保存した要約を読み込む
+        profile, digests, recentのいずれかのキーを持つYAMLの辞書でなければ、
+        従来の要約の文字列としてdigestsの1項目にする。
+        """
+        if not text or not text.strip():
+            return cls()
+        import yaml
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError:
+            data = None
+        if not isinstance(data, dict) or \
+                not {"profile", "digests", "recent"} & set(data):
+            return cls(digests=[text.strip()])
+        return cls(profile=str(data.get("profile") or ""),
+                   digests=[str(d) for d in data.get("digests") or []],
+                   recent=[str(r) for r in data.get("recent") or []])
+
+    def copy(self) -> "TieredSummary":
+        """階層のリストも複製した要約"""
+        return TieredSummary(self.profile, list(self.digests),
+                             list(self.recent))
+
+    def dump(self) -> str:
+        """gistに保存するYAML"""
+        import yaml
+        return yaml.safe_dump(
+            {
+                "profile": self.profile,
+                "digests": self.digests,
+                "recent": self.recent,
+            },
+            allow_unicode=True,
+            sort_keys=False)
+
+    def render(self) -> str:
+        """プロンプトに入れる要約。古い階層から順に改行でつなぐ"""
+        parts = [self.profile, *self.digests, *self.recent]
+        return "\n".join(p.strip() for p in parts if p.strip())
+
+    async def compact(self, condense: Callable[[str, int], Awaitable[str]]):
+        """上限を超えた階層の古い半分を上の階層へまとめ直す
+        condense(text, max_tokens)はtextをmax_tokens以内に要約して返す。
+        要約に失敗したときは階層を変えずに例外を投げるので、
+        次の要約のときにもう一度まとめ直せる。
+        """
+        if len(self.recent) > RECENT_LIMIT:
+            count = len(self.recent) - RECENT_LIMIT // 2
+            digest = await condense("\n".join(self.recent[:count]),
+                                    DIGEST_TOKENS)
+            self.digests.append(digest)
+            del self.recent[:count]
+        if len(self.digests) > DIGEST_LIMIT:
+            count = len(self.digests) - DIGEST_LIMIT // 2
+            self.profile = await condense(
+                "\n".join([self.profile, *self.digests[:count]]),
+                PROFILE_TOKENS)
+            del self.digests[:count]
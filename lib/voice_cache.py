@@ -0,0 +1,222 @@
+"""合成した音声のディスクキャッシュ
+
+(正規化したテキスト, 話者CV, Mode)のハッシュをファイル名にして
+音声のバイナリを保存する。挨拶や決まり文句を何度も合成しないので、
+時間とFASTモードのAPIポイント(1500+100*文字数)を節約できる。
+合計サイズがmax_bytesを超えたら最後に使われた時刻が古いものから消す。
+合計サイズは書き込むたびに足して覚えておき、ディレクトリを数え直すのは
+上限を超えたときだけにする。
+
+# USAGE
+cache = VoiceCache()
+binary = cache.get("こんにちは", CV.四国めたんあまあま, Mode.FAST)
+if binary is None:
+    binary = get_voice("こんにちは", CV.四国めたんあまあま, Mode.FAST).content
+    cache.put("こんにちは", CV.四国めたんあまあま, Mode.FAST, binary)
+print(cache.stats())
+
+# 届いた順に書き込み、最後まで書けたらキャッシュに入れる
+with cache.writer("こんにちは", CV.四国めたんあまあま, Mode.FAST) as f:
+    for chunk in response.iter_content(4096):
+        f.write(chunk)
+"""
+import os
+import re
+import json
+import atexit
+import hashlib
+import threading
+import unicodedata
+from contextlib import contextmanager, suppress
+from typing import BinaryIO, Iterator, Union, Optional
+from .voicevox_character import CV, Mode
+
+# 音声キャッシュを置くディレクトリ
+CACHE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "chat_my_assistant", "voice")
+# キャッシュの合計サイズの上限(バイト)
+MAX_BYTES = int(os.getenv("CHATME_VOICE_CACHE_MB", "200")) * 1024 * 1024
+# 音声ファイルの拡張子
+SUFFIX = ".wav"
+# ヒット数とミス数を記録するファイル名
+STATS_FILE = "stats.json"
+# ヒット数とミス数をディスクへ書き込むまでに貯める回数
+STATS_FLUSH_EVERY = 50
+
+
+def normalize(text: str) -> str:
+    """キャッシュキー用にテキストを正規化する
+    全角半角の揺れをNFKCでそろえ、連続する空白をひとつにする。
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class VoiceCache:
+    """音声バイナリのLRUディスクキャッシュ"""
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # まだディスクへ書き込んでいないヒット数とミス数
+        self._pending: dict[str, int] = {}
+        # SpeechPipelineは複数のスレッドからget()を呼ぶ
+        self._lock = threading.Lock()
+        # キャッシュの合計サイズの見積もり(None=まだ数えていない)
+        self._bytes: Optional[int] = None
+        atexit.register(self.flush_stats)
+
+    @staticmethod
+    def key(text: str, speaker: Union[int, CV], mode: Union[int,
+                                                             Mode]) -> str:
+        """テキスト、話者、モードからキャッシュキーを作る"""
+        source = f"{int(mode)}\0{int(speaker)}\0{normalize(text)}"
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, text: str, speaker: Union[int, CV],
+            mode: Union[int, Mode]) -> Optional[bytes]:
+        """キャッシュされた音声を返す。無ければNone
+        ヒットしたファイルは更新時刻を今にして、LRUの新しい側へ移す。
+        """
+        path = self._path(self.key(text, speaker, mode))
+        try:
+            with open(path, "rb") as f:
+                binary = f.read()
+            os.utime(path)
+        except OSError:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return binary
+
+    def put(self, text: str, speaker: Union[int, CV], mode: Union[int, Mode],
+            binary: bytes):
+        """音声を保存し、上限を超えた分を古いものから消す"""
+        with self.writer(text, speaker, mode) as f:
+            f.write(binary)
+
+    @contextmanager
+    def writer(self, text: str, speaker: Union[int, CV],
+               mode: Union[int, Mode]) -> Iterator[BinaryIO]:
+        """音声を少しずつ書き込む一時ファイルを返す
+        withを抜けたらキャッシュのファイルと置き換えて上限を超えた分を消し、
+        例外や途中で閉じられたジェネレータで抜けたら一時ファイルを捨てる。
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(self.key(text, speaker, mode))
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        replaced = 0  # 置き換えたファイルのサイズ
+        try:
+            with open(tmp, "wb") as f:
+                yield f
+                written = f.tell()
+            with suppress(FileNotFoundError):
+                replaced = os.stat(path).st_size
+            os.replace(tmp, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+        self._grow(written - replaced)
+
+    def _grow(self, delta: int):
+        """合計サイズにdeltaを足し、上限を超えたら古いものから消す"""
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += delta
+            over = self._bytes is None or self._bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self) -> list[tuple[str, os.stat_result]]:
+        """(パス, stat)を最後に使われた時刻の古い順に返す"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((path, os.stat(path)))
+            except FileNotFoundError:  # 他のプロセスが消した
+                continue
+        return sorted(entries, key=lambda e: e[1].st_mtime)
+
+    def evict(self):
+        """合計サイズがmax_bytes以下になるまで古いものから消す
+        他のプロセスが書き込んだ分も数え直して、合計サイズの見積もりを合わせる。
+        """
+        entries = self._entries()
+        total = sum(st.st_size for _, st in entries)
+        for path, st in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= st.st_size
+        with self._lock:
+            self._bytes = total
+
+    def _count(self, field: str):
+        """ヒット数、ミス数をメモリで数え、STATS_FLUSH_EVERY回ごとに
+        ディスクへ書き込む。プロセスをまたいで集計するため。
+        CLIの--cache-statsで表示する。
+        """
+        with self._lock:
+            self._pending[field] = self._pending.get(field, 0) + 1
+            if sum(self._pending.values()) >= STATS_FLUSH_EVERY:
+                self._flush_stats()
+
+    def flush_stats(self):
+        """数えたヒット数、ミス数をディスクの記録に足す(終了時にも呼ばれる)"""
+        with self._lock:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        if not self._pending:
+            return
+        stats = self._load_stats()
+        for field, count in self._pending.items():
+            stats[field] = stats.get(field, 0) + count
+        path = os.path.join(self.directory, STATS_FILE)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(tmp, path)  # 読み込み側が書きかけのファイルを読まない
+        except OSError:
+            return
+        self._pending = {}
+
+    def _load_stats(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, STATS_FILE),
+                      "r",
+                      encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def stats(self) -> dict:
+        """ヒット数、ミス数、ヒット率、エントリ数、合計サイズ"""
+        self.flush_stats()
+        stats = self._load_stats()
+        hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+        entries = self._entries()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": len(entries),
+            "bytes": sum(st.st_size for _, st in entries),
+            "max_bytes": self.max_bytes,
+        }
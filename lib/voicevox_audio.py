@@ -9,22 +9,48 @@ fast=Trueオプションで高速URLを使用します。
 初期のポイント: 1,000,000ポイント
 
 確認の仕方はcheck_point()
+
+長い文章はsplit_sentences()で文に分け、SpeechPipelineで
+次の文を合成しながら今の文を再生する。
+PyAudioがあれば、WEB版APIの音声はダウンロードしながら再生する。
 """
 import os
+import re
+import sys
 from io import BytesIO
 import json
-from typing import Union
-from time import sleep
+from typing import Union, Optional, Callable, Iterator
+from time import sleep, monotonic
 import argparse
+import asyncio
+import threading
+from functools import partial
+from contextlib import nullcontext
 import requests
 from pydub import AudioSegment
 from pydub.playback import play
 from .voicevox_character import CV, Mode
+from .voice_cache import VoiceCache
+from .voicevox_local import LocalEngine, URL as local_url
+from .metrics import tracer
+from .http_session import close_session
+from . import pcm_stream
 
 apikey = os.getenv("VOICEVOX_API_KEY")
-url = "https://api.tts.quest/v1"
-fast_url = "https://api.su-shiki.com/v2"
-local_url = "http://localhost:50021"
+url = os.getenv("VOICEVOX_SLOW_URL", "https://api.tts.quest/v1")
+fast_url = os.getenv("VOICEVOX_FAST_URL", "https://api.su-shiki.com/v2")
+# 再生より先に合成しておく文の数
+LOOKAHEAD = 3
+# SLOWモードで音声の準備ができたか確認する最初の間隔(秒)
+POLL_INTERVAL = 0.2
+# 確認の間隔の上限(秒)
+POLL_INTERVAL_MAX = 2.0
+# 音声の準備を待つ上限(秒)
+POLL_DEADLINE = 30.0
+# 句読点までをひとつの文とみなす
+SENTENCE = re.compile(r".*?[。．！？!?\n]+", re.S)
+# 合成した音声のディスクキャッシュ
+voice_cache = VoiceCache()
 
 
 def check_point() -> dict:
@@ -63,7 +89,9 @@ def get_voice(text,
         return response
     elif mode == 2:  # Mode FAST
         params = {"key": apikey, "speaker": int(speaker), "text": text}
-        response = requests.get(f"{fast_url}/voicevox/audio", params)
+        response = requests.get(f"{fast_url}/voicevox/audio",
+                                params,
+                                stream=True)
         return response
     # Mode SLOW
     wav_api = requests.get(
@@ -75,12 +103,152 @@ def get_voice(text,
     if wav_api.status_code != 200:
         print("Warnig: Use fast mode")
         raise requests.HTTPError(wav_api.status_code)
-    wav_url = wav_api.json()["wavDownloadUrl"]
-    sleep(3)
-    response = requests.get(wav_url)
+    resp_json = wav_api.json()
+    wait_audio_ready(resp_json["audioStatusUrl"])
+    response = requests.get(resp_json["wavDownloadUrl"], stream=True)
     return response
 
 
+def wait_audio_ready(status_url: str,
+                     interval: float = POLL_INTERVAL,
+                     deadline: float = POLL_DEADLINE):
+    """SLOWモードの音声の準備ができるまで待つ
+    audioStatusUrlを指数バックオフしながら確認し、
+    isAudioReadyになったらすぐに戻る。
+    合成に失敗したときやdeadline秒を過ぎたらrequests.HTTPErrorを投げる。
+    1回の確認もdeadlineまでの残り時間しか待たない。
+    """
+    limit = monotonic() + deadline
+    while True:
+        try:
+            response = requests.get(status_url,
+                                    timeout=max(limit - monotonic(), 0.1))
+        except requests.Timeout as err:
+            raise requests.HTTPError(
+                f"音声合成が{deadline}秒以内に終わりませんでした。") from err
+        response.raise_for_status()
+        status = response.json()
+        if status.get("isAudioError"):
+            raise requests.HTTPError(f"音声合成に失敗しました。{status}")
+        if status.get("isAudioReady"):
+            return
+        if monotonic() + interval > limit:
+            raise requests.HTTPError(f"音声合成が{deadline}秒以内に終わりませんでした。")
+        sleep(interval)
+        interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+
+def synthesize(text,
+               speaker: Union[int, CV] = CV(0),
+               mode: Union[int, Mode] = Mode.SLOW,
+               use_cache: bool = True) -> bytes:
+    """音声のバイナリを返す
+    キャッシュにあればVOICEVOXにアクセスしない。
+    合成に成功した音声はキャッシュに保存する。
+    """
+    if use_cache:
+        binary = voice_cache.get(text, speaker, mode)
+        if binary is not None:
+            return binary
+    response = get_voice(text, speaker, mode)
+    response.raise_for_status()
+    binary = response.content
+    if use_cache:
+        voice_cache.put(text, speaker, mode, binary)
+    return binary
+
+
+def stream_voice(text,
+                 speaker: Union[int, CV] = CV(0),
+                 mode: Union[int, Mode] = Mode.SLOW,
+                 use_cache: bool = True) -> Union[bytes, Iterator[bytes]]:
+    """キャッシュにあれば音声のバイナリ、無ければ本文を少しずつ返すイテレータ
+    ステータスを確認するところまではここで行い、本文は読み進めた分だけ届く。
+    届いた分はメモリに貯めずにキャッシュの一時ファイルへ書き込み、
+    最後まで読み終えたらキャッシュに入れる。
+    """
+    if use_cache:
+        binary = voice_cache.get(text, speaker, mode)
+        if binary is not None:
+            return binary
+    response = get_voice(text, speaker, mode)
+    response.raise_for_status()
+
+    def chunks() -> Iterator[bytes]:
+        cached = voice_cache.writer(text, speaker, mode) \
+            if use_cache else nullcontext()
+        with response, cached as f:
+            for chunk in response.iter_content(pcm_stream.CHUNK_BYTES):
+                if f is not None:
+                    f.write(chunk)
+                yield chunk
+
+    return VoiceStream(response, chunks())
+
+
+class VoiceStream:
+    """音声の本文を少しずつ返すイテレータ
+    読み始める前でもclose()で接続を閉じられる。
+    読みかけで閉じたときはキャッシュに入れない。
+    """
+    def __init__(self, response: requests.Response, chunks: Iterator[bytes]):
+        self.response = response
+        self._chunks = chunks
+
+    def __iter__(self) -> "VoiceStream":
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self._chunks)
+
+    def close(self):
+        """接続を閉じる"""
+        self._chunks.close()
+        self.response.close()
+
+
+def close_voice(binary: Union[bytes, Iterator[bytes]]):
+    """再生しなかった音声の接続を閉じる"""
+    if isinstance(binary, VoiceStream):
+        binary.close()
+
+
+def discard_voice(future: asyncio.Future):
+    """合成し終えたのに再生しない音声の接続を閉じる"""
+    if future.done() and not future.cancelled() and \
+            future.exception() is None:
+        close_voice(future.result())
+
+
+async def synthesize_local(texts: list[str],
+                           speaker: Union[int, CV] = CV(0),
+                           use_cache: bool = True) -> list[bytes]:
+    """ローカルのVOICEVOXエンジンで複数の文をまとめて合成する
+    キャッシュに無い文だけを1回のmulti_synthesisで合成する。
+    キャッシュの読み書きはイベントループを止めないように別スレッドで行う。
+    """
+    def cached() -> list[Optional[bytes]]:
+        return [voice_cache.get(text, speaker, Mode.LOCAL) for text in texts]
+
+    def store(rendered: dict[int, bytes]):
+        for i, binary in rendered.items():
+            voice_cache.put(texts[i], speaker, Mode.LOCAL, binary)
+
+    binaries = await asyncio.to_thread(cached) if use_cache \
+        else [None] * len(texts)
+    missing = [i for i, binary in enumerate(binaries) if binary is None]
+    if missing:
+        engine = LocalEngine(local_url)
+        rendered = dict(
+            zip(missing, await engine.synthesize_many(
+                [texts[i] for i in missing], speaker)))
+        for i, binary in rendered.items():
+            binaries[i] = binary
+        if use_cache:
+            await asyncio.to_thread(store, rendered)
+    return binaries
+
+
 def build_audio(binary, wav_file=None):
     """audioバイナリを作成
     ファイルパス wav_fileが渡されたらそのファイルにwavを保存する。
@@ -93,13 +261,216 @@ def build_audio(binary, wav_file=None):
     return AudioSegment.from_wav(wav_file)
 
 
+def split_sentences(text: str) -> tuple[list[str], str]:
+    """句読点で文に分ける
+    return: (句読点で終わった文のリスト, 句読点で終わっていない残り)
+    """
+    sentences = []
+    end = 0
+    for match in SENTENCE.finditer(text):
+        sentences.append(match.group())
+        end = match.end()
+    return sentences, text[end:]
+
+
+def play_binary(binary: Union[bytes, Iterator[bytes]],
+                stop: Optional[threading.Event] = None):
+    """音声のバイナリか、本文を少しずつ返すイテレータを再生する
+    PyAudioがあればデコードせずにPCMをそのままデバイスへ書き込み、
+    stopがセットされたらすぐに再生をやめる。
+    無ければpydubでデコードして最後まで再生する。
+    """
+    if pcm_stream.available():
+        chunks = [binary] if isinstance(binary, bytes) else binary
+        try:
+            with tracer.span("voice.play", streaming=True):
+                pcm_stream.play_pcm(chunks, stop)
+        finally:  # 途中で止めたときも接続を閉じる
+            close_voice(binary)
+        return
+    if not isinstance(binary, bytes):
+        binary = b"".join(binary)
+    with tracer.span("voice.decode", bytes=len(binary)):
+        audio = build_audio(binary)
+    with tracer.span("voice.play", seconds=audio.duration_seconds):
+        play(audio)
+
+
+class SpeechPipeline:
+    """文ごとに音声合成と再生を並行して行う
+    feed()で受け取ったテキストを文に分け、再生よりlookahead文先まで
+    並行して合成し、再生は文の順番通りに行う。
+    最初の音声が出るまでの時間は最初の文の合成時間だけで決まる。
+    LOCALモードでは最初の文を単独で、一度に届いた残りの文は
+    lookahead文ずつmulti_synthesisでまとめて合成する。
+    再生する関数を指定せずPyAudioがあれば、WEB版APIの音声は
+    ダウンロードを待たずに届いた分から再生する。
+
+    # USAGE
+    speech = SpeechPipeline(CV.四国めたんあまあま, Mode.FAST)
+    speech.feed("こんにちは。今日は")  # 「こんにちは。」の合成が始まる
+    speech.feed("晴れです。")
+    speech.close()
+    await speech.wait()
+    speech.cancel()  # 途中でやめるとき
+    """
+    def __init__(self,
+                 speaker: Union[int, CV] = CV.四国めたんあまあま,
+                 mode: Union[int, Mode] = Mode.SLOW,
+                 lookahead: int = LOOKAHEAD,
+                 player: Optional[Callable[[bytes], None]] = None):
+        self.speaker = speaker
+        self.mode = mode
+        self._stop = threading.Event()  # 再生中の音声を止める
+        # 音声のバイナリを再生する関数(別スレッドで呼ばれる)
+        self.player = player or partial(play_binary, stop=self._stop)
+        # 合成した音声をダウンロードしながら再生するか
+        self.streaming = player is None and pcm_stream.available()
+        self.lookahead = lookahead
+        self._buffer = ""  # 句読点で終わっていない文
+        self._started = False  # 最初の文を合成に回したか
+        self._queue: asyncio.Queue = asyncio.Queue()  # 文ごとの音声を再生順に
+        self._ahead = asyncio.Semaphore(lookahead)
+        self._acquiring = asyncio.Lock()  # 枠を合成に回した順に確保する
+        self._tasks: set[asyncio.Task] = set()
+        self._player = asyncio.create_task(self._play_all())
+
+    def feed(self, text: str):
+        """テキストを追加し、句読点で終わった文から合成を始める"""
+        sentences, self._buffer = split_sentences(self._buffer + text)
+        self._enqueue(sentences)
+
+    def close(self):
+        """残りのテキストを合成に回し、これ以上追加しないことを伝える"""
+        self._enqueue([self._buffer])
+        self._buffer = ""
+        self._queue.put_nowait(None)
+
+    async def wait(self):
+        """すべての文の再生が終わるまで待つ"""
+        await self._player
+
+    def cancel(self):
+        """合成待ち、合成中、再生待ちの文を取り消し、再生中の音声を止める
+        pydubで再生中の文は止められないので、その文の再生が終わるまで鳴る。
+        """
+        self._stop.set()
+        for task in list(self._tasks):
+            task.cancel()
+        self._player.cancel()
+        # 先に合成し終えて再生待ちの音声の接続を閉じる
+        while not self._queue.empty():
+            future = self._queue.get_nowait()
+            if future is not None:
+                discard_voice(future)
+
+    def _enqueue(self, sentences: list[str]):
+        """文をまとめて合成に回し、文ごとの音声のFutureを再生待ちに入れる"""
+        sentences = [s for s in sentences if s.strip()]
+        if not sentences:
+            return
+        size = self.lookahead if self.mode == Mode.LOCAL else 1
+        batches = []
+        if not self._started:  # 最初の音声を早く出すために単独で合成
+            self._started = True
+            batches.append(sentences[:1])
+            sentences = sentences[1:]
+        batches += [
+            sentences[i:i + size] for i in range(0, len(sentences), size)
+        ]
+        loop = asyncio.get_running_loop()
+        for batch in batches:
+            futures = [loop.create_future() for _ in batch]
+            for future in futures:
+                self._queue.put_nowait(future)
+            task = asyncio.create_task(self._synthesize(batch, futures))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _synthesize(self, batch: list[str],
+                          futures: list[asyncio.Future]):
+        """再生待ちがlookahead文を超えないように待ってから合成する
+        確保した枠は再生側が文の再生を始めるときに返す。
+        """
+        async with self._acquiring:
+            for _ in batch:
+                await self._ahead.acquire()
+        try:
+            with tracer.span("voice.synthesize",
+                             mode=int(self.mode),
+                             sentences=len(batch)):
+                if self.mode == Mode.LOCAL:
+                    binaries = await synthesize_local(batch, self.speaker)
+                else:
+                    binaries = [await self._fetch(batch[0])]
+        except BaseException as err:
+            for future in futures:
+                self._ahead.release()
+                if isinstance(err, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(err)
+            if isinstance(err, asyncio.CancelledError):
+                raise
+            return
+        for future, binary in zip(futures, binaries):
+            future.set_result(binary)
+
+    async def _fetch(self, text: str) -> Union[bytes, Iterator[bytes]]:
+        """WEB版APIで1文を合成する
+        取り消されても別スレッドの問い合わせは終わるまで続くので、
+        届いた音声の接続はそのときに閉じる。
+        """
+        fetch = stream_voice if self.streaming else synthesize
+        fetching = asyncio.ensure_future(
+            asyncio.to_thread(fetch, text, self.speaker, self.mode))
+        try:
+            return await asyncio.shield(fetching)
+        except asyncio.CancelledError:
+            fetching.add_done_callback(discard_voice)
+            raise
+
+    async def _play_all(self):
+        """合成の終わった文から順番に再生する"""
+        while (future := await self._queue.get()) is not None:
+            try:
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                discard_voice(future)
+                raise
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                print(f"Warning: 音声合成に失敗しました。{future.exception()}",
+                      file=sys.stderr)
+                continue
+            self._ahead.release()
+            await asyncio.to_thread(self.player, future.result())
+
+
+async def speak(text,
+                speaker: Union[int, CV] = CV.四国めたんあまあま,
+                mode: Union[int, Mode] = Mode.SLOW,
+                lookahead: Optional[int] = None):
+    """テキストを文ごとに合成しながら再生する"""
+    speech = SpeechPipeline(speaker, mode, lookahead or LOOKAHEAD)
+    speech.feed(text)
+    speech.close()
+    await speech.wait()
+
+
 def play_voice(text,
                speaker: Union[int, CV] = CV.四国めたんあまあま,
                mode: Union[int, Mode] = Mode.SLOW):
     """テキストの再生"""
-    resp = get_voice(text, speaker, mode)
-    audio = build_audio(resp.content)
-    play(audio)
+    async def main():
+        # 共有セッションはこのイベントループに結びつくので、終わったら閉じる
+        try:
+            await speak(text, speaker, mode)
+        finally:
+            await close_session()
+
+    asyncio.run(main())
 
 
 if __name__ == "__main__":
@@ -113,8 +484,16 @@ if __name__ == "__main__":
                         action="count",
                         default=0,
                         help="VOICEVOX モード Local Fast Slow")
-    parser.add_argument("text", help="VOICEVOXに話させる文字列")
+    parser.add_argument("--cache-stats",
+                        action="store_true",
+                        help="音声キャッシュのヒット数、ミス数、サイズを表示")
+    parser.add_argument("text", nargs="?", help="VOICEVOXに話させる文字列")
     args = parser.parse_args()
+    if args.cache_stats:
+        print(json.dumps(voice_cache.stats(), indent=2))
+        sys.exit(0)
+    if args.text is None:
+        parser.error("the following arguments are required: text")
     # リクエスト過多の429エラーが出たときには
     # fastバージョンを使う
     # try:
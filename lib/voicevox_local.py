@@ -0,0 +1,81 @@
+"""ローカルのVOICEVOXエンジンの非同期クライアント
+
+共有セッションのコネクションプールを使い、
+複数の文のaudio_queryを並行して作成し、
+/multi_synthesisで複数の文の音声を1往復で合成する。
+
+# USAGE
+engine = LocalEngine()
+wav = await engine.synthesize("こんにちは。", CV.四国めたんあまあま)
+wavs = await engine.synthesize_many(["こんにちは。", "元気ですか？"], 0)
+"""
+import os
+import json
+import asyncio
+from io import BytesIO
+from zipfile import ZipFile
+from typing import Union
+from .voicevox_character import CV
+from .http_session import get_session
+
+# VOICEVOXエンジンのURL
+URL = os.getenv("VOICEVOX_LOCAL_URL", "http://localhost:50021")
+
+
+class LocalEngine:
+    """VOICEVOXエンジンのHTTP APIを非同期に呼び出す"""
+    def __init__(self, url: str = URL):
+        self.url = url
+
+    async def audio_query(self, text: str, speaker: Union[int, CV] = 0) -> dict:
+        """音声の合成用クエリの作成"""
+        params = {"text": text, "speaker": int(speaker)}
+        async with get_session().post(f"{self.url}/audio_query",
+                                      headers={"accept": "application/json"},
+                                      params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def synthesis(self, query: dict, speaker: Union[int, CV] = 0) -> bytes:
+        """音声合成してwavのバイナリを返す"""
+        headers = {"accept": "audio/wav", "Content-Type": "application/json"}
+        async with get_session().post(f"{self.url}/synthesis",
+                                      headers=headers,
+                                      params={"speaker": int(speaker)},
+                                      data=json.dumps(query)) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def multi_synthesis(self,
+                              queries: list[dict],
+                              speaker: Union[int, CV] = 0) -> list[bytes]:
+        """複数のクエリをまとめて音声合成する
+        エンジンはwavをまとめたzipを返すので、クエリの順に展開して返す。
+        """
+        headers = {"accept": "application/zip",
+                   "Content-Type": "application/json"}
+        async with get_session().post(f"{self.url}/multi_synthesis",
+                                      headers=headers,
+                                      params={"speaker": int(speaker)},
+                                      data=json.dumps(queries)) as response:
+            response.raise_for_status()
+            binary = await response.read()
+        with ZipFile(BytesIO(binary)) as archive:
+            return [archive.read(name) for name in sorted(archive.namelist())]
+
+    async def synthesize(self, text: str, speaker: Union[int, CV] = 0) -> bytes:
+        """テキストを音声合成する"""
+        query = await self.audio_query(text, speaker)
+        return await self.synthesis(query, speaker)
+
+    async def synthesize_many(self,
+                              texts: list[str],
+                              speaker: Union[int, CV] = 0) -> list[bytes]:
+        """複数のテキストをまとめて音声合成する
+        audio_queryは並行して作り、合成は1回のmulti_synthesisで行う。
+        """
+        if len(texts) == 1:
+            return [await self.synthesize(texts[0], speaker)]
+        queries = await asyncio.gather(
+            *[self.audio_query(text, speaker) for text in texts])
+        return await self.multi_synthesis(list(queries), speaker)
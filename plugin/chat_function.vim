@@ -15,5 +15,18 @@ function! Chat()
     set nopaste
 endfunction
 
+" 常駐モードのchatmeへ選択範囲を送り、回答をターミナルに流す
+" 先に python3 chatme.py --daemon -c PRO で起動しておく
+" usage:
+" :'<,'>call ChatDaemon()
+function! ChatDaemon() range
+    " 選択範囲をレジスタxへ格納
+    normal! gv"xy
+    let l:question = tempname()
+    call writefile(split(@x, "\n"), l:question)
+    execute "vs | term python3 ${PYTHONPATH}/chat_my_assistant/lib/chat_client.py -c PRO " . l:question
+endfunction
+
 vnoremap <leader>c :call Chat()<CR>
 nnoremap <leader>c :call Chat()<CR>
+vnoremap <leader>C :call ChatDaemon()<CR>
@@ -0,0 +1,39 @@
+"""テストの共通設定
+
+lib/のモジュールは読み込むときに環境変数から保存先やキャッシュの場所を
+決めるので、読み込む前に一時ディレクトリへ向け、gistには繋がないようにする。
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# テスト全体で使う一時ディレクトリ
+SCRATCH = tempfile.mkdtemp(prefix="chatme-test-")
+os.environ.update({
+    "XDG_CACHE_HOME": os.path.join(SCRATCH, "cache"),
+    "XDG_DATA_HOME": os.path.join(SCRATCH, "data"),
+    "CHATME_STORAGE": "sqlite",
+})
+os.environ.pop("GIST_ID", None)
+
+
+@pytest.fixture
+def run():
+    """コルーチンを新しいイベントループで実行し、共有セッションを閉じる"""
+    from lib.http_session import close_session
+
+    def runner(coroutine):
+        async def main():
+            try:
+                return await coroutine
+            finally:
+                await close_session()
+
+        return asyncio.run(main())
+
+    return runner
@@ -0,0 +1,23 @@
+"""テストで共有する部品"""
+from typing import Optional
+from lib.storage import Storage
+
+
+class DictStorage(Storage):
+    """メモリ上の保存先。changedをrevalidate()の結果にする"""
+    def __init__(self, files: Optional[dict] = None, changed=False):
+        self.files: dict[str, str] = dict(files or {})
+        self.changed = changed
+        self.revalidated = 0
+
+    def get(self, filename: str) -> Optional[str]:
+        return self.files.get(filename)
+
+    async def put(self, filename: str, content: str):
+        self.files[filename] = content
+
+    def revalidate(self) -> bool:
+        self.revalidated += 1
+        if isinstance(self.changed, Exception):
+            raise self.changed
+        return self.changed
@@ -0,0 +1,59 @@
+"""バッチモードの入力の読み方、同時に問い合わせる数と出力の順番"""
+import io
+import json
+import asyncio
+import pytest
+from lib.ai import AI
+from lib.batch import read_prompts, run_batch
+
+
+def test_read_prompts_accepts_each_format():
+    items = read_prompts([
+        '{"id": "a", "prompt": "質問"}\n',
+        '{"request_id": "user-001", "title": "題", "body": "本文"}\n',
+        "\n",
+        "ただの文\n",
+    ])
+    assert items == [
+        {"id": "a", "prompt": "質問"},
+        {"id": "user-001", "prompt": "題\n本文"},
+        {"id": 3, "prompt": "ただの文"},
+    ]
+
+
+class SlowAI(AI):
+    """後の質問ほど早く答え、同時に問い合わせた数を数えるAI"""
+    def __init__(self):
+        super().__init__(memory_tokens=0)
+        self.running = 0
+        self.max_running = 0
+
+    async def post(self, chat_messages, on_delta=None) -> str:
+        prompt = chat_messages[-1].content
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01 * (5 - int(prompt)))
+            if prompt == "3":
+                raise ValueError("APIのエラー")
+            return f"{prompt}への回答"
+        finally:
+            self.running -= 1
+
+
+def test_results_keep_input_order(run):
+    ai = SlowAI()
+    out = io.StringIO()
+    items = [{"id": i, "prompt": str(i)} for i in range(5)]
+    run(run_batch(ai, items, out, concurrency=2))
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["id"] for r in results] == [0, 1, 2, 3, 4]
+    assert results[0]["answer"] == "0への回答"
+    assert results[3]["answer"] is None
+    assert results[3]["error"] == "APIのエラー"
+    assert ai.max_running == 2
+
+
+def test_rejects_zero_concurrency(run):
+    with pytest.raises(ValueError):
+        run(run_batch(SlowAI(), [{"id": 0, "prompt": "0"}], io.StringIO(), 0))
@@ -0,0 +1,49 @@
+"""fit_contextのトークン予算の切り詰め"""
+from collections import namedtuple
+from lib.context import fit_context, message_tokens, estimate_tokens, \
+    MIN_LATEST_TOKENS
+
+Message = namedtuple("Message", ["role", "content"])
+
+
+def total(system_role, summary, messages) -> int:
+    tokens = message_tokens(system_role) + \
+        sum(message_tokens(m.content) for m in messages)
+    return tokens + (message_tokens(summary) if summary else 0)
+
+
+def test_fits_everything_within_budget():
+    messages = [Message("user", "こんにちは"), Message("assistant", "やあ")]
+    summary, kept = fit_context("役割", "要約", messages, 1000)
+    assert summary == "要約"
+    assert kept == messages
+
+
+def test_drops_oldest_messages_first():
+    messages = [Message("user", f"{i}番目の質問です" * 5) for i in range(20)]
+    summary, kept = fit_context("役割", "", messages, 200)
+    assert kept == messages[-len(kept):]
+    assert 0 < len(kept) < len(messages)
+    assert total("役割", summary, kept) <= 200
+
+
+def test_truncates_summary_head():
+    summary, kept = fit_context("役割", "古い" * 200 + "新しい", [
+        Message("user", "質問"),
+    ], 100)
+    assert summary.endswith("新しい")
+    assert total("役割", summary, kept) <= 100
+
+
+def test_keeps_question_when_system_role_fills_budget():
+    question = Message("user", "いま聞きたいこと")
+    summary, kept = fit_context("長い役割" * 500, "要約", [question], 100)
+    assert summary == ""
+    assert kept == [question]
+
+
+def test_long_question_keeps_its_tail():
+    question = Message("user", "前置き" * 1000 + "本題")
+    _, kept = fit_context("役割" * 500, "", [question], 100)
+    assert kept[0].content.endswith("本題")
+    assert estimate_tokens(kept[0].content) <= MIN_LATEST_TOKENS
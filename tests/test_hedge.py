@@ -0,0 +1,108 @@
+"""hedgedのヘッジとフェイルオーバー"""
+import asyncio
+import pytest
+from lib.hedge import Route, LatencyTracker, hedged, parse_routes, \
+    MIN_SAMPLES, MIN_HEDGE_AFTER
+
+PRIMARY = Route("http://primary", "m1", "k1")
+BACKUP = Route("http://backup", "m2", "k2")
+
+
+class Fake:
+    """経路ごとに、最初の要素までの待ち時間と要素か例外を決める問い合わせ"""
+    def __init__(self, plan: dict):
+        self.plan = plan  # route: (待ち時間, 要素のリストか例外)
+        self.started: list[Route] = []
+        self.closed: list[Route] = []
+
+    async def __call__(self, route: Route):
+        self.started.append(route)
+        delay, result = self.plan[route]
+        try:
+            await asyncio.sleep(delay)
+            if isinstance(result, Exception):
+                raise result
+            for item in result:
+                yield item
+        finally:
+            self.closed.append(route)
+
+
+async def collect(routes, start, **options) -> list:
+    options.setdefault("tracker", LatencyTracker())
+    return [item async for item in hedged(routes, start, **options)]
+
+
+def test_single_route(run):
+    fake = Fake({PRIMARY: (0, ["a", "b"])})
+    assert run(collect([PRIMARY], fake)) == [(PRIMARY, "a"), (PRIMARY, "b")]
+
+
+def test_fails_over_without_waiting(run):
+    fake = Fake({PRIMARY: (0, ValueError("503")), BACKUP: (0, ["ok"])})
+    assert run(collect([PRIMARY, BACKUP], fake, after=10)) == [(BACKUP, "ok")]
+
+
+def test_hedges_slow_route_and_cancels_loser(run):
+    fake = Fake({PRIMARY: (1.0, ["late"]), BACKUP: (0, ["fast", "er"])})
+    items = run(collect([PRIMARY, BACKUP], fake, after=0.05))
+    assert items == [(BACKUP, "fast"), (BACKUP, "er")]
+    assert fake.started == [PRIMARY, BACKUP]
+    assert PRIMARY in fake.closed
+
+
+def test_no_hedge_while_not_ready(run):
+    fake = Fake({PRIMARY: (0.15, ["slow"]), BACKUP: (0, ["fast"])})
+    items = run(collect([PRIMARY, BACKUP], fake, after=0.02,
+                        ready=lambda: False))
+    assert items == [(PRIMARY, "slow")]
+    assert fake.started == [PRIMARY]
+
+
+def test_raises_when_every_route_fails(run):
+    fake = Fake({PRIMARY: (0, ValueError("first")),
+                 BACKUP: (0, ValueError("last"))})
+    with pytest.raises(ValueError, match="last"):
+        run(collect([PRIMARY, BACKUP], fake))
+
+
+def test_latency_tracker_median_multiple():
+    tracker = LatencyTracker(default=3.0)
+    assert tracker.threshold(PRIMARY) == 3.0
+    for _ in range(MIN_SAMPLES):
+        tracker.add(PRIMARY, 1.0)
+    assert tracker.threshold(PRIMARY) == 2.0  # 中央値の2倍
+    for _ in range(tracker.window):
+        tracker.add(PRIMARY, 9.0)
+    assert tracker.threshold(PRIMARY) == 3.0  # defaultまで
+    for _ in range(tracker.window):
+        tracker.add(PRIMARY, 0.01)
+    assert tracker.threshold(PRIMARY) == MIN_HEDGE_AFTER
+
+
+@pytest.mark.parametrize("tail", [10, 20])
+def test_hedges_under_a_slow_tail(run, tail):
+    """遅い応答がtail%あっても、遅い応答より前にヘッジを送る"""
+    tracker = LatencyTracker()
+    for i in range(100):
+        tracker.add((PRIMARY, ""), 2.0 if i % 100 < tail else 0.1)
+    assert tracker.threshold((PRIMARY, "")) < 2.0
+    fake = Fake({PRIMARY: (2.0, ["slow"]), BACKUP: (0, ["fast"])})
+    items = run(collect([PRIMARY, BACKUP], fake, tracker=tracker))
+    assert items == [(BACKUP, "fast")]
+
+
+def test_parse_routes(monkeypatch, capsys):
+    monkeypatch.setenv("BACKUP_KEY", "secret")
+    monkeypatch.delenv("MISSING_KEY", raising=False)
+    routes = parse_routes([
+        "m2",
+        {"endpoint": "http://backup", "api_key_env": "BACKUP_KEY"},
+        {"endpoint": "http://gone", "api_key_env": "MISSING_KEY"},
+    ], PRIMARY)
+    assert routes == [
+        Route(PRIMARY.endpoint, "m2", PRIMARY.api_key),
+        Route("http://backup", PRIMARY.model, "secret"),
+    ]
+    assert "MISSING_KEY" in capsys.readouterr().err
+    assert parse_routes(None, PRIMARY) == [PRIMARY]
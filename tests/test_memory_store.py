@@ -0,0 +1,72 @@
+"""MemoryStoreのBM25検索と記憶の数の上限"""
+import os
+from lib import memory_store
+from lib.ai import AI
+from lib.memory_store import MemoryStore, BM25Index
+from helpers import DictStorage
+
+
+def test_bm25_ranks_relevant_first():
+    index = BM25Index()
+    for doc, text in enumerate(["今日はカレーを食べた", "猫の名前はタマ", "明日は雨らしい"]):
+        index.add(doc, text)
+    assert index.search("猫の名前は？", 1)[0][1] == 1
+    assert index.search("xyz", 3) == []
+
+
+def test_recall_within_budget_in_time_order(tmp_path):
+    store = MemoryStore.open("a.txt", directory=str(tmp_path))
+    store.add("猫の名前はタマ")
+    store.add("犬の名前はポチ")
+    store.add("好きな食べ物はカレー")
+    assert store.recall("猫と犬の名前", k=8,
+                        budget=1000) == "猫の名前はタマ\n犬の名前はポチ"
+    assert store.recall("猫と犬の名前", k=8, budget=5) == ""
+
+
+def test_seed_and_reload(tmp_path):
+    store = MemoryStore.open("a.txt",
+                             seed="要約その1\n要約その2",
+                             directory=str(tmp_path))
+    store.add("要約その1")  # 同じ記憶は二重に貯めない
+    reopened = MemoryStore.open("a.txt", seed="別の要約", directory=str(tmp_path))
+    assert reopened.texts == ["要約その1", "要約その2"]
+    assert [r["kind"] for r in reopened.records] == ["summary", "summary"]
+
+
+def test_other_process_appends_are_seen(tmp_path):
+    first = MemoryStore.open("a.txt", directory=str(tmp_path))
+    second = MemoryStore.open("a.txt", directory=str(tmp_path))
+    first.add("猫の名前はタマ")
+    assert second.search("猫", 1) == ["猫の名前はタマ"]
+
+
+def test_compaction_drops_old_exchanges_first(tmp_path):
+    store = MemoryStore.open("a.txt",
+                             seed="大事な要約",
+                             directory=str(tmp_path),
+                             max_records=10)
+    other = MemoryStore.open("a.txt", directory=str(tmp_path), max_records=10)
+    for i in range(100):
+        store.add(f"質問{i}番への回答{i}番")
+    assert len(store.records) <= 10 * 5 // 4
+    assert "大事な要約" in store.texts
+    assert store.texts[-1] == "質問99番への回答99番"
+    assert "質問0番への回答0番" not in store.texts
+    lines = (tmp_path / "a.txt.jsonl").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == len(store.records)
+    # 詰め直したファイルを他のインスタンスも読み直す
+    assert other.search("質問99番", 1) == ["質問99番への回答99番"]
+    assert len(other.records) == len(store.records)
+
+
+def test_memory_is_opt_in():
+    path = os.path.join(memory_store.DATA_DIR, "opt-in.txt.jsonl")
+    storage = DictStorage({"opt-in.txt": "- user: 猫の名前はタマ"})
+    ai = AI(filename="opt-in.txt")
+    ai.load(storage)
+    assert ai.memory is None and not os.path.exists(path)
+    ai = AI(filename="opt-in.txt", memory_tokens=800)
+    ai.load(storage)
+    assert os.path.exists(path)
+    assert "タマ" in ai.memory.recall("猫の名前", k=8, budget=100)
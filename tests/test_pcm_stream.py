@@ -0,0 +1,64 @@
+"""WavParserが分割して届いたWAVからPCMを取り出せるか"""
+import io
+import wave
+import struct
+import pytest
+from lib.pcm_stream import WavParser
+
+
+def make_wav(frames: bytes, channels: int = 1, width: int = 2) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(width)
+        wav.setframerate(24000)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def feed_all(parser: WavParser, binary: bytes, size: int) -> list[bytes]:
+    return [
+        bytes(parser.feed(binary[i:i + size]))
+        for i in range(0, len(binary), size)
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 44, 4096])
+def test_pcm_in_any_chunk_size(size):
+    pcm = bytes(range(256)) * 8
+    parser = WavParser()
+    parts = feed_all(parser, make_wav(pcm, channels=2), size)
+    assert b"".join(parts) == pcm
+    assert parser.format.channels == 2
+    assert parser.format.sample_width == 2
+    # フレーム(2ch×2バイト)の途中で切らない
+    assert all(len(part) % 4 == 0 for part in parts)
+
+
+def test_extra_chunks_before_data():
+    pcm = b"\1\0" * 100
+    wav = make_wav(pcm)
+    # fmtの後ろにLISTチャンクを挟む
+    position = wav.index(b"data")
+    extra = b"LIST" + struct.pack("<I", 5) + b"abcde\0"
+    wav = wav[:position] + extra + wav[position:]
+    wav = wav[:4] + struct.pack("<I", len(wav) - 8) + wav[8:]
+    assert b"".join(feed_all(WavParser(), wav, 10)) == pcm
+
+
+def test_unknown_data_size_reads_to_end():
+    pcm = b"\2\0" * 100
+    wav = bytearray(make_wav(pcm))
+    position = wav.index(b"data")
+    struct.pack_into("<I", wav, position + 4, 0xFFFFFFFF)
+    assert b"".join(feed_all(WavParser(), bytes(wav), 64)) == pcm
+
+
+def test_ignores_bytes_after_data_chunk():
+    pcm = b"\3\0" * 10
+    assert b"".join(feed_all(WavParser(), make_wav(pcm) + b"junk", 5)) == pcm
+
+
+def test_rejects_non_wav():
+    with pytest.raises(ValueError):
+        WavParser().feed(b"ID3\x03" + b"\0" * 20)
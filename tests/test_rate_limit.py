@@ -0,0 +1,71 @@
+"""RateLimiterの優先度と一時停止"""
+import asyncio
+from time import monotonic
+from lib.rate_limit import RateLimiter, Priority, retry_after
+
+
+def test_interactive_goes_before_background(run):
+    async def main():
+        limiter = RateLimiter(rpm=600, tpm=100000)
+        limiter.pause(0.05)
+        order = []
+
+        async def request(name, priority):
+            await limiter.acquire(10, priority)
+            order.append(name)
+
+        background = asyncio.create_task(
+            request("summary", Priority.BACKGROUND))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(
+            request("answer", Priority.INTERACTIVE))
+        await asyncio.gather(background, interactive)
+        return order
+
+    assert run(main()) == ["answer", "summary"]
+
+
+def test_pause_holds_every_request(run):
+    async def main():
+        limiter = RateLimiter(rpm=600, tpm=100000)
+        limiter.pause(0.1)
+        assert not limiter.ready(10)
+        start = monotonic()
+        await limiter.acquire(10)
+        return monotonic() - start
+
+    assert run(main()) >= 0.09
+
+
+def test_tokens_per_minute_delay(run):
+    async def main():
+        limiter = RateLimiter(rpm=600, tpm=600)  # 1秒に10トークン
+        await limiter.acquire(600)
+        assert not limiter.ready(1)
+        start = monotonic()
+        await limiter.acquire(1)
+        return monotonic() - start
+
+    assert 0.05 <= run(main()) < 1.0
+
+
+def test_cancelled_waiter_lets_others_through(run):
+    async def main():
+        limiter = RateLimiter(rpm=600, tpm=100000)
+        limiter.pause(0.05)
+        first = asyncio.create_task(limiter.acquire(10))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(limiter.acquire(10, Priority.BACKGROUND))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.wait_for(second, 1.0)
+        return limiter.ready(10)
+
+    assert run(main())
+
+
+def test_retry_after():
+    assert retry_after({"Retry-After": "1.5"}) == 1.5
+    assert retry_after({}) is None
+    assert retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert retry_after({"Retry-After": "soon"}) is None
@@ -0,0 +1,71 @@
+"""temperature=0の回答キャッシュのキー、期限、追い出しとAI.postでの使い回し"""
+from aiohttp import web
+from lib import ai as ai_module, fake_server
+from lib.ai import AI, Message
+from lib.hedge import Route
+from lib.response_cache import ResponseCache, cacheable
+
+ENDPOINT = "http://api/v1/chat/completions"
+DATA = {"model": "m", "temperature": 0,
+        "messages": [{"role": "user", "content": "質問"}]}
+
+
+def test_key_ignores_streaming_options():
+    assert ResponseCache.key(ENDPOINT, DATA) == \
+        ResponseCache.key(ENDPOINT, {**DATA, "stream": True,
+                                     "stream_options": {"include_usage": 1}})
+    assert ResponseCache.key(ENDPOINT, DATA) != \
+        ResponseCache.key("http://other", DATA)
+    assert cacheable(DATA) and not cacheable({**DATA, "temperature": 1.0})
+
+
+def test_round_trip_and_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path / "r.sqlite3"))
+    assert cache.get(ENDPOINT, DATA) is None
+    cache.put(ENDPOINT, DATA, "回答")
+    assert cache.get(ENDPOINT, DATA) == "回答"
+    expired = ResponseCache(str(tmp_path / "r.sqlite3"), ttl=0)
+    assert expired.get(ENDPOINT, DATA) is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / "r.sqlite3"), max_bytes=20)
+    requests = [{**DATA, "max_tokens": i} for i in range(3)]
+    cache.put(ENDPOINT, requests[0], "a" * 10)
+    cache.put(ENDPOINT, requests[1], "b" * 10)
+    cache.get(ENDPOINT, requests[0])  # 0番を新しい側へ
+    cache.put(ENDPOINT, requests[2], "c" * 10)
+    assert cache.get(ENDPOINT, requests[1]) is None
+    assert cache.get(ENDPOINT, requests[0]) == "a" * 10
+    assert cache.get(ENDPOINT, requests[2]) == "c" * 10
+
+
+def test_post_reuses_answer_without_network(tmp_path, run, monkeypatch):
+    monkeypatch.setattr(ai_module, "response_cache",
+                        ResponseCache(str(tmp_path / "r.sqlite3")))
+    posts = []
+
+    @web.middleware
+    async def count(request, handler):
+        posts.append(request.path)
+        return await handler(request)
+
+    app = fake_server.openai_app(answer="こんにちは")
+    app.middlewares.append(count)
+
+    async def main():
+        server = await fake_server.start(app)
+        try:
+            ai = AI(system_role="案内役", temperature=0, memory_tokens=0)
+            ai.routes = [Route(fake_server.url_of(server) +
+                               "/v1/chat/completions", "m", "k")]
+            question = [Message("user", "やあ")]
+            deltas: list[str] = []
+            first = await ai.post(question)
+            second = await ai.post(question, deltas.append)
+            return first, second, deltas
+        finally:
+            await server.cleanup()
+
+    assert run(main()) == ("こんにちは", "こんにちは", ["こんにちは"])
+    assert len(posts) == 1
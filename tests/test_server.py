@@ -0,0 +1,135 @@
+"""ChatServerの会話ごとの状態と破棄"""
+import asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from lib.ai import AI
+from lib.server import ChatServer, SessionPool
+from lib.session import ChatSession
+from lib.storage import SQLiteStorage, DebouncedStorage, ReplicatedStorage
+from helpers import DictStorage
+
+
+def make_server(tmp_path, **options) -> ChatServer:
+    storage = ReplicatedStorage(SQLiteStorage(str(tmp_path / "s.sqlite3")),
+                                DebouncedStorage(DictStorage(), delay=60))
+    server = ChatServer(character="Test", session_storage=storage, **options)
+    # キャラクタ設定を読み込まずに使うAI
+    server.ais["Test"] = AI(name="Test", filename="test.txt", memory_tokens=0)
+    return server
+
+
+def test_sessions_have_their_own_summary(tmp_path, run):
+    server = make_server(tmp_path)
+
+    async def main():
+        async with server.lease("alice", "Test") as alice, \
+                server.lease("bob", "Test") as bob:
+            pass
+        assert alice.ai is not bob.ai
+        assert alice.ai.summaries is not bob.ai.summaries
+        assert alice.ai.filename == "alice@test.txt"
+        await alice.ai.storage.put(alice.ai.filename, "アリスの要約")
+        await server.close_all()
+
+    run(main())
+    storage = server.session_storage
+    assert storage.primary.get("alice@test.txt") == "アリスの要約"
+    assert storage.primary.get("bob@test.txt") is None
+
+
+def test_evicted_sessions_release_storage_state(tmp_path, run):
+    server = make_server(tmp_path, max_sessions=2)
+    storage = server.session_storage
+
+    async def main():
+        for i in range(6):
+            async with server.lease(f"s{i}", "Test") as chat:
+                await chat.ai.storage.put(chat.ai.filename, f"要約{i}")
+        assert len(server.pool) == 2
+        await asyncio.wait(server._closing)
+        # 破棄した会話の分はもう持っていない
+        assert len(storage._refreshed) <= 2
+        assert len(storage.replica._writers) <= 2
+        await server.close_all()
+
+    run(main())
+    assert storage._refreshed == set()
+    assert storage.replica._writers == {}
+    # 書き込みは捨てずにreplicaまで届いている
+    assert storage.replica.storage.files["s0@test.txt"] == "要約0"
+
+
+def test_leased_session_is_not_evicted(run):
+    async def main():
+        evicted = []
+        pool = SessionPool(max_sessions=1, idle_timeout=0,
+                           on_evict=evicted.append)
+        first = pool.add(("a", "Test"), ChatSession(AI(memory_tokens=0)))
+        pool.add(("b", "Test"), ChatSession(AI(memory_tokens=0)))
+        pool.release(("b", "Test"))
+        assert pool.evict_idle() == 1  # 返したbだけ
+        assert not pool.discard(("a", "Test"))
+        assert pool.acquire(("a", "Test")) is first
+        pool.release(("a", "Test"))
+        pool.release(("a", "Test"))
+        assert pool.discard(("a", "Test"))
+        return len(evicted)
+
+    assert run(main()) == 2
+
+
+async def with_client(server: ChatServer, job):
+    client = TestClient(TestServer(server.app()))
+    await client.start_server()
+    try:
+        return await job(client)
+    finally:
+        await client.close()
+        await server.close_all()
+
+
+def test_websocket_survives_unexpected_errors(tmp_path, run, capsys):
+    server = make_server(tmp_path)
+
+    async def respond(*_args, **_kwargs):
+        raise RuntimeError("boom")
+
+    async def job(client):
+        async with server.lease("alice", "Test") as chat:
+            chat.ai.respond = respond
+        ws = await client.ws_connect("/v1/sessions/alice/ws")
+        replies = []
+        for text in ("一つ目", "二つ目"):
+            await ws.send_json({"text": text})
+            replies.append(await ws.receive_json(timeout=5))
+        await ws.close()
+        return replies
+
+    replies = run(with_client(server, job))
+    assert replies == [{"type": "error", "message": "回答に失敗しました。"}] * 2
+    assert "boom" in capsys.readouterr().err
+
+
+def test_session_in_use_is_not_deleted(tmp_path, run):
+    server = make_server(tmp_path)
+
+    async def job(client):
+        ws = await client.ws_connect("/v1/sessions/alice/ws")
+        busy = await client.delete("/v1/sessions/alice")
+        await ws.close()
+        await asyncio.sleep(0.05)
+        idle = await client.delete("/v1/sessions/alice")
+        return busy.status, idle.status
+
+    assert run(with_client(server, job)) == (409, 204)
+
+
+def test_non_ascii_token_is_rejected(tmp_path, run):
+    server = make_server(tmp_path, token="secret")
+
+    async def job(client):
+        wrong = await client.get("/v1/health?token=ひみつ")
+        right = await client.get("/v1/health",
+                                 headers={"Authorization": "Bearer secret"})
+        return wrong.status, right.status
+
+    assert run(with_client(server, job)) == (401, 200)
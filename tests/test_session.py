@@ -0,0 +1,235 @@
+"""ChatSessionのターンの順番と回答の取り消し、表示できた分だけの要約"""
+import os
+import json
+import signal
+import asyncio
+from types import SimpleNamespace
+import pytest
+from lib import ai as ai_module, fake_server, voicevox_audio
+from lib.ai import AI, Message, Summarizer, barge_in
+from lib.hedge import Route
+from lib.memory_store import MemoryStore
+from lib.metrics import tracer
+from lib.rate_limit import RateLimiter
+from lib.session import ChatSession
+from lib.tiered_summary import RECENT_LIMIT, DIGEST_LIMIT
+from lib.voicevox_character import Mode
+from helpers import DictStorage
+
+
+def make_ai() -> AI:
+    """要約を始めないAI"""
+    return AI(memory_tokens=0, summary_turns=100, summary_interval=60)
+
+
+def test_ctrl_c_cancels_each_turn_and_restores_handler(run):
+    async def main():
+        previous = signal.getsignal(signal.SIGINT)
+        cancelled = []
+        for _ in range(2):  # 続けて2ターン
+            turn = asyncio.create_task(asyncio.sleep(10))
+            with barge_in(turn):
+                os.kill(os.getpid(), signal.SIGINT)
+                await asyncio.wait({turn}, timeout=5)
+            cancelled.append(turn.cancelled())
+            assert signal.getsignal(signal.SIGINT) is previous
+        return cancelled
+
+    assert run(main()) == [True, True]
+
+
+def test_cancelled_answer_keeps_delivered_part(run):
+    ai = make_ai()
+
+    async def post(_messages, on_delta=None):
+        on_delta("途中まで")
+        await asyncio.sleep(10)
+        return "途中まで届いた回答"
+
+    ai.post = post
+
+    async def main():
+        history = []
+        task = asyncio.create_task(ai.respond(history, "質問"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        ai.summaries.cancel()
+        return history
+
+    history = run(main())
+    assert [m.content for m in history] == ["質問", "途中まで"]
+    assert ai.summaries._turns == 1
+
+
+def test_amend_summarizes_only_what_was_shown(run):
+    ai = make_ai()
+
+    async def main():
+        history = [Message("user", "質問")]
+        ai.remember(history, "全部の回答", settle=False)
+        assert ai.summaries._turns == 0
+        ai.amend(history, "全部の")
+        assert history[-1].content == "全部の"
+        assert ai.summaries._turns == 1
+        # 何も表示できなかったときは質問ごと取り除く
+        history.append(Message("user", "次の質問"))
+        ai.remember(history, "見せなかった回答", settle=False)
+        ai.amend(history, "")
+        ai.summaries.cancel()
+        return history
+
+    assert [m.content for m in run(main())] == ["質問", "全部の"]
+
+
+def test_turns_of_a_session_run_one_at_a_time(run):
+    ai = make_ai()
+    order = []
+
+    async def post(messages, on_delta=None):
+        order.append(("start", messages[-1].content))
+        await asyncio.sleep(0.01)
+        order.append(("end", messages[-1].content))
+        return f"{messages[-1].content}への回答"
+
+    ai.post = post
+
+    async def main():
+        session = ChatSession(ai)
+        first = asyncio.create_task(session.send("一つ目"))
+        await asyncio.sleep(0)
+        assert session.busy
+        answers = await asyncio.gather(first, session.send("二つ目"))
+        assert not session.busy
+        ai.summaries.cancel()
+        return answers, [m.content for m in session.history]
+
+    answers, history = run(main())
+    assert answers == ["一つ目への回答", "二つ目への回答"]
+    assert order == [("start", "一つ目"), ("end", "一つ目"),
+                     ("start", "二つ目"), ("end", "二つ目")]
+    assert history == ["一つ目", "一つ目への回答", "二つ目", "二つ目への回答"]
+
+
+def test_failed_turn_leaves_no_question(run):
+    ai = make_ai()
+
+    async def post(_messages, on_delta=None):
+        raise ValueError("APIのエラー")
+
+    ai.post = post
+
+    async def main():
+        session = ChatSession(ai)
+        with pytest.raises(ValueError):
+            await session.send("質問")
+        return session.history
+
+    assert run(main()) == []
+
+
+def test_console_turn_traces_spinner_and_voice_in_the_same_turn(
+        run, monkeypatch, tmp_path):
+    path = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(tracer, "path", str(path))
+    monkeypatch.setattr(voicevox_audio.pcm_stream, "available", lambda: False)
+    monkeypatch.setattr(voicevox_audio, "synthesize", lambda *_: b"wav")
+    monkeypatch.setattr(voicevox_audio, "build_audio",
+                        lambda _: SimpleNamespace(duration_seconds=0))
+    monkeypatch.setattr(voicevox_audio, "play", lambda _: None)
+    ai = make_ai()
+    ai.voice = Mode.SLOW
+
+    async def main():
+        server = await fake_server.start(fake_server.openai_app())
+        try:
+            ai.routes = [Route(fake_server.url_of(server) +
+                               "/v1/chat/completions", "m", "k")]
+            session = ChatSession(ai)
+            for text in ("一つ目", "二つ目"):
+                await session.console_turn(text)
+            ai.summaries.cancel()
+        finally:
+            await server.cleanup()
+            tracer.close()
+
+    run(main())
+    turns: dict[str, set[int]] = {}
+    for line in path.read_text(encoding="utf-8").splitlines():
+        record = json.loads(line)
+        if "span" in record:
+            turns.setdefault(record["span"], set()).add(record["turn"])
+    first = min(turns["post"])
+    assert turns["post"] == {first, first + 1}
+    assert turns["spinner"] == turns["voice.play"] == turns["post"]
+
+
+def test_api_error_keeps_the_console_running(run, monkeypatch, capsys):
+    inputs = ["一つ目", "二つ目", None]
+
+    async def read_input():
+        return inputs.pop(0)
+
+    monkeypatch.setattr(ChatSession, "read_input", staticmethod(read_input))
+    ai = make_ai()
+
+    async def main():
+        app = fake_server.openai_app(error_rate=1.0, error_status=400)
+        server = await fake_server.start(app)
+        try:
+            ai.routes = [Route(fake_server.url_of(server) +
+                               "/v1/chat/completions", "m", "k")]
+            session = ChatSession(ai)
+            await session.interact()
+            return session.history
+        finally:
+            await server.cleanup()
+
+    assert run(main()) == []
+    assert inputs == []
+    assert capsys.readouterr().err.count("Error: 400") == 2
+
+
+def test_soak_keeps_session_state_bounded(run, monkeypatch, tmp_path):
+    """bench/soak.pyを短くしたもの。会話を続けても状態が増え続けない"""
+    turns, max_records = 300, 50
+
+    async def summarize(_self, messages):
+        return f"- user: {messages[0].content}"
+
+    async def condense(text: str, _max_tokens: int) -> str:
+        return text.splitlines()[-1]
+
+    monkeypatch.setattr(Summarizer, "post", summarize)
+    monkeypatch.setattr(ai_module, "condense", condense)
+    monkeypatch.setattr(ai_module, "limiter", RateLimiter(10**6, 10**9))
+    ai = AI(filename="soak.txt", storage=DictStorage(), summary_turns=10,
+            summary_interval=60)
+    ai.memory = MemoryStore.open("soak.txt", directory=str(tmp_path),
+                                 max_records=max_records)
+    sizes: list[tuple[int, int, int]] = []
+
+    async def main():
+        server = await fake_server.start(fake_server.openai_app())
+        try:
+            ai.routes = [Route(fake_server.url_of(server) +
+                               "/v1/chat/completions", "m", "k")]
+            session = ChatSession(ai)
+            for turn in range(turns):
+                await session.send(f"今日は何をしようかな(その{turn})")
+                sizes.append((len(session.history),
+                              len(ai.summaries._pending),
+                              len(ai.memory.records)))
+            await session.close()
+        finally:
+            await server.cleanup()
+
+    run(main())
+    history, pending, records = (max(column[turns // 2:])
+                                 for column in zip(*sizes))
+    assert history <= max(size[0] for size in sizes[:turns // 2])
+    assert pending <= 2 * 2 * ai.summaries.turns  # 要約中の分と次の分
+    assert records <= max_records * 1.25 + 2
+    assert ai.summaries._pending == []
+    assert len(ai.tiers.recent) <= RECENT_LIMIT
+    assert len(ai.tiers.digests) <= DIGEST_LIMIT
@@ -0,0 +1,156 @@
+"""保存先の読み書き、書き込みの間引きとgistへの複製"""
+import socket
+import asyncio
+from lib import fake_server, gist_memory
+from lib.http_session import get_session
+from lib.gist_memory import Gist
+from lib.storage import SQLiteStorage, GistStorage, DebouncedStorage, \
+    ReplicatedStorage
+from helpers import DictStorage
+
+
+def test_sqlite_round_trip(tmp_path, run):
+    path = str(tmp_path / "s.sqlite3")
+    storage = SQLiteStorage(path)
+    assert storage.get("a.txt") is None
+    run(storage.put("a.txt", "一"))
+    storage.set("a.txt", "二")
+    storage.close()
+    assert SQLiteStorage(path).get("a.txt") == "二"
+
+
+def test_replica_fills_missing_primary(tmp_path):
+    primary = SQLiteStorage(str(tmp_path / "s.sqlite3"))
+    replica = DictStorage({"a.txt": "gistの内容"})
+    storage = ReplicatedStorage(primary, replica)
+    assert storage.get("a.txt") == "gistの内容"
+    assert primary.get("a.txt") == "gistの内容"
+    assert storage.get("b.txt") is None
+
+
+def test_replica_edited_elsewhere_wins_once(tmp_path):
+    primary = SQLiteStorage(str(tmp_path / "s.sqlite3"))
+    primary.set("a.txt", "古い")
+    primary.set("b.txt", "ローカル")
+    replica = DictStorage({"a.txt": "ブラウザで編集"}, changed=True)
+    storage = ReplicatedStorage(primary, replica)
+    assert storage.get("a.txt") == "ブラウザで編集"
+    assert storage.get("b.txt") == "ローカル"  # gistに無ければそのまま
+    primary.set("a.txt", "この後の書き込み")
+    assert storage.get("a.txt") == "この後の書き込み"  # 取り込みは1回だけ
+    assert replica.revalidated == 1
+
+
+def test_unchanged_or_unreachable_replica_keeps_primary(tmp_path, capsys):
+    for changed in (False, OSError("接続できません")):
+        primary = SQLiteStorage(str(tmp_path / f"{changed!s}.sqlite3"))
+        primary.set("a.txt", "ローカル")
+        storage = ReplicatedStorage(primary, DictStorage({"a.txt": "gist"},
+                                                         changed))
+        assert storage.get("a.txt") == "ローカル"
+    assert "接続できません" in capsys.readouterr().err
+
+
+def test_debounced_writes_only_the_last(run):
+    replica = DictStorage()
+    storage = DebouncedStorage(replica, delay=60)
+
+    async def main():
+        await storage.put("a.txt", "一")
+        await storage.put("a.txt", "二")
+        assert replica.files == {}
+        await storage.flush()
+        return dict(replica.files), len(storage._writers)
+
+    assert run(main()) == ({"a.txt": "二"}, 0)
+
+
+def start_gist(monkeypatch, tmp_path, url: str) -> ReplicatedStorage:
+    """プロセスを起動し直したときのようにgistを取得し直す保存先"""
+    monkeypatch.setattr(Gist, "_root", url + "/gists/")
+    monkeypatch.setattr(Gist, "_id", "g")
+    monkeypatch.setattr(Gist, "_Gist__token", "t")
+    monkeypatch.setattr(Gist, "_document", None)
+    monkeypatch.setattr(Gist, "modified", False)
+    monkeypatch.setattr(gist_memory, "CACHE_DIR", str(tmp_path / "cache"))
+    return ReplicatedStorage(SQLiteStorage(str(tmp_path / "s.sqlite3")),
+                             DebouncedStorage(GistStorage(), delay=60))
+
+
+def test_gist_edits_are_pulled_on_next_start(monkeypatch, tmp_path, run):
+    patches = []
+    app = fake_server.gist_app({"a.txt": "v1"},
+                               on_patch=lambda *p: patches.append(p))
+
+    async def main():
+        server = await fake_server.start(app)
+        url = fake_server.url_of(server)
+        try:
+            storage = start_gist(monkeypatch, tmp_path, url)
+            first = await asyncio.to_thread(storage.get, "a.txt")
+            await storage.put("a.txt", "v2")
+            await storage.flush()
+            # 自分の書き込みだけなら304でローカルをそのまま使う
+            storage = start_gist(monkeypatch, tmp_path, url)
+            second = await asyncio.to_thread(storage.get, "a.txt")
+            unchanged = storage.revalidate()
+            # ブラウザでの編集は次の起動で取り込む
+            body = {"files": {"a.txt": {"content": "edited"}}}
+            async with get_session().patch(f"{url}/gists/g", json=body):
+                pass
+            storage = start_gist(monkeypatch, tmp_path, url)
+            third = await asyncio.to_thread(storage.get, "a.txt")
+            return first, second, unchanged, third, storage.revalidate()
+        finally:
+            await server.cleanup()
+
+    assert run(main()) == ("v1", "v2", False, "edited", True)
+    assert patches == [("a.txt", "v2"), ("a.txt", "edited")]
+
+
+def closed_url() -> str:
+    """どこも待ち受けていないURL"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def test_unreachable_gist_keeps_primary(monkeypatch, tmp_path, capsys):
+    storage = start_gist(monkeypatch, tmp_path, closed_url())
+    storage.primary.set("character.yml", "- name: T")
+    assert storage.get("character.yml") == "- name: T"
+    assert storage.get("T.txt") is None  # ローカルに無く、gistにも繋がらない
+    assert "T.txt" in capsys.readouterr().err
+
+
+def test_offline_without_cache_never_connects(monkeypatch, tmp_path, capsys):
+    storage = start_gist(monkeypatch, tmp_path, closed_url())
+    monkeypatch.setattr(Gist, "offline", True)
+    storage.primary.set("character.yml", "- name: T")
+    assert storage.get("character.yml") == "- name: T"
+    assert storage.get("T.txt") is None
+    assert capsys.readouterr().err == ""
+
+
+def test_offline_never_patches(monkeypatch, tmp_path, run, capsys):
+    from lib import http_session
+    patches = []
+
+    class Session:
+        def patch(self, *args, **kwargs):
+            patches.append(args)
+            raise AssertionError("offlineでgistへ書き込みました")
+
+    storage = start_gist(monkeypatch, tmp_path, closed_url())
+    monkeypatch.setattr(Gist, "offline", True)
+    monkeypatch.setattr(http_session, "get_session", Session)
+
+    async def main():
+        await storage.put("T.txt", "要約")
+        await storage.flush()
+
+    run(main())
+    assert patches == []
+    assert storage.primary.get("T.txt") == "要約"
+    assert capsys.readouterr().err == ""
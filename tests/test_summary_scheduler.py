@@ -0,0 +1,82 @@
+"""SummarySchedulerの間引きと順番"""
+import asyncio
+from lib.summary_scheduler import SummaryScheduler
+
+
+class Recorder:
+    """要約の呼び出しを記録する。failが正ならその回数だけ失敗する"""
+    def __init__(self, delay: float = 0.0, fail: int = 0):
+        self.delay = delay
+        self.fail = fail
+        self.batches: list[list] = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, batch: list):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.fail > 0:
+                self.fail -= 1
+                raise ValueError("summary failed")
+            self.batches.append(batch)
+        finally:
+            self.running -= 1
+
+
+def test_batches_every_turns(run):
+    async def main():
+        summarize = Recorder()
+        scheduler = SummaryScheduler(summarize, turns=2, interval=60)
+        for turn in range(3):
+            scheduler.add([f"q{turn}", f"a{turn}"])
+        await asyncio.sleep(0.01)
+        assert summarize.batches == [["q0", "a0", "q1", "a1"]]
+        await scheduler.drain()
+        return summarize.batches
+
+    assert run(main())[-1] == ["q2", "a2"]
+
+
+def test_interval_starts_summary(run):
+    async def main():
+        summarize = Recorder()
+        scheduler = SummaryScheduler(summarize, turns=10, interval=0.05)
+        scheduler.add(["q", "a"])
+        await asyncio.sleep(0.01)
+        assert summarize.batches == []
+        await asyncio.sleep(0.1)
+        return summarize.batches
+
+    assert run(main()) == [["q", "a"]]
+
+
+def test_runs_one_at_a_time(run):
+    async def main():
+        summarize = Recorder(delay=0.05)
+        scheduler = SummaryScheduler(summarize, turns=1)
+        for turn in range(3):
+            scheduler.add([turn])
+            await asyncio.sleep(0.01)
+        await scheduler.drain()
+        return summarize
+
+    summarize = run(main())
+    assert summarize.max_running == 1
+    # 実行中に増えた会話は終わってからまとめて要約する
+    assert summarize.batches == [[0], [1, 2]]
+
+
+def test_failed_summary_is_retried(run, capsys):
+    async def main():
+        summarize = Recorder(fail=1)
+        scheduler = SummaryScheduler(summarize, turns=1)
+        scheduler.add(["q0"])
+        await asyncio.sleep(0.01)
+        scheduler.add(["q1"])
+        await scheduler.drain()
+        return summarize.batches
+
+    assert run(main()) == [["q0", "q1"]]
+    assert "要約に失敗しました" in capsys.readouterr().err
@@ -0,0 +1,80 @@
+"""TieredSummaryの読み書きとまとめ直し、要約の失敗からのやり直し"""
+import pytest
+from lib.ai import AI, Message, Summarizer, condense
+from lib.storage import Storage
+from lib.tiered_summary import TieredSummary, RECENT_LIMIT, DIGEST_LIMIT
+
+
+async def fake_condense(text: str, max_tokens: int) -> str:
+    return f"まとめ({len(text.splitlines())}行)"
+
+
+def test_dump_and_parse_round_trip():
+    tiers = TieredSummary("全体像", ["中間"], ["最近1", "最近2"])
+    parsed = TieredSummary.parse(tiers.dump())
+    assert (parsed.profile, parsed.digests, parsed.recent) == \
+        ("全体像", ["中間"], ["最近1", "最近2"])
+    assert parsed.render() == "全体像\n中間\n最近1\n最近2"
+
+
+def test_plain_text_becomes_a_digest():
+    assert TieredSummary.parse("- user: 昔の要約").digests == ["- user: 昔の要約"]
+    assert TieredSummary.parse("  ").render() == ""
+
+
+def test_compact_moves_old_items_up(run):
+    tiers = TieredSummary(recent=[f"最近{i}" for i in range(RECENT_LIMIT + 1)])
+    run(tiers.compact(fake_condense))
+    assert len(tiers.recent) == RECENT_LIMIT // 2
+    assert tiers.recent[-1] == f"最近{RECENT_LIMIT}"
+    assert tiers.digests == [f"まとめ({RECENT_LIMIT // 2 + 1}行)"]
+
+    tiers.digests = [f"中間{i}" for i in range(DIGEST_LIMIT + 1)]
+    run(tiers.compact(fake_condense))
+    assert tiers.profile.startswith("まとめ")
+    assert len(tiers.digests) == DIGEST_LIMIT // 2
+
+
+class FlakyStorage(Storage):
+    """最初のput()だけ失敗する保存先"""
+    def __init__(self):
+        self.files: dict[str, str] = {}
+        self.failures = 1
+
+    def get(self, filename: str):
+        return self.files.get(filename)
+
+    async def put(self, filename: str, content: str):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("保存できません")
+        self.files[filename] = content
+
+
+def test_failed_save_does_not_add_the_batch_twice(run, monkeypatch):
+    async def post(_self, _messages):
+        return "- user: 猫の名前はタマ"
+
+    monkeypatch.setattr(Summarizer, "post", post)
+    storage = FlakyStorage()
+    ai = AI(filename="a.txt", storage=storage, memory_tokens=0)
+    batch = [Message("user", "猫の名前はタマ"), Message("assistant", "はい")]
+    with pytest.raises(OSError):
+        run(ai.summarize(batch))
+    assert ai.tiers.recent == []
+    run(ai.summarize(batch))  # やり直し
+    assert ai.tiers.recent == ["- user: 猫の名前はタマ"]
+    assert TieredSummary.parse(storage.files["a.txt"]).recent == ai.tiers.recent
+
+
+def test_condense_keeps_yaml_like_text(run, monkeypatch):
+    sent = []
+
+    async def post(self, _messages):
+        sent.append(self.chat_summary)
+        return "まとめ"
+
+    monkeypatch.setattr(Summarizer, "post", post)
+    # 保存した要約の形をしていても、まとめ直す文字列として扱う
+    assert run(condense("recent: [最近]\nprofile: 全体像", 100)) == "まとめ"
+    assert sent == ["recent: [最近]\nprofile: 全体像"]
@@ -0,0 +1,56 @@
+"""VoiceCacheのキーの正規化、LRUの追い出しと書きかけの扱い"""
+import os
+import pytest
+from lib import voice_cache
+from lib.voice_cache import VoiceCache
+from lib.voicevox_character import Mode
+
+
+def test_key_ignores_width_and_spaces():
+    assert VoiceCache.key("ＡＢＣ  です", 0, Mode.FAST) == \
+        VoiceCache.key("ABC です", 0, Mode.FAST)
+    assert VoiceCache.key("ABC", 0, Mode.FAST) != \
+        VoiceCache.key("ABC", 1, Mode.FAST)
+
+
+def test_put_get_and_stats(tmp_path):
+    cache = VoiceCache(str(tmp_path))
+    assert cache.get("こんにちは", 0, Mode.FAST) is None
+    cache.put("こんにちは", 0, Mode.FAST, b"wav")
+    assert cache.get("こんにちは", 0, Mode.FAST) == b"wav"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert (stats["entries"], stats["bytes"]) == (1, 3)
+
+
+def test_evicts_least_recently_used_only_when_over(tmp_path, monkeypatch):
+    cache = VoiceCache(str(tmp_path), max_bytes=30)
+    scans = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        scans.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(voice_cache.os, "listdir", counting_listdir)
+    for i in range(3):
+        cache.put(f"文{i}", 0, Mode.FAST, b"x" * 10)
+        os.utime(cache._path(cache.key(f"文{i}", 0, Mode.FAST)), (i, i))
+    assert len(scans) == 1  # 最初に合計サイズを数えただけ
+    cache.put("文1", 0, Mode.FAST, b"y" * 10)  # 置き換えはサイズが増えない
+    assert len(scans) == 1
+    cache.put("文3", 0, Mode.FAST, b"x" * 10)
+    assert len(scans) == 2
+    assert cache.get("文0", 0, Mode.FAST) is None  # 一番古い
+    assert cache.get("文1", 0, Mode.FAST) == b"y" * 10
+    assert cache._bytes == 30
+
+
+def test_failed_writer_leaves_nothing(tmp_path):
+    cache = VoiceCache(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        with cache.writer("途中", 0, Mode.FAST) as f:
+            f.write(b"half")
+            raise RuntimeError("切断")
+    assert cache.get("途中", 0, Mode.FAST) is None
+    assert os.listdir(tmp_path) == []
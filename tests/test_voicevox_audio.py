@@ -0,0 +1,112 @@
+"""SLOWモードの音声の準備を待つwait_audio_readyとplay_voiceの後片付け"""
+import pytest
+import requests
+from lib import voicevox_audio
+
+
+class FakeResponse:
+    def __init__(self, status: dict, code: int = 200):
+        self.status = status
+        self.status_code = code
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.HTTPError(self.status_code)
+
+    def json(self) -> dict:
+        return self.status
+
+
+def fake_get(responses: list, timeouts: list):
+    def get(_url, timeout=None):
+        timeouts.append(timeout)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return get
+
+
+def test_returns_when_ready(monkeypatch):
+    timeouts: list = []
+    monkeypatch.setattr(voicevox_audio.requests, "get", fake_get([
+        FakeResponse({"isAudioReady": False}),
+        FakeResponse({"isAudioReady": True}),
+    ], timeouts))
+    voicevox_audio.wait_audio_ready("status", interval=0.001, deadline=5)
+    # 確認ごとに残り時間だけ待つ
+    assert len(timeouts) == 2 and all(0 < t <= 5 for t in timeouts)
+
+
+@pytest.mark.parametrize("response", [
+    FakeResponse({}, code=500),
+    requests.Timeout(),
+])
+def test_error_status_and_timeout_raise_http_error(monkeypatch, response):
+    monkeypatch.setattr(voicevox_audio.requests, "get",
+                        fake_get([response], []))
+    with pytest.raises(requests.HTTPError):
+        voicevox_audio.wait_audio_ready("status", deadline=1)
+
+
+def test_play_voice_closes_shared_session(monkeypatch):
+    from lib.http_session import get_session
+    sessions = []
+
+    async def speak(*_args):
+        sessions.append(get_session())
+
+    monkeypatch.setattr(voicevox_audio, "speak", speak)
+    voicevox_audio.play_voice("一回目")
+    voicevox_audio.play_voice("二回目")  # 別のイベントループで作り直す
+    assert sessions[0] is not sessions[1]
+    assert all(session.closed for session in sessions)
+
+
+class FakeStreamResponse:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_cancel_closes_prefetched_streams(run, monkeypatch):
+    import asyncio
+    import threading
+    responses: dict[str, FakeStreamResponse] = {}
+    release = threading.Event()
+    playing = threading.Event()
+
+    def stream_voice(text, *_args):
+        if text == "三。":  # 取り消した後に届く
+            release.wait(5)
+        responses[text] = FakeStreamResponse()
+        return voicevox_audio.VoiceStream(responses[text],
+                                          (c for c in [b"pcm"]))
+
+    def player(_binary):
+        playing.set()
+        release.wait(5)
+
+    monkeypatch.setattr(voicevox_audio, "stream_voice", stream_voice)
+
+    async def main():
+        speech = voicevox_audio.SpeechPipeline(lookahead=3, player=player)
+        speech.streaming = True
+        speech.feed("一。二。三。")
+        speech.close()
+        await asyncio.to_thread(playing.wait, 5)
+        while "二。" not in responses:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        speech.cancel()
+        assert responses["二。"].closed  # 再生待ちだった
+        release.set()
+        while "三。" not in responses:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        return responses["三。"].closed  # 合成中だった
+
+    assert run(main())
@@ -0,0 +1,51 @@
+"""LocalEngineをフェイクのVOICEVOXエンジンに対して確かめる"""
+import io
+import wave
+import aiohttp
+import pytest
+from lib import fake_server
+from lib.voicevox_local import LocalEngine
+
+
+def frames(binary: bytes) -> int:
+    with wave.open(io.BytesIO(binary), "rb") as wav:
+        return wav.getnframes()
+
+
+async def with_engine(job, **options):
+    """フェイクのエンジンを起動してjob(engine)を実行する"""
+    runner = await fake_server.start(fake_server.voicevox_app(**options))
+    try:
+        return await job(LocalEngine(fake_server.url_of(runner)))
+    finally:
+        await runner.cleanup()
+
+
+def test_synthesize_many_keeps_order(run):
+    texts = ["あ", "いいい", "ううううう"]
+    wavs = run(with_engine(lambda e: e.synthesize_many(texts, 3)))
+    assert len(wavs) == len(texts)
+    # フェイクは文字数に比例した長さの無音を返す
+    per_char = int(fake_server.SAMPLE_RATE * fake_server.SECONDS_PER_CHAR)
+    assert [frames(w) for w in wavs] == [per_char * len(t) for t in texts]
+
+
+def test_synthesize_many_single_text(run):
+    wavs = run(with_engine(lambda e: e.synthesize_many(["こんにちは"])))
+    assert len(wavs) == 1
+    assert wavs[0][:4] == b"RIFF"
+
+
+def test_multi_synthesis_unzips_in_query_order(run):
+    async def job(engine):
+        queries = [await engine.audio_query(t) for t in ("ab", "a")]
+        return await engine.multi_synthesis(queries)
+
+    first, second = run(with_engine(job))
+    assert frames(first) == 2 * frames(second)
+
+
+def test_synthesize_many_raises_on_error(run):
+    with pytest.raises(aiohttp.ClientResponseError):
+        run(with_engine(lambda e: e.synthesize_many(["あ", "い"]),
+                        error_rate=1.0))